@@ -0,0 +1,110 @@
+"""Measures the memory used by class metadata records; needs no jvm.
+
+    python devtools/bench_class_memory.py [classes] [loaders]
+
+Builds synthetic MethodsWithGeneric and LineTable replies the way pyjdwp
+decodes them (a fresh string object per decoded string), with every class
+loaded by each of the given number of class loaders. It compares the memory
+used by the decoded replies as they are, which is how classes used to be
+stored, with ClassInfo records sharing strings and line tables through an
+Interner. Sizes are summed over distinct objects, so shared objects count
+once.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pyjdb"))
+import pyjdb
+
+
+def fresh(value):
+    """Returns an equal but distinct unicode string, like a second decode"""
+    return u"".join(list(value))
+
+
+def method_entries(class_index, count):
+    return [{
+            "methodID": method_index,
+            "name": fresh(u"method%d" % (method_index % 20)),
+            "signature": fresh(u"(Ljava/lang/String;I)Ljava/lang/Object;"),
+            "genericSignature": fresh(u""),
+            "modBits": 1}
+            for method_index in xrange(count)]
+
+
+def line_table_reply(method_index):
+    return {
+            "start": 0,
+            "end": 40,
+            "lines": [{"lineCodeIndex": code_index,
+                    "lineNumber": 10 + method_index * 5 + code_index // 8}
+                    for code_index in xrange(0, 40, 4)]}
+
+
+def deep_size(root):
+    seen = set()
+    total = 0
+    stack = [root]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        total += sys.getsizeof(value)
+        if isinstance(value, dict):
+            stack.extend(value.iterkeys())
+            stack.extend(value.itervalues())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+        elif hasattr(value, "__slots__"):
+            stack.extend(getattr(value, slot) for slot in value.__slots__
+                    if slot != "__weakref__" and hasattr(value, slot))
+    return total
+
+
+def main():
+    class_count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    loaders = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    methods_per_class = 15
+
+    decoded = {}
+    model = pyjdb.ClassModel()
+    interner = model.interner
+    type_id = 0
+    for _ in xrange(loaders):
+        for class_index in xrange(class_count):
+            type_id += 1
+            signature = u"Lcom/example/Class%d;" % class_index
+            methods = method_entries(class_index, methods_per_class)
+            line_tables = [line_table_reply(method["methodID"])
+                    for method in methods]
+            decoded[type_id] = {
+                    "typeID": type_id,
+                    "signature": fresh(signature),
+                    "methods": [dict(method, line_table=line_table["lines"])
+                            for method, line_table
+                            in zip(methods, line_tables)]}
+            cls = pyjdb.ClassInfo(type_id, fresh(signature), 1, interner)
+            cls.source_file = interner.string(fresh(u"Class%d.java" %
+                    class_index))
+            cls.source_path = interner.string(u"com/example/" +
+                    cls.source_file)
+            cls.methods = tuple(pyjdb.MethodInfo(method, interner)
+                    for method in methods)
+            for method, line_table in zip(cls.methods, line_tables):
+                method.line_table = interner.line_table(line_table)
+            model.add(cls)
+
+    records = dict((cls_id, model.get(cls_id)) for cls_id in decoded)
+    decoded_size = deep_size(decoded)
+    records_size = deep_size(records)
+    print("%d classes x %d loaders, %d methods each" % (class_count,
+            loaders, methods_per_class))
+    print("decoded replies: %10d bytes" % decoded_size)
+    print("class records:   %10d bytes" % records_size)
+    print("reduction:       %10.1fx" % (float(decoded_size) / records_size))
+    print("interner: %s" % interner.stats())
+
+
+if __name__ == "__main__":
+    main()
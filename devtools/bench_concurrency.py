@@ -0,0 +1,73 @@
+"""Measures pyjdb query latency while class-prepare events are processed.
+
+Attach to a jvm started with a suspended jdwp agent, e.g.
+
+    java -agentlib:jdwp=transport=dt_socket,server=y,suspend=y,address=5995 \
+            ...
+
+and run
+
+    python devtools/bench_concurrency.py [host] [port] [source file]
+
+Every class prepared after the jvm is resumed triggers a metadata fetch on
+an event worker, while the main thread repeatedly resolves a source file,
+looks up breakpoint locations and lists threads. The latency of those
+queries should not depend on how much event processing is going on.
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pyjdb"))
+import pyjdb
+from bench_util import report
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5995
+    filename = sys.argv[3] if len(sys.argv) > 3 else "Object.java"
+    duration = 10.0
+
+    debugger = pyjdb.Pyjdb(host, port)
+    debugger.initialize()
+    # breakpoint locations are looked up by path, as set_breakpoints does
+    path = debugger.class_model.resolve(filename)
+    if path is None:
+        print("%s is not loaded" % filename)
+        debugger.disconnect()
+        return
+
+    queries = {
+        "resolve": lambda: debugger.class_model.resolve(filename),
+        "breakpoint_locations": lambda: debugger.class_model.
+                breakpoint_locations(path, 1),
+        "thread_ids": debugger.thread_model.thread_ids,
+    }
+    samples = dict((name, []) for name in queries)
+    classes_before = len(debugger.class_model)
+    resumer = threading.Thread(target=debugger.resume)
+    resumer.start()
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        for name, query in queries.iteritems():
+            start = time.time()
+            try:
+                query()
+            except pyjdb.Error:
+                pass
+            samples[name].append(time.time() - start)
+        time.sleep(0.0005)
+    resumer.join()
+
+    print("classes prepared during run: %d" % (
+            len(debugger.class_model) - classes_before))
+    print("event stats: %s" % debugger.jdwp.event_stats())
+    for name in sorted(samples):
+        report(name, samples[name])
+    debugger.disconnect()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Measures the latency of pyjdb steps.
+
+Attach to a jvm started with a suspended jdwp agent, e.g.
+
+    java -agentlib:jdwp=transport=dt_socket,server=y,suspend=y,address=5995 \
+            ...
+
+and run
+
+    python devtools/bench_step.py [host] [port] [source file] [line]
+
+Once a thread hits a breakpoint on the given line, it is stepped over,
+into (skipping the default excluded classes) and, for comparison, into
+without any excluded classes, a number of times each. Every step is a
+single round trip plus the time the thread runs, so with the excludes
+stepping into framework-heavy code should cost about as much as stepping
+over it.
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "pyjdb"))
+import pyjdb
+from bench_util import report
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5995
+    filename = sys.argv[3] if len(sys.argv) > 3 else "Main.java"
+    line_number = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    steps = 200
+
+    debugger = pyjdb.Pyjdb(host, port)
+    debugger.initialize()
+    hit = threading.Event()
+    threads = []
+
+    def on_hit(breakpoint, event):
+        threads.append(event["Breakpoint"]["thread"])
+        hit.set()
+    breakpoints = debugger.set_breakpoints([(filename, line_number)],
+            listener=on_hit)
+    debugger.resume()
+    if not hit.wait(60):
+        print("no thread hit %s:%d" % (filename, line_number))
+        return
+    debugger.clear_breakpoints(breakpoints)
+    thread_id = threads[0]
+
+    steppers = [
+        ("step_over", debugger.step_over),
+        ("step_into", debugger.step_into),
+        ("step_into_no_excludes",
+                lambda thread_id: debugger.step_into(thread_id,
+                        class_exclude=())),
+    ]
+    for name, step in steppers:
+        samples = []
+        for _ in xrange(steps):
+            start = time.time()
+            step(thread_id)
+            samples.append(time.time() - start)
+        report(name, samples)
+    debugger.resume()
+    debugger.disconnect()
+
+
+if __name__ == "__main__":
+    main()
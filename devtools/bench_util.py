@@ -0,0 +1,15 @@
+"""Latency reporting shared by the devtools benchmarks."""
+
+
+def percentile(samples, fraction):
+    """Returns the given fraction's percentile of sorted samples"""
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def report(name, samples):
+    """Prints the count, median, 99th percentile and maximum of samples, in
+    seconds, as microseconds"""
+    samples = sorted(samples)
+    print("%-22s n=%-7d p50=%8.1fus p99=%8.1fus max=%8.1fus" % (
+            name, len(samples), percentile(samples, 0.5) * 1e6,
+            percentile(samples, 0.99) * 1e6, samples[-1] * 1e6))
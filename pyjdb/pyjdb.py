@@ -1,7 +1,16 @@
 """Python library for debugging java programs. Backed by pyjdwp, a wrapper of
 the Java Debug Wire Protocol (jdwp)"""
+import array
+import bisect
+import collections
+import heapq
+import logging
 import pyjdwp
+import snapshot
+import struct
 import threading
+import time
+import weakref
 
 
 class Error(Exception):
@@ -9,195 +18,3453 @@ class Error(Exception):
     pass
 
 
+# classes step_into, step_over and step_out run through without stopping
+STEP_CLASS_EXCLUDES = ("java.*", "javax.*", "sun.*", "com.sun.*", "jdk.*")
+
+
+class Interner(object):
+    """Shares equal strings and line tables between the class records of a
+    ClassModel, so repeated signatures and names, and identical line tables
+    (e.g., of bridge methods or of the same method in classes loaded by
+    several class loaders), are stored once.
+
+    Line tables are looked up by a hash of their contents and compared in
+    full on a hit, so the table keeps no copy of them; it holds them weakly.
+    Strings cannot be weakly referenced, so the class model retains the
+    strings of each class it installs and releases them when the class is
+    unloaded; a string is dropped once no installed class retains it. Strings
+    never retained are held until clear()."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__strings = {}
+        self.__ref_counts = {}
+        self.__line_tables = weakref.WeakValueDictionary()
+
+    def string(self, value):
+        """Like the intern builtin, but also accepts the unicode strings
+        pyjdwp decodes"""
+        if value is None:
+            return None
+        with self.__lock:
+            return self.__strings.setdefault(value, value)
+
+    def line_table(self, line_table_reply):
+        """Returns a LineTable for a Method.LineTable reply, shared with
+        earlier equal ones"""
+        line_table = LineTable.create(line_table_reply)
+        key = (line_table.start, line_table.end, len(line_table),
+                hash(buffer(line_table.code_indexes)),
+                hash(buffer(line_table.lines)))
+        with self.__lock:
+            shared = self.__line_tables.get(key)
+            if shared is None:
+                self.__line_tables[key] = line_table
+                return line_table
+        if shared.code_indexes == line_table.code_indexes and \
+                shared.lines == line_table.lines:
+            return shared
+        # a hash collision; such tables are simply not shared
+        return line_table
+
+    def retain(self, strings):
+        """Counts a reference to each of strings (None entries are
+        skipped)"""
+        with self.__lock:
+            for value in strings:
+                if value is not None:
+                    self.__ref_counts[value] = \
+                            self.__ref_counts.get(value, 0) + 1
+
+    def release(self, strings):
+        """Drops a reference to each of strings, and the strings left with
+        none"""
+        with self.__lock:
+            for value in strings:
+                if value not in self.__ref_counts:
+                    continue
+                self.__ref_counts[value] -= 1
+                if not self.__ref_counts[value]:
+                    del self.__ref_counts[value]
+                    self.__strings.pop(value, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__strings.clear()
+            self.__ref_counts.clear()
+            self.__line_tables.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {"strings": len(self.__strings),
+                    "line_tables": len(self.__line_tables)}
+
+
+class LineTable(object):
+    """A method's line table as parallel code index / line number arrays.
+    Use Interner.line_table to share identical tables."""
+
+    __slots__ = ["start", "end", "code_indexes", "lines", "__weakref__"]
+
+    def __init__(self, start, end, code_indexes, lines):
+        self.start = start
+        self.end = end
+        self.code_indexes = code_indexes
+        self.lines = lines
+
+    @classmethod
+    def create(cls, line_table_reply):
+        entries = sorted((line["lineCodeIndex"], line["lineNumber"])
+                for line in line_table_reply["lines"])
+        return cls(line_table_reply["start"], line_table_reply["end"],
+                array.array("l", [entry[0] for entry in entries]),
+                array.array("i", [entry[1] for entry in entries]))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def line_for_code_index(self, code_index):
+        """Returns the source line of the code at code_index, or None if it
+        precedes the first line entry"""
+        i = bisect.bisect_right(self.code_indexes, code_index)
+        if i == 0:
+            return None
+        return self.lines[i - 1]
+
+
+class FieldInfo(object):
+    __slots__ = ["field_id", "name", "signature", "generic_signature",
+            "access_modifier_bits"]
+
+    def __init__(self, field_entry, interner):
+        self.field_id = field_entry["fieldID"]
+        self.name = interner.string(field_entry["name"])
+        self.signature = interner.string(field_entry["signature"])
+        self.generic_signature = interner.string(
+                field_entry["genericSignature"] or None)
+        self.access_modifier_bits = field_entry["modBits"]
+
+
+class MethodInfo(object):
+    __slots__ = ["method_id", "name", "signature", "generic_signature",
+            "access_modifier_bits", "line_table"]
+
+    def __init__(self, method_entry, interner):
+        self.method_id = method_entry["methodID"]
+        self.name = interner.string(method_entry["name"])
+        self.signature = interner.string(method_entry["signature"])
+        self.generic_signature = interner.string(
+                method_entry["genericSignature"] or None)
+        self.access_modifier_bits = method_entry["modBits"]
+        self.line_table = None
+
+
+class ClassInfo(object):
+    """Metadata of a loaded reference type. Methods and fields are tuples of
+    MethodInfo and FieldInfo records; source_file and source_path are None
+    for classes without source information."""
+
+    __slots__ = ["type_id", "signature", "ref_type_tag",
+            "access_modifier_bits", "fields", "methods", "source_file",
+            "source_path"]
+
+    def __init__(self, type_id, signature, ref_type_tag, interner):
+        self.type_id = type_id
+        self.signature = interner.string(signature)
+        self.ref_type_tag = ref_type_tag
+        self.access_modifier_bits = 0
+        self.fields = ()
+        self.methods = ()
+        self.source_file = None
+        self.source_path = None
+
+    def strings(self):
+        """Returns the strings of the record, for Interner.retain"""
+        strings = [self.signature, self.source_file, self.source_path]
+        for member in self.methods + self.fields:
+            strings.extend([member.name, member.signature,
+                    member.generic_signature])
+        return strings
+
+
+class LineIndex(object):
+    """Index of the executable lines of a single source file.
+
+    Entries live in parallel arrays kept sorted by line number: the code for
+    line lines[i] starts at bytecode index code_indexes[i] of method
+    method_ids[i] in class class_ids[i]. New line tables are appended and the
+    columns are re-sorted lazily on the next lookup, so loading a class costs
+    an append rather than an insertion per line.
+    """
+
+    def __init__(self):
+        self.lines = array.array("i")
+        self.class_ids = array.array("L")
+        self.method_ids = array.array("L")
+        self.code_indexes = array.array("l")
+        self.__sorted = True
+
+    def __len__(self):
+        return len(self.lines)
+
+    def add_line_table(self, class_id, method_id, line_table):
+        self.lines.extend(line_table.lines)
+        self.class_ids.extend([class_id] * len(line_table))
+        self.method_ids.extend([method_id] * len(line_table))
+        self.code_indexes.extend(line_table.code_indexes)
+        if len(line_table):
+            self.__sorted = False
+
+    def remove_class(self, class_id):
+        keep = [i for i in xrange(len(self.lines))
+                if self.class_ids[i] != class_id]
+        if len(keep) != len(self.lines):
+            self.__rebuild(keep)
+
+    def next_line(self, line_number):
+        """Returns the first executable line at or after line_number, or None
+        if there is no code at or after that line"""
+        self.__ensure_sorted()
+        i = bisect.bisect_left(self.lines, line_number)
+        if i == len(self.lines):
+            return None
+        return self.lines[i]
+
+    def lines_in_range(self, start_line, end_line):
+        """Returns the sorted, distinct executable lines in [start, end]"""
+        self.__ensure_sorted()
+        lo, hi = self.__bounds(start_line, end_line)
+        result = []
+        for i in xrange(lo, hi):
+            if not result or result[-1] != self.lines[i]:
+                result.append(self.lines[i])
+        return result
+
+    def locations(self, line_number):
+        """Returns (class_id, method_id, code_index) for every bytecode
+        location attributed to line_number"""
+        return self.locations_in_range(line_number, line_number)
+
+    def locations_in_range(self, start_line, end_line):
+        self.__ensure_sorted()
+        lo, hi = self.__bounds(start_line, end_line)
+        return [(self.class_ids[i], self.method_ids[i], self.code_indexes[i])
+                for i in xrange(lo, hi)]
+
+    def breakpoint_locations(self, line_number):
+        """Returns one location per method containing line_number: the lowest
+        code index of that line, which is where a breakpoint belongs"""
+        result = []
+        seen = set()
+        for class_id, method_id, code_index in self.locations(line_number):
+            if (class_id, method_id) not in seen:
+                seen.add((class_id, method_id))
+                result.append((class_id, method_id, code_index))
+        return result
+
+    def __bounds(self, start_line, end_line):
+        return (bisect.bisect_left(self.lines, start_line),
+                bisect.bisect_right(self.lines, end_line))
+
+    def __ensure_sorted(self):
+        if self.__sorted:
+            return
+        order = sorted(xrange(len(self.lines)), key=lambda i: (
+                self.lines[i], self.class_ids[i], self.method_ids[i],
+                self.code_indexes[i]))
+        self.__rebuild(order)
+
+    def __rebuild(self, order):
+        self.lines = array.array("i", [self.lines[i] for i in order])
+        self.class_ids = array.array("L", [self.class_ids[i] for i in order])
+        self.method_ids = array.array("L", [self.method_ids[i] for i in order])
+        self.code_indexes = array.array(
+                "l", [self.code_indexes[i] for i in order])
+        self.__sorted = True
+
+
+def source_path(signature, source_file):
+    """Returns the package-qualified path of the source file a reference type
+    was compiled from, e.g. ("Lcom/foo/Foo$1;", "Foo.java") ->
+    "com/foo/Foo.java"."""
+    class_name = signature[1 : -1].split("$$Lambda$")[0]
+    if "/" not in class_name:
+        return source_file
+    return "%s/%s" % (class_name.rsplit("/", 1)[0], source_file)
+
+
+def outer_class_signature(signature):
+    """Returns the signature of the top-level class enclosing a nested,
+    anonymous or lambda class signature (or the signature itself)"""
+    class_name = signature[1 : -1].split("$$Lambda$")[0]
+    return "L%s;" % class_name.split("$")[0]
+
+
+class SourceIndex(object):
+    """Index from package-qualified source path (e.g. "com/foo/Foo.java") to
+    the IDs of all reference types compiled from that file, including inner,
+    anonymous and lambda classes. Bare file names ("Foo.java") resolve through
+    a second map and are only accepted when they are unambiguous."""
+
+    def __init__(self):
+        self.class_ids_by_path = {}
+        self.paths_by_file_name = {}
+
+    def add(self, path, class_id):
+        if path not in self.class_ids_by_path:
+            self.class_ids_by_path[path] = set()
+            file_name = path.rsplit("/", 1)[-1]
+            self.paths_by_file_name.setdefault(file_name, set()).add(path)
+        self.class_ids_by_path[path].add(class_id)
+
+    def remove(self, path, class_id):
+        class_ids = self.class_ids_by_path.get(path)
+        if class_ids is None:
+            return
+        class_ids.discard(class_id)
+        if not class_ids:
+            del self.class_ids_by_path[path]
+            file_name = path.rsplit("/", 1)[-1]
+            paths = self.paths_by_file_name[file_name]
+            paths.discard(path)
+            if not paths:
+                del self.paths_by_file_name[file_name]
+
+    def class_ids(self, path):
+        return self.class_ids_by_path.get(path, set())
+
+    def paths(self, filename):
+        """Returns the sorted package-qualified paths filename, a path or a
+        bare file name, may refer to"""
+        if "/" in filename:
+            if filename in self.class_ids_by_path:
+                return [filename]
+            return []
+        return sorted(self.paths_by_file_name.get(filename, ()))
+
+    def resolve(self, filename):
+        """Returns the package-qualified path for filename, which may be either
+        a path or a bare file name; None if no loaded class matches it"""
+        paths = self.paths(filename)
+        if not paths:
+            return None
+        if len(paths) > 1:
+            raise Error("Ambiguous source file %s; use one of %s" % (
+                    filename, ", ".join(paths)))
+        return paths[0]
+
+
+def get_replies(pending_replies):
+    """Waits for pipelined requests (pyjdwp.PendingReply objects) and returns
+    their decoded replies, with None for requests that failed or were never
+    sent (None in place of a PendingReply)"""
+    result = []
+    for reply in pending_replies:
+        if reply is None:
+            result.append(None)
+            continue
+        try:
+            result.append(reply.get())
+        except pyjdwp.Timeout:
+            raise
+        except pyjdwp.Error as e:
+            result.append(None)
+    return result
+
+
+def frame_location(frame):
+    """Returns the location (typeTag, classID, methodID and index) of a frame
+    as decoded from ThreadReference.Frames, which inlines it"""
+    return {
+            "typeTag": frame["typeTag"],
+            "classID": frame["classID"],
+            "methodID": frame["methodID"],
+            "index": frame["index"]}
+
+
+def event_data(event):
+    """Returns the kind-specific payload of a decoded event, e.g. the
+    "ClassPrepare" dict of a CLASS_PREPARE event"""
+    for key, value in event.iteritems():
+        if key != "eventKind":
+            return value
+
+
+class EventSubscriptions(object):
+    """Reference-counted event requests shared between consumers.
+
+    An EventRequest.Set is only issued while at least one consumer holds a
+    subscription for it, and consumers asking for the same event kind,
+    suspend policy and modifiers (e.g. ClassExclude, ThreadOnly, Count) share
+    one request. When the last subscriber goes away the request is removed
+    with EventRequest.Clear, so the target jvm stops reporting events nobody
+    is observing.
+
+    No lock is held while a request is being set. Its events may arrive
+    before its ID does, so listeners are notified through a callback by
+    event kind, and events of unknown requests are held back while a
+    request of their kind is being set, to be passed on once its ID is
+    known; otherwise a suspending event could be lost with its thread left
+    suspended.
+    """
+
+    def __init__(self, jdwp):
+        self.__jdwp = jdwp
+        self.__lock = threading.RLock()
+        self.__set_done = threading.Condition(self.__lock)
+        self.__request_ids_by_key = {}
+        self.__keys_by_request_id = {}
+        self.__ref_counts = {}
+        self.__listeners_by_request_id = {}
+        # keys whose EventRequest.Set is in flight, and how many per kind
+        self.__setting_keys = set()
+        self.__sets_by_kind = collections.defaultdict(int)
+        # request ID -> (event kind, [(suspend policy, event)]) for events
+        # that arrived while a request of their kind was being set
+        self.__early_events = {}
+        # event kind -> listeners, over all requests of that kind
+        self.__listeners_by_kind = collections.defaultdict(int)
+
+    def subscribe(self, event_kind, modifiers=(), suspend_policy=None,
+            listener=None, on_set=None):
+        """Returns the ID of a request for event_kind events, creating it if
+        no matching request exists. listener, if given, is called with the
+        composite suspend policy and the event for every event the request
+        generates. on_set, if given, is called with the request ID before
+        listeners get to see any of its events."""
+        if suspend_policy is None:
+            suspend_policy = self.__jdwp.SuspendPolicy.NONE
+        key = (event_kind, suspend_policy,
+                tuple(self.__freeze(modifier) for modifier in modifiers))
+        with self.__lock:
+            while key in self.__setting_keys:
+                self.__set_done.wait()
+            request_id = self.__request_ids_by_key.get(key)
+            created = request_id is None
+            if created:
+                self.__setting_keys.add(key)
+                self.__sets_by_kind[event_kind] += 1
+            if listener is not None:
+                self.__add_kind_listener(event_kind)
+        if created:
+            try:
+                request_id = self.__jdwp.EventRequest.Set({
+                    "eventKind": event_kind,
+                    "suspendPolicy": suspend_policy,
+                    "modifiers": list(modifiers)})["requestID"]
+            except pyjdwp.Error:
+                with self.__lock:
+                    self.__setting_keys.remove(key)
+                    self.__end_set(event_kind)
+                    if listener is not None:
+                        self.__remove_kind_listener(event_kind)
+                    self.__set_done.notify_all()
+                raise
+        with self.__lock:
+            early_events = []
+            if created:
+                self.__setting_keys.remove(key)
+                self.__request_ids_by_key[key] = request_id
+                self.__keys_by_request_id[request_id] = key
+                self.__ref_counts[request_id] = 0
+                self.__listeners_by_request_id[request_id] = []
+                _, early_events = self.__early_events.pop(request_id,
+                        (event_kind, []))
+                self.__end_set(event_kind)
+                self.__set_done.notify_all()
+            self.__ref_counts[request_id] += 1
+            if listener is not None:
+                self.__listeners_by_request_id[request_id].append(listener)
+            if on_set is not None:
+                on_set(request_id)
+        if listener is not None:
+            for early_suspend_policy, event in early_events:
+                listener(early_suspend_policy, event)
+        return request_id
+
+    def unsubscribe(self, request_id, listener=None):
+        """Drops one subscription to request_id, clearing the request in the
+        target jvm when it was the last one"""
+        with self.__lock:
+            if request_id not in self.__ref_counts:
+                return
+            key = self.__keys_by_request_id[request_id]
+            if listener is not None:
+                self.__listeners_by_request_id[request_id].remove(listener)
+                self.__remove_kind_listener(key[0])
+            self.__ref_counts[request_id] -= 1
+            if self.__ref_counts[request_id] > 0:
+                return
+            del self.__keys_by_request_id[request_id]
+            del self.__request_ids_by_key[key]
+            del self.__ref_counts[request_id]
+            for _ in self.__listeners_by_request_id.pop(request_id):
+                self.__remove_kind_listener(key[0])
+        self.__jdwp.EventRequest.Clear({
+            "eventKind": key[0],
+            "requestID": request_id})
+
+    def listeners(self, request_id):
+        with self.__lock:
+            return list(self.__listeners_by_request_id.get(request_id, []))
+
+    def __add_kind_listener(self, event_kind):
+        self.__listeners_by_kind[event_kind] += 1
+        if self.__listeners_by_kind[event_kind] == 1:
+            self.__jdwp.register_event_callback(self.__notify_listeners,
+                    event_kind)
+
+    def __remove_kind_listener(self, event_kind):
+        self.__listeners_by_kind[event_kind] -= 1
+        if not self.__listeners_by_kind[event_kind]:
+            del self.__listeners_by_kind[event_kind]
+            self.__jdwp.unregister_event_callback(self.__notify_listeners,
+                    event_kind)
+
+    def __end_set(self, event_kind):
+        self.__sets_by_kind[event_kind] -= 1
+        if self.__sets_by_kind[event_kind]:
+            return
+        del self.__sets_by_kind[event_kind]
+        # what is left belongs to requests set by others
+        for request_id, (kind, _) in self.__early_events.items():
+            if kind == event_kind:
+                del self.__early_events[request_id]
+
+    def __notify_listeners(self, event_list):
+        suspend_policy = event_list["suspendPolicy"]
+        for event in event_list["events"]:
+            request_id = event_data(event)["requestID"]
+            with self.__lock:
+                listeners = self.__listeners_by_request_id.get(request_id)
+                if listeners is None:
+                    if self.__sets_by_kind.get(event["eventKind"]):
+                        self.__early_events.setdefault(request_id,
+                                (event["eventKind"], []))[1].append(
+                                        (suspend_policy, event))
+                    continue
+                listeners = list(listeners)
+            for listener in listeners:
+                listener(suspend_policy, event)
+
+    def __freeze(self, value):
+        if isinstance(value, dict):
+            return tuple(sorted(
+                    (k, self.__freeze(v)) for k, v in value.iteritems()))
+        return value
+
+
+class ClassModel(object):
+    """Loaded reference types and the source and line indexes derived from
+    them.
+
+    Metadata is fetched from the jvm by callers without holding any lock and
+    installed here in one step, so the lock is only ever held for in-memory
+    updates and lookups, never across a jdwp round trip.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        self.classes_by_id = {}
+        self.class_ids_by_sig = {}
+        self.source_index = SourceIndex()
+        self.line_index = {}
+        # for the records of classes added here
+        self.interner = Interner()
+
+    def __contains__(self, class_id):
+        return class_id in self.classes_by_id
+
+    def __len__(self):
+        return len(self.classes_by_id)
+
+    def get(self, class_id):
+        return self.classes_by_id.get(class_id)
+
+    def class_ids(self):
+        with self.__lock:
+            return self.classes_by_id.keys()
+
+    def get_by_signature(self, signature):
+        with self.__lock:
+            return self.classes_by_id.get(self.class_ids_by_sig.get(signature))
+
+    def add(self, cls):
+        """Installs cls, replacing any earlier record for the same type"""
+        with self.__lock:
+            self.interner.retain(cls.strings())
+            if cls.type_id in self.classes_by_id:
+                self.__unindex(self.classes_by_id[cls.type_id])
+            self.classes_by_id[cls.type_id] = cls
+            self.class_ids_by_sig[cls.signature] = cls.type_id
+            if cls.source_path is None:
+                return
+            self.source_index.add(cls.source_path, cls.type_id)
+            if cls.source_path not in self.line_index:
+                self.line_index[cls.source_path] = LineIndex()
+            for method in cls.methods:
+                if method.line_table is not None:
+                    self.line_index[cls.source_path].add_line_table(
+                            cls.type_id, method.method_id, method.line_table)
+
+    def remove(self, signature):
+        with self.__lock:
+            if signature not in self.class_ids_by_sig:
+                return
+            class_id = self.class_ids_by_sig.pop(signature)
+            self.__unindex(self.classes_by_id.pop(class_id))
+
+    def clear(self):
+        """Forgets all classes, e.g. on disconnect"""
+        with self.__lock:
+            for class_id in self.classes_by_id.keys():
+                self.__unindex(self.classes_by_id.pop(class_id))
+            self.class_ids_by_sig.clear()
+        self.interner.clear()
+
+    def resolve(self, filename):
+        """See SourceIndex.resolve"""
+        with self.__lock:
+            return self.source_index.resolve(filename)
+
+    def paths(self, filename):
+        """See SourceIndex.paths"""
+        with self.__lock:
+            return self.source_index.paths(filename)
+
+    def breakpoint_locations(self, path, line_number):
+        """Returns the breakpoint locations (see LineIndex) of the first
+        executable line at or after line_number of path; empty if there is
+        no such line among loaded classes"""
+        return self.resolve_line(path, line_number)[1]
+
+    def resolve_line(self, path, line_number):
+        """Returns the first executable line at or after line_number of path
+        and its breakpoint locations; (None, []) if there is none"""
+        with self.__lock:
+            if path not in self.line_index:
+                return None, []
+            line_index = self.line_index[path]
+            resolved_line = line_index.next_line(line_number)
+            if resolved_line is None:
+                return None, []
+            return resolved_line, line_index.breakpoint_locations(
+                    resolved_line)
+
+    def __unindex(self, cls):
+        self.interner.release(cls.strings())
+        if cls.source_path is None:
+            return
+        self.source_index.remove(cls.source_path, cls.type_id)
+        if cls.source_path in self.line_index:
+            self.line_index[cls.source_path].remove_class(cls.type_id)
+
+
+class MetadataPipeline(object):
+    """Fetches the metadata of newly prepared classes on a background thread.
+
+    Classes are queued by ID, so a class queued twice before it is fetched
+    costs one fetch. Each round takes every queued class (up to max_batch),
+    sends the Modifiers, FieldsWithGeneric, MethodsWithGeneric and SourceFile
+    requests of all of them before reading any reply, then does the same for
+    the line tables of their methods. A class is handed to install as soon as
+    its own line tables are in, and then its callbacks run; classes queued
+    with a callback are fetched first.
+    """
+
+    def __init__(self, jdwp, install, interner, max_batch=256):
+        self.__jdwp = jdwp
+        self.__install = install
+        self.__interner = interner
+        self.__max_batch = max_batch
+        self.__cond = threading.Condition(threading.Lock())
+        self.__queue = collections.OrderedDict()
+        self.__in_flight = {}
+        self.__running = False
+        self.__thread = threading.Thread(target=self.__run,
+                name="pyjdb_metadata_pipeline")
+        self.__thread.daemon = True
+        self.__stats = {"batches": 0, "classes": 0, "max_batch": 0}
+
+    def start(self):
+        self.__running = True
+        self.__thread.start()
+
+    def stop(self):
+        with self.__cond:
+            self.__running = False
+            self.__cond.notify_all()
+
+    def enqueue(self, class_entry, callback=None):
+        """Queues a class (a dict with typeID, signature and refTypeTag, as
+        in ClassPrepare events) for fetching. callback, if given, is called
+        without arguments once the class is installed, or has failed to
+        load."""
+        type_id = class_entry["typeID"]
+        with self.__cond:
+            if type_id in self.__in_flight:
+                if callback is not None:
+                    self.__in_flight[type_id].append(callback)
+                return
+            if type_id not in self.__queue:
+                self.__queue[type_id] = (class_entry, [])
+            if callback is not None:
+                self.__queue[type_id][1].append(callback)
+            self.__cond.notify()
+
+    def fetch(self, class_entries):
+        """Fetches and installs class_entries on the calling thread, in
+        batches; returns once all of them are installed"""
+        class_entries = list(class_entries)
+        for i in xrange(0, len(class_entries), self.__max_batch):
+            self.__fetch_batch(class_entries[i : i + self.__max_batch])
+
+    def stats(self):
+        """Returns the number of batches and classes fetched by the pipeline
+        thread, the largest batch and the number of queued classes"""
+        with self.__cond:
+            stats = dict(self.__stats)
+            stats["queued"] = len(self.__queue)
+        return stats
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while self.__running and not self.__queue:
+                    self.__cond.wait()
+                if not self.__running:
+                    return
+                # classes somebody waits for go first
+                type_ids = sorted(self.__queue,
+                        key=lambda type_id: not self.__queue[type_id][1])
+                batch = []
+                for type_id in type_ids[: self.__max_batch]:
+                    class_entry, callbacks = self.__queue.pop(type_id)
+                    self.__in_flight[type_id] = callbacks
+                    batch.append(class_entry)
+                self.__stats["batches"] += 1
+                self.__stats["classes"] += len(batch)
+                self.__stats["max_batch"] = max(
+                        self.__stats["max_batch"], len(batch))
+            try:
+                self.__fetch_batch(batch)
+            except Exception as e:
+                logging.exception("Fetching class metadata failed")
+                for class_entry in batch:
+                    self.__done(class_entry["typeID"])
+
+    def __fetch_batch(self, class_entries):
+        requests = []
+        for class_entry in class_entries:
+            data = {"refType": class_entry["typeID"]}
+            requests.append([self.__jdwp.command_request_async(
+                    "ReferenceType", command_name, data) for command_name in [
+                            "Modifiers", "FieldsWithGeneric",
+                            "MethodsWithGeneric", "SourceFile"]])
+        classes = []
+        for class_entry, replies in zip(class_entries, requests):
+            cls = ClassInfo(class_entry["typeID"], class_entry["signature"],
+                    class_entry["refTypeTag"], self.__interner)
+            modifiers, fields, methods, source_file = get_replies(replies)
+            if None in (modifiers, fields, methods):
+                # unloaded in the meantime
+                self.__done(cls.type_id)
+                continue
+            cls.access_modifier_bits = modifiers["modBits"]
+            cls.fields = tuple(FieldInfo(entry, self.__interner)
+                    for entry in fields["declared"])
+            cls.methods = tuple(MethodInfo(entry, self.__interner)
+                    for entry in methods["declared"])
+            # no source info means e.g. a lambda or other synthetic class
+            if source_file is not None:
+                cls.source_file = self.__interner.string(
+                        source_file["sourceFile"])
+            classes.append(cls)
+        line_tables = []
+        for cls in classes:
+            line_tables.append([self.__jdwp.command_request_async(
+                    "Method", "LineTable", {
+                        "refType": cls.type_id,
+                        "methodID": method.method_id})
+                    for method in cls.methods] if cls.source_file else [])
+        # classes without source info are installed last, once the classes
+        # enclosing them are
+        for cls, replies in sorted(zip(classes, line_tables),
+                key=lambda entry: entry[0].source_file is None):
+            for method, reply in zip(cls.methods, get_replies(replies)):
+                # abstract and native methods have no line table
+                if reply is not None:
+                    method.line_table = self.__interner.line_table(reply)
+            try:
+                self.__install(cls)
+            finally:
+                self.__done(cls.type_id)
+
+    def __done(self, type_id):
+        with self.__cond:
+            callbacks = self.__in_flight.pop(type_id, [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logging.exception("Class metadata callback failed")
+
+
+class Stack(object):
+    """The call stack of a suspended thread, fetched lazily in pages.
+
+    The frame count comes from ThreadReference.FrameCount; frames (dicts with
+    frameID and the fields of its location, top of stack first; see
+    frame_location) are fetched with
+    ThreadReference.Frames a page of page_size frames at a time, only when
+    indexed, so looking at the top few frames of a deep stack costs one small
+    request. Fetched pages are kept until the thread is resumed, when the
+    owning ThreadModel calls invalidate.
+    """
+
+    def __init__(self, jdwp, thread_id, page_size=20):
+        self.__jdwp = jdwp
+        self.__lock = threading.Lock()
+        self.thread_id = thread_id
+        self.page_size = page_size
+        self.__frame_count = None
+        self.__pages = {}
+
+    def __len__(self):
+        with self.__lock:
+            frame_count = self.__frame_count
+        if frame_count is None:
+            frame_count = self.__jdwp.ThreadReference.FrameCount({
+                "thread": self.thread_id})["frameCount"]
+            with self.__lock:
+                self.__frame_count = frame_count
+        return frame_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("frame index out of range")
+        page_index = index // self.page_size
+        self.__fetch_pages([page_index])
+        with self.__lock:
+            return self.__pages[page_index][index % self.page_size]
+
+    def __iter__(self):
+        for index in xrange(len(self)):
+            yield self[index]
+
+    def prefetch(self, depth):
+        """Makes sure the top depth frames are fetched, pipelining the
+        requests for all missing pages"""
+        depth = min(depth, len(self))
+        self.__fetch_pages(xrange((depth + self.page_size - 1) //
+                self.page_size))
+
+    def __fetch_pages(self, page_indexes):
+        frame_count = len(self)
+        with self.__lock:
+            missing = [page_index for page_index in page_indexes
+                    if page_index not in self.__pages]
+        pending = [(page_index, self.__jdwp.command_request_async(
+                "ThreadReference", "Frames", {
+                    "thread": self.thread_id,
+                    "startFrame": page_index * self.page_size,
+                    "length": min(self.page_size,
+                            frame_count - page_index * self.page_size)}))
+                for page_index in missing]
+        for page_index, reply in pending:
+            frames = reply.get()["frames"]
+            with self.__lock:
+                self.__pages[page_index] = frames
+
+    def invalidate(self):
+        with self.__lock:
+            self.__frame_count = None
+            self.__pages.clear()
+
+
+class ThreadModel(object):
+    """Known jvm threads, keyed by thread ID, maintained from thread start and
+    death events rather than by polling.
+
+    Entries are dicts that are replaced, never mutated, so a returned entry
+    is a consistent snapshot. A thread's name and thread group are fetched
+    the first time somebody asks for the thread; its status is marked stale
+    whenever threads may have been suspended or resumed, and is only fetched
+    again when asked for. Fetches for many threads are pipelined, in batches
+    of up to max_batch threads.
+    """
+
+    def __init__(self, jdwp, max_batch=512):
+        self.__jdwp = jdwp
+        self.__max_batch = max_batch
+        self.__lock = threading.Lock()
+        # bumped on every mark_stale; a status fetched across a bump may
+        # already be out of date
+        self.__epoch = 0
+        self.__stacks = {}
+        self.threads = {}
+
+    def __contains__(self, thread_id):
+        return thread_id in self.threads
+
+    def thread_ids(self):
+        with self.__lock:
+            return self.threads.keys()
+
+    def add(self, thread_id):
+        with self.__lock:
+            if thread_id not in self.threads:
+                self.threads[thread_id] = {"stale": True}
+
+    def remove(self, thread_id):
+        with self.__lock:
+            self.threads.pop(thread_id, None)
+            self.__stacks.pop(thread_id, None)
+
+    def stack(self, thread_id):
+        """Returns the lazily fetched Stack of a suspended thread; the same
+        object, with the same cached frames, until the thread is resumed"""
+        with self.__lock:
+            if thread_id not in self.__stacks:
+                self.__stacks[thread_id] = Stack(self.__jdwp, thread_id)
+            return self.__stacks[thread_id]
+
+    def mark_stale(self, thread_id=None):
+        """Marks the status of thread_id, or of all threads, as out of date"""
+        with self.__lock:
+            self.__epoch += 1
+            thread_ids = self.threads.keys() if thread_id is None \
+                    else [thread_id]
+            for thread_id in thread_ids:
+                if thread_id in self.threads:
+                    self.threads[thread_id] = dict(self.threads[thread_id],
+                            stale=True)
+                # frame IDs do not survive a resume
+                stack = self.__stacks.pop(thread_id, None)
+                if stack is not None:
+                    stack.invalidate()
+
+    def get(self, thread_id):
+        """Returns the up to date entry of thread_id (with name,
+        thread_group_id, status and is_suspended), or None if the thread is
+        unknown or dead"""
+        return self.get_all([thread_id]).get(thread_id)
+
+    def get_all(self, thread_ids=None):
+        """Returns up to date entries of thread_ids (default: all threads) by
+        thread ID, fetching whatever is missing or stale in one pipelined
+        burst per batch; dead threads are left out"""
+        if thread_ids is None:
+            thread_ids = self.thread_ids()
+        thread_ids = list(thread_ids)
+        for i in xrange(0, len(thread_ids), self.__max_batch):
+            self.__refresh(thread_ids[i : i + self.__max_batch])
+        with self.__lock:
+            return dict((thread_id, self.threads[thread_id])
+                    for thread_id in thread_ids if thread_id in self.threads)
+
+    def __refresh(self, thread_ids):
+        with self.__lock:
+            epoch = self.__epoch
+            entries = [(thread_id, self.threads[thread_id])
+                    for thread_id in thread_ids if thread_id in self.threads]
+        requests = []
+        for thread_id, entry in entries:
+            data = {"thread": thread_id}
+            command_names = []
+            if "name" not in entry:
+                command_names.extend(["Name", "ThreadGroup"])
+            if entry["stale"]:
+                command_names.append("Status")
+            requests.append((command_names, [
+                    self.__jdwp.command_request_async(
+                        "ThreadReference", command_name, data)
+                    for command_name in command_names]))
+        updates = {}
+        dead = []
+        for (thread_id, entry), (command_names, pending) in zip(
+                entries, requests):
+            replies = get_replies(pending)
+            if None in replies:
+                # the thread died since we last heard of it
+                dead.append(thread_id)
+                continue
+            fields = dict(zip(command_names, replies))
+            updates[thread_id] = fields
+        with self.__lock:
+            for thread_id in dead:
+                self.threads.pop(thread_id, None)
+            for thread_id, fields in updates.iteritems():
+                if thread_id not in self.threads:
+                    continue
+                thread = dict(self.threads[thread_id])
+                if "Name" in fields:
+                    thread["name"] = fields["Name"]["threadName"]
+                    thread["thread_group_id"] = fields["ThreadGroup"]["group"]
+                if "Status" in fields:
+                    thread["status"] = fields["Status"]["threadStatus"]
+                    thread["is_suspended"] = fields["Status"]["suspendStatus"]
+                    # suspended or resumed again while we were asking
+                    thread["stale"] = epoch != self.__epoch
+                self.threads[thread_id] = thread
+
+
+class ValueCache(object):
+    """Values read from the jvm, cached for the current suspension epoch.
+
+    Nothing in the jvm changes while it stays suspended, so instance and
+    static field values, local variable values and array lengths are served
+    from here once read. The owner bumps the epoch (and so empties the cache)
+    whenever threads may run again: on resume, step and method invocation,
+    and on a new suspension. Each read fetches everything it misses in one
+    request. Values are dicts with typeTag and value, as pyjdwp decodes them.
+    """
+
+    def __init__(self, jdwp):
+        self.__jdwp = jdwp
+        self.__lock = threading.Lock()
+        self.__epoch = 0
+        self.__values = {}
+        self.__stats = {"hits": 0, "misses": 0}
+
+    @property
+    def epoch(self):
+        return self.__epoch
+
+    def bump(self):
+        """Starts a new epoch, dropping all cached values"""
+        with self.__lock:
+            self.__epoch += 1
+            self.__values.clear()
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["size"] = len(self.__values)
+        return stats
+
+    def object_values(self, object_id, field_ids):
+        """Returns the values of the given instance fields of an object"""
+        return self.__get("object", object_id, field_ids,
+                lambda missing: [entry["value"] for entry in
+                        self.__jdwp.ObjectReference.GetValues({
+                            "object": object_id,
+                            "fields": [{"fieldID": field_id}
+                                    for field_id in missing]})["values"]])
+
+    def static_values(self, ref_type_id, field_ids):
+        """Returns the values of the given static fields of a type"""
+        return self.__get("static", ref_type_id, field_ids,
+                lambda missing: [entry["value"] for entry in
+                        self.__jdwp.ReferenceType.GetValues({
+                            "refType": ref_type_id,
+                            "fields": [{"fieldID": field_id}
+                                    for field_id in missing]})["values"]])
+
+    def frame_values(self, thread_id, frame_id, slots):
+        """Returns the values of local variables of a frame; slots is a list
+        of (slot, sigbyte) pairs"""
+        return self.__get("frame", (thread_id, frame_id), slots,
+                lambda missing: [entry["slotValue"] for entry in
+                        self.__jdwp.StackFrame.GetValues({
+                            "thread": thread_id,
+                            "frame": frame_id,
+                            "slots": [{"slot": slot, "sigbyte": sigbyte}
+                                    for slot, sigbyte in missing]})["values"]])
+
+    def array_length(self, array_id):
+        return self.__get("array_length", array_id, [None],
+                lambda missing: [self.__jdwp.ArrayReference.Length({
+                    "arrayObject": array_id})["arrayLength"]])[0]
+
+    def __get(self, kind, owner, keys, fetch):
+        with self.__lock:
+            epoch = self.__epoch
+            cached = [self.__values.get((kind, owner, key)) for key in keys]
+        missing = [key for key, value in zip(keys, cached) if value is None]
+        fetched = {}
+        if missing:
+            fetched = dict(zip(missing, fetch(missing)))
+        with self.__lock:
+            self.__stats["hits"] += len(keys) - len(missing)
+            self.__stats["misses"] += len(missing)
+            # a value fetched across an epoch change may already be stale
+            if epoch == self.__epoch:
+                for key, value in fetched.iteritems():
+                    self.__values[(kind, owner, key)] = value
+        return [value if value is not None else fetched[key]
+                for key, value in zip(keys, cached)]
+
+
+class StringCache(object):
+    """Contents of java.lang.String objects, by string object ID.
+
+    Strings are immutable and jdwp never reuses an object ID for another
+    object until the ID is disposed, so an entry stays valid until then (or
+    until the string is found to have been collected). The cache keeps the
+    most recently used strings, up to max_entries strings and max_chars
+    characters in total; misses are fetched with one pipelined batch of
+    StringReference.Value requests.
+    """
+
+    def __init__(self, jdwp, max_entries=10000, max_chars=4 * 1024 * 1024):
+        self.__jdwp = jdwp
+        self.__lock = threading.Lock()
+        self.__max_entries = max_entries
+        self.__max_chars = max_chars
+        self.__chars = 0
+        self.__strings = collections.OrderedDict()
+        self.__stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self.__strings)
+
+    def get(self, string_id):
+        return self.get_all([string_id])[0]
+
+    def get_all(self, string_ids):
+        """Returns the contents of the given strings, in order; None for
+        strings that have been collected"""
+        string_ids = list(string_ids)
+        result = {}
+        with self.__lock:
+            for string_id in string_ids:
+                value = self.__strings.pop(string_id, None)
+                if value is not None:
+                    # re-insert as most recently used
+                    self.__strings[string_id] = value
+                    result[string_id] = value
+            missing = [string_id for string_id in set(string_ids)
+                    if string_id not in result]
+            self.__stats["hits"] += len(string_ids) - len(missing)
+            self.__stats["misses"] += len(missing)
+        replies = self.__jdwp.command_requests("StringReference", "Value",
+                [{"stringObject": string_id} for string_id in missing])
+        with self.__lock:
+            for string_id, reply in zip(missing, replies):
+                if reply is None:
+                    result[string_id] = None
+                    continue
+                value = reply["stringValue"]
+                result[string_id] = value
+                if string_id not in self.__strings:
+                    self.__strings[string_id] = value
+                    self.__chars += len(value)
+            self.__evict()
+        return [result[string_id] for string_id in string_ids]
+
+    def invalidate(self, string_ids):
+        """Drops the given IDs, e.g. because they were disposed"""
+        with self.__lock:
+            for string_id in string_ids:
+                value = self.__strings.pop(string_id, None)
+                if value is not None:
+                    self.__chars -= len(value)
+
+    def stats(self):
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats.update(size=len(self.__strings), chars=self.__chars)
+        return stats
+
+    def __evict(self):
+        while self.__strings and (len(self.__strings) > self.__max_entries or
+                self.__chars > self.__max_chars):
+            _, value = self.__strings.popitem(last=False)
+            self.__chars -= len(value)
+            self.__stats["evictions"] += 1
+
+
+class SymbolTable(object):
+    """Translates code locations into class, method and line, caching what
+    it learns.
+
+    Classes already in the class model are looked up there; the signatures,
+    source files and methods of other classes, and the line tables of their
+    methods, are fetched once, with all the lookups one call needs
+    deduplicated and pipelined.
+    """
+
+    def __init__(self, jdwp, class_model):
+        self.__jdwp = jdwp
+        self.__class_model = class_model
+        self.__lock = threading.Lock()
+        self.__classes = {}
+
+    def remove(self, signature):
+        """Forgets a class, e.g. because it was unloaded"""
+        with self.__lock:
+            for class_id, cls in self.__classes.items():
+                if cls.signature == signature:
+                    del self.__classes[class_id]
+
+    def symbolize(self, locations):
+        """Returns one dict per location (a dict with classID, methodID and
+        index, as in decoded frames) with the class_signature, source_path,
+        method_name, method_signature and line_number of the code there;
+        fields that cannot be determined are None"""
+        locations = list(locations)
+        classes = self.__classes_for(set(
+                location["classID"] for location in locations))
+        self.__fetch_line_tables(classes, set(
+                (location["classID"], location["methodID"])
+                for location in locations))
+        result = []
+        for location in locations:
+            cls = classes.get(location["classID"])
+            method = None
+            if cls is not None:
+                method = self.__method(cls, location["methodID"])
+            line_number = None
+            if method is not None and method.line_table is not None:
+                line_number = method.line_table.line_for_code_index(
+                        location["index"])
+            result.append({
+                    "class_signature": cls and cls.signature,
+                    "source_path": cls and cls.source_path,
+                    "method_name": method and method.name,
+                    "method_signature": method and method.signature,
+                    "line_number": line_number})
+        return result
+
+    def __classes_for(self, class_ids):
+        classes = {}
+        missing = []
+        with self.__lock:
+            for class_id in class_ids:
+                cls = self.__class_model.get(class_id) or \
+                        self.__classes.get(class_id)
+                if cls is None:
+                    missing.append(class_id)
+                else:
+                    classes[class_id] = cls
+        pending = [[self.__jdwp.command_request_async(
+                "ReferenceType", command_name, {"refType": class_id})
+                for command_name in [
+                        "Signature", "MethodsWithGeneric", "SourceFile"]]
+                for class_id in missing]
+        for class_id, replies in zip(missing, pending):
+            signature, methods, source_file = get_replies(replies)
+            if signature is None or methods is None:
+                continue
+            interner = self.__class_model.interner
+            cls = ClassInfo(class_id, signature["signature"], None, interner)
+            cls.methods = tuple(MethodInfo(entry, interner)
+                    for entry in methods["declared"])
+            if source_file is not None:
+                cls.source_file = interner.string(source_file["sourceFile"])
+                cls.source_path = interner.string(
+                        source_path(cls.signature, cls.source_file))
+            classes[class_id] = cls
+            with self.__lock:
+                self.__classes[class_id] = cls
+        return classes
+
+    def __fetch_line_tables(self, classes, method_keys):
+        """Fetches the line tables of the given methods of classes that were
+        not in the class model, if they have not been fetched yet"""
+        methods = []
+        with self.__lock:
+            for class_id, method_id in method_keys:
+                if class_id not in self.__classes:
+                    continue
+                cls = self.__classes[class_id]
+                method = self.__method(cls, method_id)
+                if method is not None and method.line_table is None and \
+                        cls.source_file is not None:
+                    methods.append((class_id, method))
+        pending = [self.__jdwp.command_request_async("Method", "LineTable", {
+                "refType": class_id,
+                "methodID": method.method_id})
+                for class_id, method in methods]
+        for (class_id, method), reply in zip(methods, get_replies(pending)):
+            if reply is not None:
+                method.line_table = self.__class_model.interner.line_table(
+                        reply)
+
+    def __method(self, cls, method_id):
+        for method in cls.methods:
+            if method.method_id == method_id:
+                return method
+        return None
+
+
+class IdSet(object):
+    """A set of nonzero 64 bit IDs (e.g., object IDs), kept in an open
+    addressing hash table over an array of unsigned longs, so that it takes a
+    fraction of the memory of a set of python ints"""
+
+    __slots__ = ["__table", "__mask", "__len"]
+
+    def __init__(self, capacity=1024):
+        size = 16
+        while size < 2 * capacity:
+            size *= 2
+        self.__table = array.array("L", [0]) * size
+        self.__mask = size - 1
+        self.__len = 0
+
+    def __len__(self):
+        return self.__len
+
+    def __iter__(self):
+        return (value for value in self.__table if value)
+
+    def __contains__(self, value):
+        table = self.__table
+        mask = self.__mask
+        slot = (value * 0x9e3779b97f4a7c15 >> 32) & mask
+        while table[slot]:
+            if table[slot] == value:
+                return True
+            slot = (slot + 1) & mask
+        return False
+
+    def add(self, value):
+        """Adds value; returns whether it was not in the set yet"""
+        table = self.__table
+        mask = self.__mask
+        slot = (value * 0x9e3779b97f4a7c15 >> 32) & mask
+        while table[slot]:
+            if table[slot] == value:
+                return False
+            slot = (slot + 1) & mask
+        table[slot] = value
+        self.__len += 1
+        if 2 * self.__len > mask:
+            self.__grow()
+        return True
+
+    def __grow(self):
+        values = [value for value in self.__table if value]
+        self.__table = array.array("L", [0]) * (2 * len(self.__table))
+        self.__mask = len(self.__table) - 1
+        self.__len = 0
+        for value in values:
+            self.add(value)
+
+
+class InstanceFields(object):
+    """The instance fields of reference types, inherited ones included, as
+    (name, field_id) pairs. Declared fields and superclasses are fetched with
+    pipelined requests, a level of the class hierarchy at a time, and cached
+    until clear() (e.g., when classes are unloaded)."""
+
+    def __init__(self, jdwp):
+        self.__jdwp = jdwp
+        self.__lock = threading.Lock()
+        self.__fields = {}
+
+    def clear(self):
+        with self.__lock:
+            self.__fields = {}
+
+    def get(self, type_ids):
+        """Returns a dict from each of type_ids to its instance fields"""
+        type_ids = set(type_ids)
+        with self.__lock:
+            cache = self.__fields
+            result = dict((type_id, cache[type_id]) for type_id in type_ids
+                    if type_id in cache)
+        declared = {}
+        superclasses = {}
+        missing = [type_id for type_id in type_ids if type_id not in result]
+        while missing:
+            replies = get_replies([self.__jdwp.command_request_async(
+                    command_set, command_name, {data_name: type_id})
+                    for type_id in missing
+                    for command_set, command_name, data_name in [
+                        ("ReferenceType", "Fields", "refType"),
+                        ("ClassType", "Superclass", "clazz")]])
+            for i, type_id in enumerate(missing):
+                field_reply, superclass_reply = replies[2 * i : 2 * i + 2]
+                declared[type_id] = [(field["name"], field["fieldID"])
+                        for field in (field_reply or {}).get("declared", [])
+                        if not field["modBits"] &
+                                pyjdwp.ACCESS_MODIFIER_STATIC]
+                superclasses[type_id] = superclass_reply and \
+                        superclass_reply["superclass"]
+            missing = list(set(superclass for superclass in
+                    superclasses.itervalues() if superclass and
+                    superclass not in cache and superclass not in declared))
+
+        def resolve(type_id):
+            if type_id not in result:
+                superclass = superclasses.get(type_id)
+                result[type_id] = cache.get(type_id) or \
+                        declared.get(type_id, []) + (
+                                resolve(superclass) if superclass else [])
+            return result[type_id]
+        for type_id in declared:
+            resolve(type_id)
+        with self.__lock:
+            if cache is self.__fields:
+                cache.update(result)
+        return dict((type_id, result[type_id]) for type_id in type_ids)
+
+
+class HeapWalker(object):
+    """Breadth-first walks of the object graph of a suspended jvm.
+
+    A walk goes a level at a time and keeps up to max_in_flight requests
+    pipelined within a level, and it yields nodes as soon as the replies that
+    reveal them are in. Nodes are (object_id, tag, depth, parent_id, via)
+    tuples, where via is the field name or array index parent_id refers to
+    the object through (None for referrers and roots). Each object is
+    reported once, tracked in an IdSet; walks stop max_depth references away
+    from the roots or after max_nodes nodes.
+    """
+
+    def __init__(self, jdwp, instance_fields, max_in_flight=256,
+            max_array_length=1000):
+        self.__jdwp = jdwp
+        self.__instance_fields = instance_fields
+        self.__max_in_flight = max_in_flight
+        self.__max_array_length = max_array_length
+
+    def instances(self, type_id, max_instances=0):
+        """Returns (object_id, tag) pairs for the instances of a reference
+        type, all of them if max_instances is 0"""
+        return [(entry["instance"]["objectID"], entry["instance"]["typeTag"])
+                for entry in self.__jdwp.ReferenceType.Instances({
+                    "refType": type_id,
+                    "maxInstances": max_instances})["instances"]]
+
+    def referrers(self, roots, max_depth=8, max_nodes=100000,
+            max_referrers=0):
+        """Walks the objects referring to roots, (object_id, tag) pairs, and
+        to their referrers in turn: who retains roots. max_referrers limits
+        the referrers read per object (0 for all)."""
+        def expand(level):
+            requests = (((object_id, depth), "ObjectReference",
+                    "ReferringObjects", {
+                        "object": object_id,
+                        "maxReferrers": max_referrers})
+                    for object_id, _, depth, _, _ in level)
+            for (object_id, depth), reply in self.__pipeline(requests):
+                for entry in reply["referringObjects"] if reply else ():
+                    yield (entry["instance"]["objectID"],
+                            entry["instance"]["typeTag"], depth + 1,
+                            object_id, None)
+        return self.__walk(roots, expand, max_depth, max_nodes)
+
+    def references(self, roots, max_depth=8, max_nodes=100000):
+        """Walks the objects roots, (object_id, tag) pairs, refer to through
+        instance fields and array elements (the first max_array_length of
+        each array), and the objects those refer to in turn: what roots
+        hold. Strings are not expanded."""
+        def expand(level):
+            arrays = [node for node in level if node[1] == "["]
+            objects = [node for node in level if node[1] not in "[s"]
+            requests = [((node, "type"), "ObjectReference", "ReferenceType",
+                    {"object": node[0]}) for node in objects] + \
+                    [((node, "length"), "ArrayReference", "Length",
+                        {"arrayObject": node[0]}) for node in arrays]
+            types = {}
+            lengths = {}
+            for (node, kind), reply in self.__pipeline(requests):
+                if reply is None:
+                    # collected meanwhile
+                    continue
+                if kind == "type":
+                    types[node] = reply["typeID"]
+                else:
+                    lengths[node] = reply["arrayLength"]
+            fields = self.__instance_fields.get(set(types.itervalues()))
+            requests = [(node, "ObjectReference", "GetValues", {
+                    "object": node[0],
+                    "fields": [{"fieldID": field_id}
+                            for _, field_id in fields[types[node]]]})
+                    for node in objects if fields.get(types.get(node))]
+            requests.extend((node, "ArrayReference", "GetValues", {
+                    "arrayObject": node[0],
+                    "firstIndex": 0,
+                    "length": min(lengths[node], self.__max_array_length)})
+                    for node in arrays if lengths.get(node))
+            for node, reply in self.__pipeline(requests):
+                if reply is None:
+                    continue
+                object_id, _, depth, _, _ = node
+                if node in types:
+                    for (name, _), entry in zip(fields[types[node]],
+                            reply["values"]):
+                        value = entry["value"]
+                        if value["typeTag"] in "Lsgtlc[" and value["value"]:
+                            yield (value["value"], value["typeTag"],
+                                    depth + 1, object_id, name)
+                else:
+                    for index, value in enumerate(reply["values"]):
+                        # object elements are (tag, object ID) pairs
+                        if isinstance(value, tuple) and value[1]:
+                            yield (value[1], chr(value[0]), depth + 1,
+                                    object_id, index)
+        return self.__walk(roots, expand, max_depth, max_nodes)
+
+    def __walk(self, roots, expand, max_depth, max_nodes):
+        visited = IdSet()
+        level = []
+        for object_id, tag in roots:
+            if len(visited) < max_nodes and visited.add(object_id):
+                node = (object_id, tag, 0, None, None)
+                level.append(node)
+                yield node
+        for _ in xrange(max_depth):
+            if not level:
+                return
+            next_level = []
+            for node in expand(level):
+                if visited.add(node[0]):
+                    next_level.append(node)
+                    yield node
+                    if len(visited) >= max_nodes:
+                        return
+            level = next_level
+
+    def __pipeline(self, requests):
+        """Sends (key, command set, command, data) requests with up to
+        max_in_flight of them pending, and yields (key, reply) pairs in
+        order, with None replies for failed requests"""
+        in_flight = collections.deque()
+        for key, command_set, command_name, data in requests:
+            in_flight.append((key, self.__jdwp.command_request_async(
+                    command_set, command_name, data)))
+            if len(in_flight) >= self.__max_in_flight:
+                key, pending = in_flight.popleft()
+                yield key, get_replies([pending])[0]
+        while in_flight:
+            key, pending = in_flight.popleft()
+            yield key, get_replies([pending])[0]
+
+
+class HeapHistogram(object):
+    """Samples of the instance counts of loaded reference types.
+
+    By default every type loaded in the jvm, as listed by
+    VirtualMachine.AllClasses, is sampled. A type gets an index the first
+    time it is sampled and keeps it, so every sample is an array of counts in
+    the same type order (shorter for samples taken before later types showed
+    up), and diffing two samples is one pass over two arrays. Counts come
+    from VirtualMachine.InstanceCounts requests for chunk_size types each,
+    all pipelined; a chunk that fails because one of its types was unloaded
+    is retried a type at a time. samples keeps the last max_samples (time,
+    counts) pairs; start() takes one every interval seconds on a background
+    thread.
+    """
+
+    def __init__(self, jdwp, chunk_size=1024, max_samples=100):
+        self.__jdwp = jdwp
+        self.__chunk_size = chunk_size
+        self.__lock = threading.Lock()
+        self.__indexes = {}
+        self.type_ids = array.array("L")
+        self.samples = collections.deque(maxlen=max_samples)
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def sample(self, type_ids=None):
+        """Samples the instance counts of type_ids, or of all loaded types;
+        the counts of other types are 0. Returns the (time, counts) pair
+        added to samples."""
+        if type_ids is None:
+            # the class model lacks classes loaded before their prepare
+            # events were requested, so ask the jvm
+            type_ids = [entry["typeID"] for entry in
+                    self.__jdwp.VirtualMachine.AllClasses()["classes"]]
+        type_ids = list(type_ids)
+        chunks = [type_ids[i : i + self.__chunk_size]
+                for i in xrange(0, len(type_ids), self.__chunk_size)]
+        replies = self.__instance_counts(chunks)
+        retried = [[type_id] for chunk, reply in zip(chunks, replies)
+                if reply is None and len(chunk) > 1 for type_id in chunk]
+        chunks.extend(retried)
+        replies.extend(self.__instance_counts(retried))
+        sample_time = time.time()
+        with self.__lock:
+            for type_id in type_ids:
+                if type_id not in self.__indexes:
+                    self.__indexes[type_id] = len(self.type_ids)
+                    self.type_ids.append(type_id)
+            counts = array.array("l", [0]) * len(self.type_ids)
+            for chunk, reply in zip(chunks, replies):
+                if reply is None:
+                    continue
+                for type_id, entry in zip(chunk, reply["counts"]):
+                    counts[self.__indexes[type_id]] = entry["instanceCount"]
+        sample = (sample_time, counts)
+        self.samples.append(sample)
+        return sample
+
+    def diff(self, old, new):
+        """Returns the count changes from the counts of sample old to those
+        of sample new"""
+        delta = array.array("l", new)
+        for index, count in enumerate(old):
+            delta[index] -= count
+        return delta
+
+    def top(self, counts, n=20):
+        """Returns the (type_id, count) pairs of the n largest counts, e.g.,
+        of a diff"""
+        return [(self.type_ids[index], count) for index, count in
+                heapq.nlargest(n, enumerate(counts), key=lambda entry:
+                        entry[1])]
+
+    def start(self, interval=10.0):
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(interval,),
+                name="pyjdb_heap_histogram")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self, interval):
+        while not self.__stopped.wait(interval):
+            try:
+                self.sample()
+            except pyjdwp.Error:
+                logging.exception("Heap histogram sample failed")
+
+    def __instance_counts(self, chunks):
+        return get_replies([self.__jdwp.command_request_async(
+                "VirtualMachine", "InstanceCounts", {"refTypesCount": [
+                    {"refType": type_id} for type_id in chunk]})
+                for chunk in chunks])
+
+
+class Profiler(object):
+    """A sampling cpu profiler.
+
+    Each sample suspends the jvm (or only the threads given to sample() or
+    start()), sends ThreadReference.Status and FrameCount for every sampled
+    thread in one pipelined burst, then Frames for the top max_frames frames
+    (or all, if negative) of every RUNNING thread in a second one, and
+    resumes as soon as the replies are in. Stacks are decoded after
+    resuming, and their locations symbolized once each through the
+    SymbolTable. Stacks are counted by their (class_id,
+    method_id, line_number) frames, root first; folded() and call_tree()
+    aggregate them.
+
+    A sample takes at most threads_per_sample threads, round robin. When a
+    sample holds the jvm for longer than max_pause seconds, that budget is
+    halved, and it grows back by one thread per sample while pauses stay
+    under it, so pauses stay close to max_pause however many threads there
+    are.
+    """
+
+    def __init__(self, jdwp, thread_model, symbol_table, values,
+            max_frames=32, max_pause=0.005, threads_per_sample=256):
+        self.__jdwp = jdwp
+        self.__thread_model = thread_model
+        self.__symbol_table = symbol_table
+        self.__values = values
+        self.__max_frames = max_frames
+        self.__max_pause = max_pause
+        self.__lock = threading.Lock()
+        self.__max_threads_per_sample = threads_per_sample
+        self.__threads_per_sample = threads_per_sample
+        self.__next_thread = 0
+        self.__labels = {}
+        self.__lines = {}
+        self.__stacks = collections.defaultdict(int)
+        self.__stats = {"samples": 0, "stacks": 0, "pause_total": 0.0,
+                "pause_max": 0.0, "over_budget": 0}
+        self.__stopped = threading.Event()
+
+    def sample(self, thread_ids=None):
+        """Takes a sample of thread_ids, or of all threads; returns how long
+        the sampled threads were suspended, in seconds"""
+        suspend_all = thread_ids is None
+        if suspend_all:
+            thread_ids = self.__thread_model.thread_ids()
+        with self.__lock:
+            count = min(self.__threads_per_sample, len(thread_ids))
+            start_index = self.__next_thread % max(len(thread_ids), 1)
+            self.__next_thread = start_index + count
+        thread_ids = (thread_ids[start_index:] + thread_ids[:start_index])[
+                :count]
+        start = time.time()
+        if suspend_all:
+            self.__jdwp.VirtualMachine.Suspend()
+        else:
+            get_replies([self.__jdwp.command_request_async(
+                    "ThreadReference", "Suspend", {"thread": thread_id})
+                    for thread_id in thread_ids])
+        try:
+            pending = []
+            for thread_id in thread_ids:
+                pending.append(self.__jdwp.command_request_async(
+                        "ThreadReference", "Status", {"thread": thread_id}))
+                pending.append(self.__jdwp.command_request_async(
+                        "ThreadReference", "FrameCount",
+                        {"thread": thread_id}))
+            replies = get_replies(pending)
+            pending = []
+            for thread_id, status, frame_count in zip(thread_ids,
+                    replies[::2], replies[1::2]):
+                if status is None or frame_count is None or \
+                        status["threadStatus"] != \
+                        self.__jdwp.ThreadStatus.RUNNING:
+                    continue
+                # Frames fails with INVALID_LENGTH for more frames than
+                # there are
+                length = frame_count["frameCount"]
+                if self.__max_frames >= 0:
+                    length = min(length, self.__max_frames)
+                if length:
+                    pending.append(self.__jdwp.command_request_async(
+                            "ThreadReference", "Frames", {
+                                "thread": thread_id,
+                                "startFrame": 0,
+                                "length": length}))
+            for reply in pending:
+                try:
+                    reply.wait()
+                except pyjdwp.Timeout:
+                    raise
+                except pyjdwp.Error:
+                    pass
+        finally:
+            if suspend_all:
+                self.__jdwp.VirtualMachine.Resume()
+            else:
+                get_replies([self.__jdwp.command_request_async(
+                        "ThreadReference", "Resume", {"thread": thread_id})
+                        for thread_id in thread_ids])
+            pause_time = time.time() - start
+            self.__values.bump()
+            self.__thread_model.mark_stale()
+        stacks = []
+        for frames in get_replies(pending):
+            if frames is None:
+                continue
+            stacks.append(tuple((frame["classID"], frame["methodID"],
+                    frame["index"]) for frame in reversed(frames["frames"])))
+        self.__add(stacks, pause_time)
+        return pause_time
+
+    def start(self, interval=0.01, thread_ids=None):
+        """Takes a sample every interval seconds on a background thread"""
+        self.__stopped.clear()
+        thread = threading.Thread(target=self.__run,
+                args=(interval, thread_ids), name="pyjdb_profiler")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def clear(self):
+        with self.__lock:
+            self.__stacks.clear()
+
+    def stats(self):
+        """Returns sample and pause time counters, and the current thread
+        budget of a sample"""
+        with self.__lock:
+            stats = dict(self.__stats)
+            stats["threads_per_sample"] = self.__threads_per_sample
+        stats["pause_mean"] = stats["pause_total"] / stats["samples"] \
+                if stats["samples"] else 0.0
+        return stats
+
+    def folded(self):
+        """Returns the sampled stacks in the folded format of flame graph
+        tools: one "root;...;leaf count" line per distinct stack"""
+        with self.__lock:
+            stacks = self.__stacks.items()
+        return ["%s %d" % (";".join(self.__labels[frame] for frame in stack),
+                count) for stack, count in sorted(stacks)]
+
+    def call_tree(self):
+        """Returns the sampled stacks as a tree of dicts with name, count
+        (samples in the frame or its callees), self_count and children (by
+        name)"""
+        with self.__lock:
+            stacks = self.__stacks.items()
+        root = {"name": "all", "count": 0, "self_count": 0, "children": {}}
+        for stack, count in stacks:
+            node = root
+            node["count"] += count
+            for frame in stack:
+                name = self.__labels[frame]
+                node = node["children"].setdefault(name, {"name": name,
+                        "count": 0, "self_count": 0, "children": {}})
+                node["count"] += count
+            node["self_count"] += count
+        return root
+
+    def __add(self, stacks, pause_time):
+        # symbolize locations never seen before; stacks are counted by line
+        # rather than code index
+        locations = set(location for stack in stacks for location in stack
+                if location not in self.__lines)
+        if locations:
+            locations = list(locations)
+            symbols = self.__symbol_table.symbolize({"classID": class_id,
+                    "methodID": method_id, "index": code_index}
+                    for class_id, method_id, code_index in locations)
+            for location, symbol in zip(locations, symbols):
+                frame = location[:2] + (symbol["line_number"],)
+                self.__lines[location] = frame
+                self.__labels[frame] = "%s.%s:%s" % (
+                        (symbol["class_signature"] or "?")[1 : -1].replace(
+                                "/", "."),
+                        symbol["method_name"] or "?",
+                        symbol["line_number"] or "?")
+        with self.__lock:
+            for stack in stacks:
+                self.__stacks[tuple(self.__lines[location]
+                        for location in stack)] += 1
+            self.__stats["samples"] += 1
+            self.__stats["stacks"] += len(stacks)
+            self.__stats["pause_total"] += pause_time
+            self.__stats["pause_max"] = max(self.__stats["pause_max"],
+                    pause_time)
+            if pause_time > self.__max_pause:
+                self.__stats["over_budget"] += 1
+                self.__threads_per_sample = max(1,
+                        self.__threads_per_sample // 2)
+            else:
+                self.__threads_per_sample = min(
+                        self.__max_threads_per_sample,
+                        self.__threads_per_sample + 1)
+
+    def __run(self, interval, thread_ids):
+        while not self.__stopped.wait(interval):
+            try:
+                self.sample(thread_ids)
+            except pyjdwp.Error:
+                logging.exception("Profiler sample failed")
+
+
+class CallRing(object):
+    """A fixed-size ring buffer of method entry and exit records. Records
+    live in preallocated parallel arrays, so adding one allocates nothing;
+    once the ring is full, the oldest records are overwritten."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.__times = array.array("d", [0.0]) * capacity
+        self.__thread_ids = array.array("L", [0]) * capacity
+        self.__class_ids = array.array("L", [0]) * capacity
+        self.__method_ids = array.array("L", [0]) * capacity
+        self.__exits = array.array("b", [0]) * capacity
+        # records ever added
+        self.__count = 0
+
+    def __len__(self):
+        return min(self.__count, self.capacity)
+
+    def overwritten(self):
+        return max(0, self.__count - self.capacity)
+
+    def add(self, timestamp, thread_id, class_id, method_id, is_exit):
+        index = self.__count % self.capacity
+        self.__times[index] = timestamp
+        self.__thread_ids[index] = thread_id
+        self.__class_ids[index] = class_id
+        self.__method_ids[index] = method_id
+        self.__exits[index] = is_exit
+        self.__count += 1
+
+    def records(self):
+        """Returns (time, thread_id, class_id, method_id, is_exit) tuples,
+        oldest first"""
+        records = []
+        for count in xrange(self.overwritten(), self.__count):
+            index = count % self.capacity
+            records.append((self.__times[index], self.__thread_ids[index],
+                    self.__class_ids[index], self.__method_ids[index],
+                    bool(self.__exits[index])))
+        return records
+
+    def clear(self):
+        self.__count = 0
+
+
+class MethodTracer(object):
+    """Traces method entries and exits, with per-method call counts and
+    inclusive latencies.
+
+    METHOD_ENTRY and METHOD_EXIT requests are filtered in the target jvm by
+    thread and class name patterns and suspend nothing. Their events bypass
+    the regular event path: they reach the tracer undecoded (see
+    Jdwp.register_raw_event_callback), which unpacks the fixed-size event
+    with a single struct and records it in a CallRing. Each exit is matched
+    with the innermost open entry of the same method in its thread; the
+    time between them, as seen by the debugger, is that call's latency.
+    Return values (METHOD_EXIT_WITH_RETURN_VALUE) are not traced, as
+    decoding them would take the slow path.
+    """
+
+    def __init__(self, jdwp, subscriptions, symbol_table, capacity=65536):
+        self.__jdwp = jdwp
+        self.__subscriptions = subscriptions
+        self.__symbol_table = symbol_table
+        self.__lock = threading.Lock()
+        self.__ring = CallRing(capacity)
+        self.__request_ids = []
+        self.__event_struct = None
+        self.__entry_kind = None
+        # thread ID -> [(class_id, method_id, entry time)], innermost last
+        self.__open_calls = {}
+        # (class_id, method_id) -> [calls, total time, max time]
+        self.__methods = {}
+        self.__unmatched = 0
+
+    def start(self, class_match=None, class_exclude=(), thread_id=None):
+        """Traces methods of classes matching class_match and none of
+        class_exclude (class name patterns, e.g. "com.foo.*") in thread_id,
+        or in all threads"""
+        self.stop()
+        if self.__event_struct is None:
+            spec = self.__jdwp.jdwp_spec
+            formats = pyjdwp.STRUCT_FMTS_BY_SIZE_UNSIGNED
+            # kind, request ID, thread and location
+            self.__event_struct = struct.Struct(">BI%sB%s%sQ" % (
+                    formats[spec.lookup_id_size("objectID")],
+                    formats[spec.lookup_id_size("referenceTypeID")],
+                    formats[spec.lookup_id_size("methodID")]))
+            self.__entry_kind = self.__jdwp.EventKind.METHOD_ENTRY
+        modifiers = []
+        if thread_id is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_THREAD_ONLY,
+                    "thread": thread_id})
+        if class_match is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_MATCH,
+                    "classPattern": class_match})
+        for pattern in class_exclude:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": pattern})
+        for event_kind in [self.__jdwp.EventKind.METHOD_ENTRY,
+                self.__jdwp.EventKind.METHOD_EXIT]:
+            # registered as soon as the request ID is known, not once
+            # subscribe returns
+            request_id = self.__subscriptions.subscribe(event_kind, modifiers,
+                    self.__jdwp.SuspendPolicy.NONE, on_set=lambda request_id:
+                            self.__jdwp.register_raw_event_callback(
+                                    self.handle_raw_event, request_id))
+            self.__request_ids.append(request_id)
+
+    def stop(self):
+        """Stops tracing; what was traced so far is kept"""
+        request_ids, self.__request_ids = self.__request_ids, []
+        for request_id in request_ids:
+            self.__jdwp.unregister_raw_event_callback(request_id)
+            self.__subscriptions.unsubscribe(request_id)
+
+    def clear(self):
+        with self.__lock:
+            self.__ring.clear()
+            self.__open_calls.clear()
+            self.__methods.clear()
+            self.__unmatched = 0
+
+    def handle_raw_event(self, payload, offset, received):
+        event_kind, _, thread_id, _, class_id, method_id, _ = \
+                self.__event_struct.unpack_from(payload, offset)
+        is_exit = event_kind != self.__entry_kind
+        with self.__lock:
+            self.__ring.add(received, thread_id, class_id, method_id, is_exit)
+            calls = self.__open_calls.get(thread_id)
+            if not is_exit:
+                if calls is None:
+                    calls = self.__open_calls[thread_id] = []
+                calls.append((class_id, method_id, received))
+                return
+            # normally the innermost call; calls above it lost their exits,
+            # e.g. to a full event queue, and are dropped
+            index = len(calls) - 1 if calls else -1
+            while index >= 0 and (calls[index][0] != class_id or
+                    calls[index][1] != method_id):
+                index -= 1
+            if index < 0:
+                self.__unmatched += 1
+                return
+            self.__unmatched += len(calls) - 1 - index
+            elapsed = received - calls[index][2]
+            del calls[index:]
+            method = self.__methods.get((class_id, method_id))
+            if method is None:
+                self.__methods[(class_id, method_id)] = [1, elapsed, elapsed]
+            else:
+                method[0] += 1
+                method[1] += elapsed
+                if elapsed > method[2]:
+                    method[2] = elapsed
+
+    def records(self):
+        """Returns the traced entries and exits still in the ring; see
+        CallRing.records"""
+        with self.__lock:
+            return self.__ring.records()
+
+    def method_stats(self, n=None):
+        """Returns dicts with class_id, method_id, name, calls and the
+        total, mean and max inclusive time in seconds of the n methods with
+        the most time in them, or of all methods"""
+        with self.__lock:
+            methods = sorted(self.__methods.iteritems(),
+                    key=lambda (key, method): -method[1])[:n]
+        symbols = self.__symbol_table.symbolize({"classID": class_id,
+                "methodID": method_id, "index": 0}
+                for (class_id, method_id), _ in methods)
+        result = []
+        for ((class_id, method_id), (calls, total, max_time)), symbol in zip(
+                methods, symbols):
+            result.append({
+                    "class_id": class_id,
+                    "method_id": method_id,
+                    "name": "%s.%s" % (
+                            (symbol["class_signature"] or "?")[1 : -1].replace(
+                                    "/", "."),
+                            symbol["method_name"] or "?"),
+                    "calls": calls,
+                    "total": total,
+                    "mean": total / calls,
+                    "max": max_time})
+        return result
+
+    def stats(self):
+        """Returns how many entries and exits were traced, how many of them
+        were overwritten in the ring, how many exits or entries could not be
+        matched up, and how many calls are still open"""
+        with self.__lock:
+            return {
+                    "events": len(self.__ring) + self.__ring.overwritten(),
+                    "overwritten": self.__ring.overwritten(),
+                    "unmatched": self.__unmatched,
+                    "open_calls": sum(len(calls)
+                            for calls in self.__open_calls.itervalues()),
+                    "tracing": bool(self.__request_ids)}
+
+
+class BreakpointCondition(object):
+    """When a breakpoint stops.
+
+    thread_id, instance_id (the "this" object), class_match and
+    class_exclude (class name patterns, e.g. "com.foo.*") and hit_count are
+    compiled into jdwp modifiers, so the target jvm filters hits on them
+    without suspending anything. hit_count is applied last, so it counts
+    only hits passing the other filters; the request stops at the
+    hit_count-th such hit and expires.
+
+    predicate is the residual condition, evaluated here: it is called with
+    a dict from each of local_names visible at the breakpoint location to
+    its value (the contents for strings, object IDs for other objects), read
+    in a single request. A breakpoint with a predicate only suspends the
+    thread that hit it, and resumes it right away if predicate returns
+    False or raises (e.g., a KeyError for a local not in scope at the
+    location); otherwise all threads are suspended, or only that one if
+    suspend_all is False.
+    """
+
+    def __init__(self, hit_count=None, thread_id=None, instance_id=None,
+            class_match=None, class_exclude=None, predicate=None,
+            local_names=(), suspend_all=True):
+        self.hit_count = hit_count
+        self.thread_id = thread_id
+        self.instance_id = instance_id
+        self.class_match = class_match
+        self.class_exclude = class_exclude
+        self.predicate = predicate
+        self.local_names = frozenset(local_names)
+        self.suspend_all = suspend_all
+
+    def holds(self, local_values):
+        """Returns whether predicate holds for local_values; errors count as
+        not holding"""
+        if self.predicate is None:
+            return True
+        try:
+            return bool(self.predicate(local_values))
+        except Exception:
+            logging.debug("Breakpoint predicate failed", exc_info=True)
+            return False
+
+    def modifiers(self):
+        """Returns the jdwp modifiers to follow a LocationOnly modifier"""
+        modifiers = []
+        if self.thread_id is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_THREAD_ONLY,
+                    "thread": self.thread_id})
+        if self.instance_id is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_INSTANCE_ONLY,
+                    "instance": self.instance_id})
+        if self.class_match is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_MATCH,
+                    "classPattern": self.class_match})
+        if self.class_exclude is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": self.class_exclude})
+        if self.hit_count is not None:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_COUNT,
+                    "count": self.hit_count})
+        return modifiers
+
+
+class Breakpoint(object):
+    """Handle to a line breakpoint. path and line are the source path and
+    executable line the requested filename and line_number resolved to, and
+    locations and request_ids the breakpoint locations (see LineIndex) and
+    the jdwp requests set for them; all stay empty while the breakpoint is
+    deferred. condition is a BreakpointCondition or None, and listener, if
+    given, is called with the breakpoint and the event on every hit that
+    passes the condition; hits counts those."""
+
+    def __init__(self, filename, line_number, condition=None, listener=None):
+        self.filename = filename
+        self.line_number = line_number
+        self.condition = condition
+        self.listener = listener
+        self.path = None
+        self.line = None
+        self.locations = []
+        self.request_ids = []
+        self.hits = 0
+        # location -> [(name, slot, sigbyte)] of the locals the condition's
+        # predicate reads there
+        self.local_slots = {}
+
+    def __repr__(self):
+        return "Breakpoint(%s:%d, request_ids=%s)" % (
+                self.filename, self.line_number, self.request_ids)
+
+
+class Tracepoint(Breakpoint):
+    """A breakpoint that records values and lets the thread go on.
+
+    A hit suspends only the thread that hit the tracepoint, for as long as it
+    takes to read local_names in one StackFrame.GetValues (along with
+    StackFrame.ThisObject) and the field_names declared by the class of the
+    location from "this" in one ObjectReference.GetValues; that thread alone
+    is then resumed. If condition has a predicate, it sees the captured
+    locals, and hits failing it are not recorded.
+
+    Each record is a dict with time, thread_id, location (a (class_id,
+    method_id, code_index) tuple), this (an object ID, or None), locals and
+    fields; strings are replaced by their contents once the thread runs
+    again. records keeps the last max_records. At most max_rate hits per
+    second are captured; the others resume the thread without reading
+    anything and are counted in dropped. pause_times keeps how long each of
+    the last max_records hits held the thread, in seconds, from the arrival
+    of the event until ThreadReference.Resume returned.
+    """
+
+    def __init__(self, filename, line_number, local_names=(),
+            field_names=(), max_records=1000, max_rate=None, condition=None,
+            listener=None):
+        Breakpoint.__init__(self, filename, line_number, condition, listener)
+        self.local_names = frozenset(local_names)
+        self.field_names = frozenset(field_names)
+        self.max_rate = max_rate
+        self.records = collections.deque(maxlen=max_records)
+        self.pause_times = collections.deque(maxlen=max_records)
+        self.dropped = 0
+        # location -> [(name, field_id)] of field_names
+        self.fields = {}
+        self.__lock = threading.Lock()
+        self.__allowance = max_rate
+        self.__last_hit = time.time()
+
+    def allow(self):
+        """Returns whether a hit may be captured now, refilling a bucket of
+        max_rate captures at max_rate per second"""
+        if self.max_rate is None:
+            return True
+        with self.__lock:
+            now = time.time()
+            self.__allowance = min(self.max_rate, self.__allowance +
+                    (now - self.__last_hit) * self.max_rate)
+            self.__last_hit = now
+            if self.__allowance < 1:
+                self.dropped += 1
+                return False
+            self.__allowance -= 1
+            return True
+
+    def pause_stats(self):
+        """Returns the number, mean and maximum of the recent pause_times"""
+        pause_times = list(self.pause_times)
+        return {
+                "count": len(pause_times),
+                "mean": sum(pause_times) / len(pause_times)
+                        if pause_times else 0.0,
+                "max": max(pause_times) if pause_times else 0.0}
+
+
+class BreakpointRegistry(object):
+    """Set breakpoints, indexed by jdwp request ID and by location, so that
+    resolving a breakpoint event to its Breakpoint and source line takes a
+    dict lookup. Lookups take no lock; only changes do.
+
+    A breakpoint's locations are registered before its EventRequest.Set
+    requests are sent and its request IDs as the replies come in, and both
+    stay until its EventRequest.Clear replies are in. Hits may still be
+    reported before the ID of their request is known, so events of unknown
+    requests are held back while any Set is in flight, to be handled again
+    once all are done."""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.by_request_id = {}
+        self.by_location = {}
+        self.source_lines = {}
+        self.__sets = 0
+        self.__early_events = []
+
+    def __len__(self):
+        return len(self.by_request_id)
+
+    def begin_set(self, breakpoints):
+        """Registers the locations of breakpoints, whose requests are about
+        to be set; every call must be followed by one to end_set"""
+        with self.__lock:
+            self.__sets += 1
+            for breakpoint in breakpoints:
+                for location in breakpoint.locations:
+                    self.by_location[location] = \
+                            self.by_location.get(location, ()) + (breakpoint,)
+                    self.source_lines[location] = (breakpoint.path,
+                            breakpoint.line)
+
+    def add(self, breakpoint, request_id):
+        """Registers a request set for one of breakpoint's locations"""
+        with self.__lock:
+            self.by_request_id[request_id] = breakpoint
+
+    def end_set(self):
+        """Returns the composite events held back by hold_early, once no Set
+        is in flight anymore"""
+        with self.__lock:
+            self.__sets -= 1
+            if self.__sets:
+                return []
+            early_events = self.__early_events
+            self.__early_events = []
+            return early_events
+
+    def setting(self):
+        """Returns whether any breakpoint request is being set"""
+        return self.__sets > 0
+
+    def hold_early(self, event_list):
+        """Holds back a composite event with a breakpoint event of a request
+        not known yet, if a Set is in flight; returns whether it did"""
+        with self.__lock:
+            if not self.__sets or all(
+                    event["Breakpoint"]["requestID"] in self.by_request_id
+                    for event in event_list["events"]
+                    if "Breakpoint" in event):
+                return False
+            self.__early_events.append(event_list)
+            return True
+
+    def remove(self, breakpoint):
+        with self.__lock:
+            for request_id in breakpoint.request_ids:
+                self.by_request_id.pop(request_id, None)
+            for location in breakpoint.locations:
+                remaining = tuple(other for other in
+                        self.by_location.get(location, ())
+                        if other is not breakpoint)
+                if remaining:
+                    self.by_location[location] = remaining
+                else:
+                    self.by_location.pop(location, None)
+                    self.source_lines.pop(location, None)
+
+    def lookup(self, request_id):
+        """Returns the Breakpoint whose request has request_id, or None"""
+        return self.by_request_id.get(request_id)
+
+    def at_location(self, class_id, method_id, code_index):
+        """Returns the Breakpoints set at a location"""
+        return self.by_location.get((class_id, method_id, code_index), ())
+
+    def source_line(self, class_id, method_id, code_index):
+        """Returns the (path, line) of a breakpoint location, or None"""
+        return self.source_lines.get((class_id, method_id, code_index))
+
+    def for_event(self, event):
+        """Returns the Breakpoint a decoded BREAKPOINT event was reported
+        for, or None"""
+        return self.by_request_id.get(event["Breakpoint"]["requestID"])
+
+
 class Pyjdb(object):
 
     def __init__(self, host="localhost", port=5005, sourcepath="."):
-        self.__debug_state_lock = threading.Condition()
         self.jdwp = pyjdwp.Jdwp(host, port)
+        self.subscriptions = EventSubscriptions(self.jdwp)
         self.sourcepath = sourcepath
         self.class_blacklist = ["Lsun/misc/PostVMInitHook;"]
-        self.classes_by_id = {}
-        self.class_ids_by_sig = {}
-        self.threads = {}
-        self.line_index = {}
-        self.class_prepare_listeners = []
+        # the class model, thread model and breakpoints are locked
+        # independently, and none of their locks is held across a request to
+        # the jvm, so event handling never blocks queries for long
+        self.class_model = ClassModel()
+        self.classes_by_id = self.class_model.classes_by_id
+        self.class_ids_by_sig = self.class_model.class_ids_by_sig
+        self.source_index = self.class_model.source_index
+        self.line_index = self.class_model.line_index
+        self.thread_model = ThreadModel(self.jdwp)
+        # raw, possibly stale entries; use self.thread_model.get_all() for
+        # up to date ones
+        self.threads = self.thread_model.threads
+        self.metadata_pipeline = MetadataPipeline(self.jdwp,
+                self.__install_class, self.class_model.interner)
+        self.symbol_table = SymbolTable(self.jdwp, self.class_model)
+        self.values = ValueCache(self.jdwp)
+        self.strings = StringCache(self.jdwp)
+        self.instance_fields = InstanceFields(self.jdwp)
+        self.heap = HeapWalker(self.jdwp, self.instance_fields)
+        self.heap_histogram = HeapHistogram(self.jdwp)
+        self.profiler = Profiler(self.jdwp, self.thread_model,
+                self.symbol_table, self.values)
+        self.method_tracer = MethodTracer(self.jdwp, self.subscriptions,
+                self.symbol_table)
+        self.__breakpoint_lock = threading.Lock()
+        self.pending_breakpoints = {}
+        self.pending_breakpoint_files_by_request_id = {}
+        self.breakpoints = BreakpointRegistry()
+        self.__step_lock = threading.Lock()
+        # per thread, the request of its last step, cleared with the next
+        self.__step_request_ids = {}
+        # per stepping thread, an Event set once the step event is in
+        self.__step_waiters = {}
 
     def initialize(self):
         try:
             self.jdwp.initialize()
         except pyjdwp.Error as e:
             raise e
-        self.jdwp.register_event_callback(self.handle_event)
+        self.metadata_pipeline.start()
+        for event_kind in [self.jdwp.EventKind.CLASS_PREPARE,
+                self.jdwp.EventKind.CLASS_UNLOAD,
+                self.jdwp.EventKind.THREAD_START,
+                self.jdwp.EventKind.THREAD_DEATH,
+                # events that may have suspended threads
+                self.jdwp.EventKind.BREAKPOINT,
+                self.jdwp.EventKind.SINGLE_STEP,
+                self.jdwp.EventKind.EXCEPTION]:
+            self.jdwp.register_event_callback(self.handle_event, event_kind)
         # load up runtime metadata like known classes and running threads
         self.__initialize_event_subscriptions()
         self.__initialize_jvm_state()
 
-    def resume(self):
-        with self.__debug_state_lock:
+    def stack(self, thread_id):
+        """Returns the call stack of a suspended thread; see Stack"""
+        return self.thread_model.stack(thread_id)
+
+    def thread_dump(self, max_frames=-1):
+        """Returns a jstack-like dump of all threads, taken while the jvm is
+        suspended once.
+
+        All per-thread requests (Name, ThreadGroup, Status, Frames,
+        OwnedMonitors and CurrentContendedMonitor) are pipelined; if
+        max_frames is not negative, FrameCount is sent in place of Frames, and
+        Frames for at most max_frames frames follow in a second burst. The jvm
+        is resumed as soon as the replies are in; replies are decoded, frames
+        symbolized and thread group names looked up afterwards, since
+        the IDs involved stay valid. The result is a dict with the time the
+        jvm was suspended for ("pause_time", in seconds) and "threads", a
+        list of dicts with thread_id, name, thread_group, status, frames (see
+        SymbolTable.symbolize; each frame also has its location),
+        owned_monitors (object IDs) and contended_monitor (an object ID or
+        None). Threads that die meanwhile are left out; monitor information
+        is empty if the jvm cannot provide it.
+        """
+        command_names = ["Name", "ThreadGroup", "Status", "Frames",
+                "OwnedMonitors", "CurrentContendedMonitor"]
+        start = time.time()
+        self.jdwp.VirtualMachine.Suspend()
+        try:
+            thread_ids = [entry["thread"] for entry in
+                    self.jdwp.VirtualMachine.AllThreads()["threads"]]
+            pending = []
+            for thread_id in thread_ids:
+                for command_name in command_names:
+                    data = {"thread": thread_id}
+                    if command_name == "Frames":
+                        if max_frames >= 0:
+                            # Frames fails with INVALID_LENGTH for more
+                            # frames than there are, so count them first
+                            command_name = "FrameCount"
+                        else:
+                            data.update(startFrame=0, length=-1)
+                    pending.append(self.jdwp.command_request_async(
+                            "ThreadReference", command_name, data))
+            if max_frames >= 0:
+                frames_index = command_names.index("Frames")
+                frame_counts = get_replies(
+                        pending[frames_index::len(command_names)])
+                for i, frame_count in enumerate(frame_counts):
+                    if frame_count is not None:
+                        frame_count = self.jdwp.command_request_async(
+                                "ThreadReference", "Frames", {
+                                    "thread": thread_ids[i],
+                                    "startFrame": 0,
+                                    "length": min(max_frames,
+                                            frame_count["frameCount"])})
+                    pending[i * len(command_names) + frames_index] = \
+                            frame_count
+            # wait for the replies, but decode them after resuming
+            for reply in pending:
+                if reply is None:
+                    continue
+                try:
+                    reply.wait()
+                except pyjdwp.Timeout:
+                    raise
+                except pyjdwp.Error as e:
+                    pass
+        finally:
             self.jdwp.VirtualMachine.Resume()
-            for thread_id in self.threads.keys():
-                self.__update_thread_status(thread_id)
+        pause_time = time.time() - start
+        replies = get_replies(pending)
+        self.thread_model.mark_stale()
+        threads = []
+        for i, thread_id in enumerate(thread_ids):
+            name, group, status, frames, owned, contended = replies[
+                    i * len(command_names) : (i + 1) * len(command_names)]
+            if None in (name, group, status, frames):
+                # died before we suspended it
+                continue
+            threads.append({
+                    "thread_id": thread_id,
+                    "name": name["threadName"],
+                    "thread_group": group["group"],
+                    "status": status["threadStatus"],
+                    "frames": [frame_location(frame)
+                            for frame in frames["frames"]],
+                    "owned_monitors": [monitor["monitor"]["objectID"]
+                            for monitor in owned["owned"]] if owned else [],
+                    "contended_monitor": contended["monitor"]["objectID"]
+                            or None if contended else None})
+        # symbolize every distinct location and look up every distinct
+        # thread group once
+        locations = list(set(tuple(sorted(location.iteritems()))
+                for thread in threads for location in thread["frames"]))
+        symbols = dict(zip(locations, self.symbol_table.symbolize(
+                dict(location) for location in locations)))
+        group_ids = list(set(thread["thread_group"] for thread in threads))
+        group_names = dict(zip(group_ids, get_replies([
+                self.jdwp.command_request_async("ThreadGroupReference",
+                        "Name", {"group": group_id})
+                for group_id in group_ids])))
+        for thread in threads:
+            group_name = group_names[thread["thread_group"]]
+            thread["thread_group"] = group_name and group_name["groupName"]
+            thread["frames"] = [dict(symbols[tuple(sorted(
+                    location.iteritems()))], location=location)
+                    for location in thread["frames"]]
+        return {"pause_time": pause_time, "threads": threads}
+
+    def capture_snapshot(self, path, max_depth=2, max_objects=10000,
+            max_array_length=100, max_pause=0.5, max_frames=-1):
+        """Captures the stacks of all threads, the locals (and "this") of
+        their frames and the objects reachable from those, up to max_depth
+        references away, into a snapshot file at path; see the snapshot
+        module.
+
+        The jvm is suspended once, and each step pipelines all of its
+        requests: Name, Status and Frames for all threads (up to max_frames
+        frames each if not negative, after a burst of FrameCount), then
+        StackFrame.GetValues and ThisObject for all frames, then a level of
+        the object graph at a time, with ReferenceType,
+        ObjectReference.GetValues and ArrayReference.GetValues (up to
+        max_array_length elements) for all objects of the level. The walk
+        stops early, and the snapshot is marked truncated, once max_objects
+        objects are captured or max_pause seconds have passed. String
+        contents, frame symbols and type signatures are read after resuming.
+        Returns a dict with pause_time, threads, objects and truncated.
+        """
+        start = time.time()
+        deadline = start + max_pause
+        self.suspend()
+        try:
+            threads = self.__snapshot_threads(max_frames)
+            roots = [value for thread in threads
+                    for frame in thread["frames"]
+                    for value in frame["values"]]
+            objects, truncated = self.__snapshot_objects(roots, max_depth,
+                    max_objects, max_array_length, deadline)
+        finally:
+            self.resume()
+        pause_time = time.time() - start
+
+        writer = snapshot.SnapshotWriter()
+        frames = [frame for thread in threads for frame in thread["frames"]]
+        symbols = self.symbol_table.symbolize(
+                {"classID": class_id, "methodID": method_id,
+                    "index": code_index}
+                for class_id, method_id, code_index in
+                (frame["location"] for frame in frames))
+        for frame, symbol in zip(frames, symbols):
+            frame.update(symbol)
+        for thread in threads:
+            writer.add_thread(thread["thread_id"], thread["name"],
+                    thread["status"], thread["frames"])
+        signatures = self.__type_signatures(set(
+                entry["type_id"] for entry in objects.itervalues()))
+        string_ids = [object_id for object_id, entry in objects.iteritems()
+                if entry["tag"] == "s"]
+        strings = dict(zip(string_ids, self.strings.get_all(string_ids)))
+        for object_id, entry in objects.iteritems():
+            signature = signatures.get(entry["type_id"])
+            values = entry["values"]
+            if values and values[0][1] is None:
+                # primitive array elements come untagged
+                values = [(None, signature[1], value) for _, _, value
+                        in values] if signature is not None else []
+            writer.add_object(object_id, signature, entry["tag"], values,
+                    entry["length"], strings.get(object_id))
+        writer.write(path, pause_time, truncated)
+        return {
+                "pause_time": pause_time,
+                "threads": len(threads),
+                "objects": len(objects),
+                "truncated": truncated}
+
+    def __snapshot_threads(self, max_frames):
+        """Reads the frames of all threads and the locals of those frames, in
+        a suspended jvm. Locals are (name, tag, value) tuples."""
+        thread_ids = [entry["thread"] for entry in
+                self.jdwp.VirtualMachine.AllThreads()["threads"]]
+        # Frames fails with INVALID_LENGTH for more frames than there are,
+        # so with a limit the frames are counted first, as in thread_dump
+        pending = [self.jdwp.command_request_async(
+                "ThreadReference", command_name, data)
+                for thread_id in thread_ids
+                for command_name, data in [
+                    ("Name", {"thread": thread_id}),
+                    ("Status", {"thread": thread_id}),
+                    ("FrameCount", {"thread": thread_id})
+                    if max_frames >= 0 else
+                    ("Frames", {"thread": thread_id, "startFrame": 0,
+                        "length": -1})]]
+        if max_frames >= 0:
+            frame_counts = get_replies(pending[2::3])
+            for i, frame_count in enumerate(frame_counts):
+                if frame_count is not None:
+                    frame_count = self.jdwp.command_request_async(
+                            "ThreadReference", "Frames", {
+                                "thread": thread_ids[i],
+                                "startFrame": 0,
+                                "length": min(max_frames,
+                                        frame_count["frameCount"])})
+                pending[3 * i + 2] = frame_count
+        replies = get_replies(pending)
+        threads = []
+        for i, thread_id in enumerate(thread_ids):
+            name, status, frames = replies[3 * i : 3 * i + 3]
+            if None in (name, status, frames):
+                # died before we suspended it
+                continue
+            threads.append({
+                    "thread_id": thread_id,
+                    "name": name["threadName"],
+                    "status": status["threadStatus"],
+                    "frames": [{
+                        "frame_id": frame["frameID"],
+                        "location": (frame["classID"], frame["methodID"],
+                                frame["index"])}
+                        for frame in frames["frames"]]})
+        methods = list(set(frame["location"][:2] for thread in threads
+                for frame in thread["frames"]))
+        variable_tables = dict(zip(methods, get_replies([
+                self.jdwp.command_request_async("Method", "VariableTable", {
+                    "refType": class_id,
+                    "methodID": method_id})
+                for class_id, method_id in methods])))
+        pending = []
+        for thread in threads:
+            for frame in thread["frames"]:
+                class_id, method_id, code_index = frame["location"]
+                variable_table = variable_tables[(class_id, method_id)]
+                frame["slots"] = [(variable["name"], variable["slot"],
+                            ord(variable["signature"][0]))
+                        for variable in (variable_table or {}).get(
+                                "slots", [])
+                        if variable["name"] != "this" and
+                        variable["codeIndex"] <= code_index <
+                                variable["codeIndex"] + variable["length"]]
+                data = {"thread": thread["thread_id"],
+                        "frame": frame["frame_id"]}
+                pending.append(self.jdwp.command_request_async(
+                        "StackFrame", "GetValues", dict(data, slots=[
+                            {"slot": slot, "sigbyte": sigbyte}
+                            for _, slot, sigbyte in frame["slots"]]))
+                        if frame["slots"] else None)
+                pending.append(self.jdwp.command_request_async(
+                        "StackFrame", "ThisObject", data))
+        replies = iter(get_replies(pending))
+        for thread in threads:
+            for frame in thread["frames"]:
+                local_values, this = next(replies), next(replies)
+                frame["values"] = []
+                if this is not None and this["objectThis"]["objectID"]:
+                    frame["values"].append(("this",
+                            this["objectThis"]["typeTag"],
+                            this["objectThis"]["objectID"]))
+                if local_values is not None:
+                    frame["values"].extend((name, value["typeTag"],
+                            value["value"]) for (name, _, _), value in zip(
+                                frame["slots"], [entry["slotValue"] for entry
+                                    in local_values["values"]]))
+        return threads
+
+    def __snapshot_objects(self, roots, max_depth, max_objects,
+            max_array_length, deadline):
+        """Walks the object graph from roots ((name, tag, value) tuples) a
+        level at a time, in a suspended jvm. Returns a dict from object ID to
+        a dict with type_id, tag, length and values, and whether the walk was
+        cut short."""
+        objects = {}
+        level = {}
+        truncated = False
+        for _, tag, value in roots:
+            if snapshot.payload_kind(tag) == "id" and value:
+                level[value] = tag
+        for _ in xrange(max_depth):
+            object_ids = [object_id for object_id in level
+                    if object_id not in objects]
+            if not object_ids:
+                break
+            if time.time() > deadline:
+                truncated = True
+                break
+            if len(objects) + len(object_ids) > max_objects:
+                object_ids = object_ids[:max_objects - len(objects)]
+                truncated = True
+            types = dict(zip(object_ids, get_replies([
+                    self.jdwp.command_request_async("ObjectReference",
+                        "ReferenceType", {"object": object_id})
+                    for object_id in object_ids])))
+            # collected since we saw them
+            object_ids = [object_id for object_id in object_ids
+                    if types[object_id] is not None]
+            arrays = [object_id for object_id in object_ids
+                    if types[object_id]["refTypeTag"] ==
+                            self.jdwp.TypeTag.ARRAY]
+            others = [object_id for object_id in object_ids
+                    if types[object_id]["refTypeTag"] !=
+                            self.jdwp.TypeTag.ARRAY and
+                    level[object_id] != "s"]
+            fields = self.instance_fields.get(set(types[object_id]["typeID"]
+                    for object_id in others))
+            pending = [self.jdwp.command_request_async("ObjectReference",
+                    "GetValues", {
+                        "object": object_id,
+                        "fields": [{"fieldID": field_id} for _, field_id
+                                in fields[types[object_id]["typeID"]]]})
+                    for object_id in others]
+            pending.extend(self.jdwp.command_request_async("ArrayReference",
+                    "Length", {"arrayObject": object_id})
+                    for object_id in arrays)
+            replies = get_replies(pending)
+            lengths = dict(zip(arrays, [reply and reply["arrayLength"]
+                    for reply in replies[len(others):]]))
+            elements = dict(zip(arrays, get_replies([
+                    self.jdwp.command_request_async("ArrayReference",
+                        "GetValues", {
+                            "arrayObject": object_id,
+                            "firstIndex": 0,
+                            "length": min(lengths[object_id],
+                                    max_array_length)})
+                    if lengths[object_id] else None
+                    for object_id in arrays])))
+            for object_id in object_ids:
+                entry = {
+                        "type_id": types[object_id]["typeID"],
+                        "tag": level[object_id],
+                        "length": -1,
+                        "values": []}
+                objects[object_id] = entry
+                if object_id in lengths:
+                    entry["length"] = lengths[object_id] or 0
+                    reply = elements[object_id]
+                    for value in reply["values"] if reply else ():
+                        if isinstance(value, tuple):
+                            # object elements are (tag, object ID) pairs
+                            value = (chr(value[0]), value[1])
+                        else:
+                            value = (None, value)
+                        entry["values"].append((None,) + value)
+            for object_id, reply in zip(others, replies[:len(others)]):
+                if reply is None:
+                    continue
+                objects[object_id]["values"] = [
+                        (name, value["value"]["typeTag"],
+                            value["value"]["value"])
+                        for (name, _), value in zip(
+                            fields[types[object_id]["typeID"]],
+                            reply["values"])]
+            next_level = {}
+            for object_id in object_ids:
+                for _, tag, value in objects[object_id]["values"]:
+                    if tag is not None and value and \
+                            snapshot.payload_kind(tag) == "id":
+                        next_level[value] = tag
+            level = next_level
+            if truncated:
+                break
+        return objects, truncated
+
+    def __type_signatures(self, type_ids):
+        """Returns a dict from type IDs to their signatures, from the class
+        model where possible and with pipelined ReferenceType.Signature
+        requests otherwise"""
+        signatures = {}
+        missing = []
+        for type_id in type_ids:
+            cls = self.class_model.get(type_id)
+            if cls is not None:
+                signatures[type_id] = cls.signature
+            else:
+                missing.append(type_id)
+        for type_id, reply in zip(missing, get_replies([
+                self.jdwp.command_request_async("ReferenceType", "Signature",
+                    {"refType": type_id}) for type_id in missing])):
+            if reply is not None:
+                signatures[type_id] = reply["signature"]
+        return signatures
+
+    def dispose_objects(self, ref_counts):
+        """Releases object IDs in the target jvm; ref_counts maps each object
+        ID to the number of times it was received. Disposed IDs may be
+        reused for other objects, so they are dropped from the caches."""
+        self.strings.invalidate(ref_counts.keys())
+        self.jdwp.VirtualMachine.DisposeObjects({"requests": [
+                {"object": object_id, "refCnt": ref_count}
+                for object_id, ref_count in ref_counts.iteritems()]})
+
+    def suspend(self):
+        self.jdwp.VirtualMachine.Suspend()
+        self.thread_model.mark_stale()
+        self.values.bump()
+
+    def resume(self):
+        self.values.bump()
+        # leftover step requests would stop threads again; their clears go
+        # out in one burst with the resume
+        pending = self.__clear_step_requests()
+        self.jdwp.VirtualMachine.Resume()
+        get_replies(pending)
+        # thread states are fetched again only when somebody asks for them
+        self.thread_model.mark_stale()
+
+    def invoke_method(self, thread_id, class_id, method_id, arguments=(),
+            object_id=None, options=0):
+        """Invokes a method in a thread suspended by an event: an instance
+        method of object_id, or a static method of class_id if object_id is
+        None. Returns the reply, with returnValue and exception."""
+        # the invocation runs code, and by default resumes all threads
+        self.values.bump()
+        data = {
+                "thread": thread_id,
+                "methodID": method_id,
+                "arguments": [{"arg": argument} for argument in arguments],
+                "options": options}
+        try:
+            if object_id is None:
+                data["clazz"] = class_id
+                return self.jdwp.ClassType.InvokeMethod(data)
+            data.update(object=object_id, clazz=class_id)
+            return self.jdwp.ObjectReference.InvokeMethod(data)
+        finally:
+            self.values.bump()
+
+    def step_into(self, thread_id, count=1, class_exclude=STEP_CLASS_EXCLUDES,
+            size=None, timeout=10.0):
+        """Steps a suspended thread count lines (or bytecodes, with size
+        StepSize.MIN), entering called methods of classes matching none of
+        class_exclude; see __step"""
+        return self.__step(thread_id, self.jdwp.StepDepth.INTO, count,
+                class_exclude, size, timeout)
+
+    def step_over(self, thread_id, count=1, class_exclude=STEP_CLASS_EXCLUDES,
+            size=None, timeout=10.0):
+        """Steps a suspended thread count lines (or bytecodes) without
+        stopping in called methods; see __step"""
+        return self.__step(thread_id, self.jdwp.StepDepth.OVER, count,
+                class_exclude, size, timeout)
+
+    def step_out(self, thread_id, count=1, class_exclude=STEP_CLASS_EXCLUDES,
+            size=None, timeout=10.0):
+        """Runs a suspended thread until its current method (or, for count
+        n, its n-th caller) returns; see __step"""
+        return self.__step(thread_id, self.jdwp.StepDepth.OUT, count,
+                class_exclude, size, timeout)
+
+    def __step(self, thread_id, depth, count, class_exclude, size, timeout):
+        """Steps thread_id and waits for it to stop, for at most timeout
+        seconds; returns where it stopped, as a dict with location (a
+        (class_id, method_id, code_index) tuple) and the fields returned by
+        SymbolTable.symbolize.
+
+        The target jvm does all the stepping: ClassExclude modifiers make it
+        run through excluded classes without reporting them, and a Count
+        modifier makes it skip the first count - 1 steps and report only the
+        next one. The request thus expires once the thread stops, and a
+        thread resumed by other means than resume() or another step (e.g.,
+        by ThreadReference.Resume) does not stop on it again. A step request
+        only holds for the frame it was set in, so each step needs a new
+        one; clearing the thread's previous step request, setting the new
+        one and resuming the thread are pipelined, so a step costs a single
+        round trip on top of the time the thread runs. If setting the
+        request fails, the thread is resumed regardless."""
+        if size is None:
+            size = self.jdwp.StepSize.LINE
+        modifiers = [{
+                "modKind": pyjdwp.MODIFIER_KIND_STEP,
+                "thread": thread_id,
+                "size": size,
+                "depth": depth}]
+        for pattern in class_exclude:
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": pattern})
+        # last, so only steps passing the other filters are counted
+        modifiers.append({
+                "modKind": pyjdwp.MODIFIER_KIND_COUNT,
+                "count": count})
+        stopped = threading.Event()
+        waiter = [stopped, None]
+        with self.__step_lock:
+            self.__step_waiters[thread_id] = waiter
+            previous_request_id = self.__step_request_ids.pop(thread_id, None)
+        clear_reply = None
+        if previous_request_id is not None:
+            clear_reply = self.jdwp.command_request_async("EventRequest",
+                    "Clear", {
+                        "eventKind": self.jdwp.EventKind.SINGLE_STEP,
+                        "requestID": previous_request_id})
+        set_reply = self.jdwp.command_request_async("EventRequest", "Set", {
+                "eventKind": self.jdwp.EventKind.SINGLE_STEP,
+                "suspendPolicy": self.jdwp.SuspendPolicy.EVENT_THREAD,
+                "modifiers": modifiers})
+        resume_reply = self.jdwp.command_request_async("ThreadReference",
+                "Resume", {"thread": thread_id})
+        self.values.bump()
+        self.thread_model.mark_stale(thread_id)
+        # python 2 waits with a timeout poll, which would add milliseconds to
+        # every step, so the wait blocks and a timer cuts it short
+        timer = threading.Timer(timeout, stopped.set)
+        timer.daemon = True
+        timer.start()
+        try:
+            get_replies([clear_reply])
+            request_id = set_reply.get()["requestID"]
+            with self.__step_lock:
+                self.__step_request_ids[thread_id] = request_id
+            resume_reply.wait()
+            stopped.wait()
+        except pyjdwp.Error:
+            with self.__step_lock:
+                if self.__step_waiters.get(thread_id) is waiter:
+                    del self.__step_waiters[thread_id]
+            raise
+        finally:
+            timer.cancel()
+        event = waiter[1]
+        if event is None:
+            with self.__step_lock:
+                if self.__step_waiters.get(thread_id) is waiter:
+                    del self.__step_waiters[thread_id]
+            raise pyjdwp.Timeout("Thread %d did not stop stepping" % thread_id)
+        result = self.symbol_table.symbolize([event])[0]
+        result["location"] = (event["classID"], event["methodID"],
+                event["index"])
+        return result
+
+    def __handle_step(self, event):
+        with self.__step_lock:
+            waiter = self.__step_waiters.pop(event["thread"], None)
+        if waiter is not None:
+            waiter[1] = event
+            waiter[0].set()
+
+    def __clear_step_requests(self):
+        """Sends EventRequest.Clear for the step requests left from steps;
+        returns the pending replies"""
+        with self.__step_lock:
+            request_ids = self.__step_request_ids.values()
+            self.__step_request_ids.clear()
+        return [self.jdwp.command_request_async("EventRequest", "Clear", {
+                    "eventKind": self.jdwp.EventKind.SINGLE_STEP,
+                    "requestID": request_id})
+                for request_id in request_ids]
 
     def set_breakpoint_at_line(self, filename, line_number):
-        print("Setting breakpoint at %s:%d" % (filename, line_number))
-        index_key = (filename, line_number)
-        with self.__debug_state_lock:
-            if index_key in self.line_index:
-                line_index_entry = self.line_index[(filename, line_number)]
-                event_request_modifier = {
-                        "modKind": 7,
-                        "typeTag": self.jdwp.TypeTag.CLASS,
-                        "classID": line_index_entry[0],
-                        "methodID": line_index_entry[1],
-                        "index": line_index_entry[2]}
-                resp = self.jdwp.EventRequest.Set({
-                    "eventKind": self.jdwp.EventKind.BREAKPOINT,
-                    "suspendPolicy": self.jdwp.SuspendPolicy.ALL,
-                    "modifiers": [event_request_modifier]})
-                return
-        # if we get here we should set the deferred breakpoint
-        self.set_deferred_breakpoint_at_line(filename, line_number)
+        """Sets a breakpoint on line_number of filename, or on the next
+        executable line after it if line_number has no code (e.g., a comment
+        or blank line). Falls back to a deferred breakpoint if no loaded class
+        has code at or after that line. Returns a Breakpoint."""
+        logging.debug("Setting breakpoint at %s:%d", filename, line_number)
+        return self.set_breakpoints([(filename, line_number)])[0]
 
     def set_deferred_breakpoint_at_line(self, filename, line_number):
-        index_key = (filename, line_number)
-        print("Setting deferred breakpoint at %s:%d" % index_key)
-        def matches(cls, filename=filename):
-            return cls["source_file"] == filename
-        def notify(cls, filename=filename, line_number=line_number):
-            should_set_breakpoint = False
-            with self.__debug_state_lock:
-                if index_key in self.line_index:
-                    should_set_breakpoint = True
-            if should_set_breakpoint:
-                self.set_breakpoint_at_line(filename, line_number)
-        self.class_prepare_listeners.append((matches, notify))
+        """Sets a breakpoint to be installed once a class from filename with
+        code at or after line_number is prepared. Returns a Breakpoint."""
+        logging.debug("Setting deferred breakpoint at %s:%d", filename,
+                line_number)
+        breakpoint = Breakpoint(filename, line_number)
+        self.__defer_breakpoints([breakpoint])
+        return breakpoint
+
+    def set_conditional_breakpoint(self, filename, line_number, condition,
+            listener=None):
+        """Sets a breakpoint like set_breakpoint_at_line that only stops when
+        condition, a BreakpointCondition, holds; see Breakpoint for
+        listener. Returns a Breakpoint."""
+        return self.set_breakpoints([(filename, line_number)], condition,
+                listener)[0]
+
+    def set_breakpoints(self, lines, condition=None, listener=None):
+        """Sets a breakpoint for every (filename, line_number) in lines, like
+        set_breakpoint_at_line, and returns a Breakpoint handle for each;
+        condition and listener apply to all of them (see Breakpoint).
+
+        All lines are resolved through the line indexes first, and the
+        EventRequest.Set requests for all of them are pipelined; the lines no
+        loaded class has code for become deferred breakpoints, with one
+        catch-up scan of the loaded classes for all of their files."""
+        breakpoints = [Breakpoint(filename, line_number, condition, listener)
+                for filename, line_number in lines]
+        self.__install_breakpoints(breakpoints)
+        return breakpoints
+
+    def set_tracepoint(self, filename, line_number, local_names=(),
+            field_names=(), max_records=1000, max_rate=None, condition=None,
+            listener=None):
+        """Sets a Tracepoint on line_number of filename, resolved like
+        set_breakpoint_at_line, and returns it"""
+        tracepoint = Tracepoint(filename, line_number, local_names,
+                field_names, max_records, max_rate, condition, listener)
+        self.__install_breakpoints([tracepoint])
+        return tracepoint
+
+    def __install_breakpoints(self, breakpoints):
+        """Sets the breakpoints that resolve to loaded code, and defers the
+        others"""
+        deferred = []
+        for breakpoint in breakpoints:
+            breakpoint.path = self.class_model.resolve(breakpoint.filename)
+            breakpoint.line, breakpoint.locations = \
+                    self.class_model.resolve_line(breakpoint.path,
+                            breakpoint.line_number)
+            if not breakpoint.locations:
+                deferred.append(breakpoint)
+        self.__set_breakpoints([breakpoint for breakpoint in breakpoints
+                if breakpoint.locations])
+        if deferred:
+            self.__defer_breakpoints(deferred)
+
+    def clear_breakpoints(self, breakpoints):
+        """Removes breakpoints, set or still deferred. The EventRequest.Clear
+        requests are pipelined, and replaced by a single
+        EventRequest.ClearAllBreakpoints when no other breakpoint remains."""
+        request_ids = []
+        unsubscribe = []
+        with self.__breakpoint_lock:
+            for breakpoint in breakpoints:
+                pending = self.pending_breakpoints.get(breakpoint.filename)
+                if pending is not None and \
+                        breakpoint in pending["breakpoints"]:
+                    pending["breakpoints"].remove(breakpoint)
+                    if not pending["breakpoints"]:
+                        unsubscribe.append(pending["request_id"])
+                        del self.pending_breakpoints[breakpoint.filename]
+                        self.pending_breakpoint_files_by_request_id.pop(
+                                pending["request_id"], None)
+                request_ids.extend(breakpoint.request_ids)
+            request_ids = set(request_ids)
+            clear_all = len(self.breakpoints) == len(request_ids) and \
+                    not self.breakpoints.setting()
+        if clear_all and request_ids:
+            self.jdwp.EventRequest.ClearAllBreakpoints()
+        else:
+            get_replies([self.jdwp.command_request_async(
+                    "EventRequest", "Clear", {
+                        "eventKind": self.jdwp.EventKind.BREAKPOINT,
+                        "requestID": request_id})
+                    for request_id in request_ids])
+        # hits reported until now are still those of the breakpoints
+        with self.__breakpoint_lock:
+            for breakpoint in breakpoints:
+                self.breakpoints.remove(breakpoint)
+                breakpoint.request_ids = []
+        for request_id in unsubscribe:
+            if request_id is not None:
+                self.subscriptions.unsubscribe(request_id,
+                        self.__handle_pending_class_prepare)
+
+    def __defer_breakpoints(self, breakpoints):
+        """Pending breakpoints are indexed by source file, and each source
+        file gets a single CLASS_PREPARE request filtered in the target jvm
+        by source name (and package, for qualified paths), so only loads of
+        matching classes are ever reported to us."""
+        new_files = []
+        with self.__breakpoint_lock:
+            for breakpoint in breakpoints:
+                if breakpoint.filename not in self.pending_breakpoints:
+                    self.pending_breakpoints[breakpoint.filename] = {
+                        "request_id": None,
+                        "breakpoints": []}
+                    new_files.append(breakpoint.filename)
+                self.pending_breakpoints[breakpoint.filename][
+                        "breakpoints"].append(breakpoint)
+        for filename in new_files:
+            # the file must be known by request ID before the first event
+            request_id = self.subscriptions.subscribe(
+                    self.jdwp.EventKind.CLASS_PREPARE,
+                    self.__source_file_modifiers(filename),
+                    self.jdwp.SuspendPolicy.EVENT_THREAD,
+                    self.__handle_pending_class_prepare,
+                    lambda request_id, filename=filename:
+                            self.__set_pending_request_id(filename,
+                                    request_id))
+            with self.__breakpoint_lock:
+                pending = self.pending_breakpoints.get(filename)
+                orphaned = pending is None or \
+                        pending["request_id"] != request_id
+            # the breakpoints were cleared or resolved meanwhile
+            if orphaned:
+                self.subscriptions.unsubscribe(request_id,
+                        self.__handle_pending_class_prepare)
+        # matching classes may have been loaded since we last looked
+        if new_files:
+            self.__load_classes_for_source_files(new_files)
+        for filename in set(breakpoint.filename for breakpoint in breakpoints):
+            self.__resolve_pending_breakpoints(filename)
+
+    def __set_pending_request_id(self, filename, request_id):
+        with self.__breakpoint_lock:
+            pending = self.pending_breakpoints.get(filename)
+            if pending is not None:
+                pending["request_id"] = request_id
+                self.pending_breakpoint_files_by_request_id[request_id] = \
+                        filename
+
+    def __set_breakpoints(self, breakpoints):
+        """Sets a request per location of each breakpoint, all pipelined"""
+        if not breakpoints:
+            return
+        # slots and fields must be known before the first hit is reported
+        self.__resolve_local_slots([breakpoint for breakpoint in breakpoints
+                if self.__local_names(breakpoint)])
+        for breakpoint in breakpoints:
+            if isinstance(breakpoint, Tracepoint):
+                self.__resolve_fields(breakpoint)
+        self.breakpoints.begin_set(breakpoints)
+        try:
+            self.__send_breakpoint_requests(breakpoints)
+        finally:
+            early_events = self.breakpoints.end_set()
+        for event_list in early_events:
+            self.__handle_breakpoints(event_list)
+
+    def __send_breakpoint_requests(self, breakpoints):
+        pending = []
+        for breakpoint in breakpoints:
+            condition = breakpoint.condition
+            if isinstance(breakpoint, Tracepoint) or condition is not None \
+                    and (condition.predicate is not None or
+                            not condition.suspend_all):
+                suspend_policy = self.jdwp.SuspendPolicy.EVENT_THREAD
+            else:
+                suspend_policy = self.jdwp.SuspendPolicy.ALL
+            modifiers = condition.modifiers() if condition is not None else []
+            pending.append([self.jdwp.command_request_async(
+                    "EventRequest", "Set", {
+                        "eventKind": self.jdwp.EventKind.BREAKPOINT,
+                        "suspendPolicy": suspend_policy,
+                        "modifiers": [{
+                            "modKind": pyjdwp.MODIFIER_KIND_LOCATION_ONLY,
+                            "typeTag": self.jdwp.TypeTag.CLASS,
+                            "classID": class_id,
+                            "methodID": method_id,
+                            "index": code_index}] + modifiers})
+                    for class_id, method_id, code_index
+                    in breakpoint.locations])
+        for breakpoint, replies in zip(breakpoints, pending):
+            request_ids = []
+            for reply in get_replies(replies):
+                # fails if the class was unloaded meanwhile
+                if reply is not None:
+                    request_ids.append(reply["requestID"])
+                    self.breakpoints.add(breakpoint, reply["requestID"])
+            breakpoint.request_ids = request_ids
+
+    def __local_names(self, breakpoint):
+        """Returns the names of the locals read on hits of breakpoint"""
+        names = frozenset()
+        if breakpoint.condition is not None and \
+                breakpoint.condition.predicate is not None:
+            names = breakpoint.condition.local_names
+        if isinstance(breakpoint, Tracepoint):
+            names = names | breakpoint.local_names
+        return names
+
+    def __resolve_local_slots(self, breakpoints):
+        """Finds the slots of the locals each breakpoint reads at each of its
+        locations, with one pipelined Method.VariableTable per distinct
+        method. Methods compiled without local variable information have
+        none."""
+        methods = list(set((class_id, method_id)
+                for breakpoint in breakpoints
+                for class_id, method_id, _ in breakpoint.locations))
+        variable_tables = dict(zip(methods, get_replies([
+                self.jdwp.command_request_async("Method", "VariableTable", {
+                    "refType": class_id,
+                    "methodID": method_id})
+                for class_id, method_id in methods])))
+        for breakpoint in breakpoints:
+            names = self.__local_names(breakpoint)
+            for location in breakpoint.locations:
+                class_id, method_id, code_index = location
+                variable_table = variable_tables[(class_id, method_id)]
+                breakpoint.local_slots[location] = [
+                        (variable["name"], variable["slot"],
+                            ord(variable["signature"][0]))
+                        for variable in (variable_table or {}).get(
+                                "slots", [])
+                        if variable["name"] in names and
+                        variable["codeIndex"] <= code_index <
+                                variable["codeIndex"] + variable["length"]]
+
+    def __resolve_fields(self, tracepoint):
+        for location in tracepoint.locations:
+            cls = self.class_model.get(location[0])
+            tracepoint.fields[location] = [(field.name, field.field_id)
+                    for field in (cls.fields if cls is not None else ())
+                    if field.name in tracepoint.field_names and not
+                    field.access_modifier_bits & pyjdwp.ACCESS_MODIFIER_STATIC]
+
+    def __handle_breakpoints(self, event_list):
+        """Evaluates the predicates of the conditional breakpoints hit in an
+        event set, captures tracepoint records and notifies breakpoint
+        listeners. A thread held only for tracepoints, for predicates that
+        all failed or for requests that are gone is resumed at once, even if
+        reading its values fails."""
+        if self.breakpoints.hold_early(event_list):
+            return
+        suspend_policy = event_list["suspendPolicy"]
+        hits = []
+        tracepoints = []
+        records = []
+        held = False
+        try:
+            for event in event_list["events"]:
+                if event["eventKind"] != self.jdwp.EventKind.BREAKPOINT:
+                    # anything else reported along may want the thread held
+                    held = True
+                    continue
+                thread_id = event["Breakpoint"]["thread"]
+                breakpoint = self.breakpoints.for_event(event)
+                if breakpoint is None:
+                    # cleared, or set by someone else; only a thread stopped
+                    # on its own can be let go without stopping anyone
+                    held = held or suspend_policy != \
+                            self.jdwp.SuspendPolicy.EVENT_THREAD
+                elif isinstance(breakpoint, Tracepoint):
+                    tracepoints.append(breakpoint)
+                    record = breakpoint.allow() and self.__capture(
+                            breakpoint, event["Breakpoint"])
+                    if record:
+                        records.append((breakpoint, record))
+                        hits.append((breakpoint, event))
+                elif self.__breakpoint_condition_holds(breakpoint,
+                        event["Breakpoint"]):
+                    held = True
+                    hits.append((breakpoint, event))
+        finally:
+            if not held:
+                self.values.bump()
+                if suspend_policy == self.jdwp.SuspendPolicy.EVENT_THREAD:
+                    self.jdwp.ThreadReference.Resume({"thread": thread_id})
+                    self.thread_model.mark_stale(thread_id)
+                elif suspend_policy == self.jdwp.SuspendPolicy.ALL:
+                    self.resume()
+                pause_time = time.time() - event_list["received"]
+                for tracepoint in tracepoints:
+                    tracepoint.pause_times.append(pause_time)
+            elif suspend_policy == self.jdwp.SuspendPolicy.EVENT_THREAD and \
+                    any(not isinstance(breakpoint, Tracepoint) and (
+                        breakpoint.condition is None or
+                        breakpoint.condition.suspend_all)
+                    for breakpoint, _ in hits):
+                # stop the other threads too, now that the condition holds;
+                # the event thread stays suspended by the event
+                self.suspend()
+                self.jdwp.ThreadReference.Resume({"thread": thread_id})
+        # strings are looked up once the thread runs again
+        for tracepoint, record in records:
+            record["locals"] = self.__untag_values(record["locals"])
+            record["fields"] = self.__untag_values(record["fields"])
+            tracepoint.records.append(record)
+        for breakpoint, event in hits:
+            breakpoint.hits += 1
+            if breakpoint.listener is not None:
+                breakpoint.listener(breakpoint, event)
+
+    def __breakpoint_condition_holds(self, breakpoint, event):
+        condition = breakpoint.condition
+        if condition is None or condition.predicate is None:
+            return True
+        location = (event["classID"], event["methodID"], event["index"])
+        slots = breakpoint.local_slots.get(location, [])
+        local_values = {}
+        if slots:
+            frame_id = self.jdwp.ThreadReference.Frames({
+                    "thread": event["thread"],
+                    "startFrame": 0,
+                    "length": 1})["frames"][0]["frameID"]
+            values = self.values.frame_values(event["thread"], frame_id,
+                    [(slot, sigbyte) for _, slot, sigbyte in slots])
+            local_values = self.__untag_values(dict(zip(
+                    [name for name, _, _ in slots], values)))
+        return condition.holds(local_values)
+
+    def __capture(self, tracepoint, event):
+        """Reads a tracepoint's locals and fields of this on a hit. Returns
+        the record, with tagged values, or None if the condition's predicate
+        fails."""
+        location = (event["classID"], event["methodID"], event["index"])
+        slots = tracepoint.local_slots.get(location, [])
+        fields = tracepoint.fields.get(location, [])
+        thread_id = event["thread"]
+        frame_id = self.jdwp.ThreadReference.Frames({
+                "thread": thread_id,
+                "startFrame": 0,
+                "length": 1})["frames"][0]["frameID"]
+        pending_locals = self.jdwp.command_request_async("StackFrame",
+                "GetValues", {
+                    "thread": thread_id,
+                    "frame": frame_id,
+                    "slots": [{"slot": slot, "sigbyte": sigbyte}
+                            for _, slot, sigbyte in slots]}) if slots else None
+        pending_this = self.jdwp.command_request_async("StackFrame",
+                "ThisObject", {"thread": thread_id, "frame": frame_id}) \
+                if fields else None
+        record = {
+                "time": time.time(),
+                "thread_id": thread_id,
+                "location": location,
+                "this": None,
+                "locals": {},
+                "fields": {}}
+        local_values, this = get_replies([pending_locals, pending_this])
+        if local_values is not None:
+            record["locals"] = dict(zip([name for name, _, _ in slots],
+                    [entry["slotValue"] for entry in local_values["values"]]))
+        condition = tracepoint.condition
+        if condition is not None and condition.predicate is not None and \
+                not condition.holds(self.__untag_values(dict(
+                        (name, value) for name, value in
+                        record["locals"].iteritems()
+                        if name in condition.local_names))):
+            return None
+        if this is not None and this["objectThis"]["objectID"]:
+            record["this"] = this["objectThis"]["objectID"]
+            field_values = self.jdwp.ObjectReference.GetValues({
+                    "object": record["this"],
+                    "fields": [{"fieldID": field_id}
+                            for _, field_id in fields]})["values"]
+            record["fields"] = dict(zip([name for name, _ in fields],
+                    [entry["value"] for entry in field_values]))
+        return record
+
+    def __untag_values(self, values):
+        """Maps a dict of tagged values to their values, with the contents of
+        strings in place of their object IDs"""
+        string_ids = [value["value"] for value in values.itervalues()
+                if value["typeTag"] == "s" and value["value"]]
+        strings = dict(zip(string_ids, self.strings.get_all(string_ids)))
+        return dict((name, strings.get(value["value"], value["value"])
+                if value["typeTag"] == "s" else value["value"])
+                for name, value in values.iteritems())
+
+    def __source_file_modifiers(self, filename):
+        file_name = filename.rsplit("/", 1)[-1]
+        modifiers = [{
+                "modKind": pyjdwp.MODIFIER_KIND_SOURCE_NAME_MATCH,
+                "sourceNamePattern": file_name}]
+        if "/" in filename:
+            package = filename.rsplit("/", 1)[0].replace("/", ".")
+            modifiers.append({
+                    "modKind": pyjdwp.MODIFIER_KIND_CLASS_MATCH,
+                    "classPattern": "%s.*" % package})
+        return modifiers
+
+    def __load_classes_for_source_files(self, filenames):
+        """Fetches metadata for loaded classes we have not seen yet whose
+        top-level class name matches one of filenames"""
+        stems = tuple("/" + filename.rsplit(".", 1)[0]
+                for filename in filenames)
+        classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()["classes"]
+        matching = []
+        for entry in classes:
+            if entry["typeID"] in self.class_model or \
+                    entry["signature"] in self.class_blacklist:
+                continue
+            outer_name = "/" + \
+                    outer_class_signature(entry["signature"])[1 : -1]
+            if outer_name.endswith(stems):
+                matching.append(entry)
+        self.metadata_pipeline.fetch(matching)
+
+    def __resolve_pending_breakpoints(self, filename, paths=None):
+        """Sets the pending breakpoints of filename that resolve to code in
+        a loaded file filename may refer to, only among paths if given"""
+        candidates = self.class_model.paths(filename)
+        if paths is not None:
+            candidates = [path for path in candidates if path in paths]
+        resolved = []
+        request_id = None
+        # claim resolvable breakpoints under the lock, so that concurrent
+        # class prepares never set the same breakpoint twice
+        with self.__breakpoint_lock:
+            pending = self.pending_breakpoints.get(filename)
+            if pending is None or pending["request_id"] is None:
+                return
+            for breakpoint in list(pending["breakpoints"]):
+                for path in candidates:
+                    line, locations = self.class_model.resolve_line(path,
+                            breakpoint.line_number)
+                    if locations:
+                        breakpoint.path = path
+                        breakpoint.line = line
+                        breakpoint.locations = locations
+                        pending["breakpoints"].remove(breakpoint)
+                        resolved.append(breakpoint)
+                        break
+            if not pending["breakpoints"]:
+                request_id = pending["request_id"]
+                del self.pending_breakpoints[filename]
+                self.pending_breakpoint_files_by_request_id.pop(request_id,
+                        None)
+        self.__set_breakpoints(resolved)
+        if request_id is not None:
+            self.subscriptions.unsubscribe(request_id,
+                    self.__handle_pending_class_prepare)
+
+    def __handle_pending_class_prepare(self, suspend_policy, event):
+        class_prepare = event["ClassPrepare"]
+        with self.__breakpoint_lock:
+            filename = self.pending_breakpoint_files_by_request_id.get(
+                    class_prepare["requestID"])
+
+        def resolve_and_resume():
+            try:
+                # only the prepared class's file, as a bare file name may
+                # also refer to files loaded before
+                cls = self.class_model.get(class_prepare["typeID"])
+                if filename is not None and cls is not None and \
+                        cls.source_path is not None:
+                    self.__resolve_pending_breakpoints(filename,
+                            [cls.source_path])
+            finally:
+                # the preparing thread was held so that breakpoints are in
+                # place before any code of the class runs; let it go now.
+                if suspend_policy == self.jdwp.SuspendPolicy.EVENT_THREAD:
+                    self.values.bump()
+                    self.jdwp.ThreadReference.Resume({
+                        "thread": class_prepare["thread"]})
+                    self.thread_model.mark_stale(class_prepare["thread"])
+                elif suspend_policy == self.jdwp.SuspendPolicy.ALL:
+                    self.resume()
+        # the metadata pipeline calls back once the class's line tables are in,
+        # so the event thread does not wait for them
+        if class_prepare["typeID"] in self.class_model:
+            resolve_and_resume()
+        else:
+            self.metadata_pipeline.enqueue(class_prepare, resolve_and_resume)
 
     def disconnect(self):
+        self.metadata_pipeline.stop()
+        self.class_model.clear()
+        self.heap_histogram.stop()
+        self.profiler.stop()
         self.jdwp.disconnect()
 
     def handle_event(self, event_list):
-        with self.__debug_state_lock:
-            for event in event_list["events"]:
-                if event["eventKind"] in [self.jdwp.EventKind.CLASS_PREPARE,
-                        self.jdwp.EventKind.CLASS_UNLOAD]:
-                    self.__update_class_metadata(event["ClassPrepare"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_START:
-                    self.__update_thread_status(event["ThreadStart"]["thread"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_END:
-                    self.__update_thread_status(event["ThreadEnd"]["thread"])
-                elif event["eventKind"] == self.jdwp.EventKind.THREAD_DEATH:
-                    self.__update_thread_status(event["ThreadDeath"]["thread"])
+        if event_list["suspendPolicy"] != self.jdwp.SuspendPolicy.NONE:
+            # values read while the threads were running are out of date
+            self.values.bump()
+        if event_list["suspendPolicy"] == self.jdwp.SuspendPolicy.ALL:
+            self.thread_model.mark_stale()
+        for event in event_list["events"]:
+            if event_list["suspendPolicy"] == \
+                    self.jdwp.SuspendPolicy.EVENT_THREAD and \
+                    "thread" in event_data(event):
+                self.thread_model.mark_stale(event_data(event)["thread"])
+            if event["eventKind"] == self.jdwp.EventKind.CLASS_PREPARE:
+                class_prepare = event["ClassPrepare"]
+                if class_prepare["signature"] not in self.class_blacklist:
+                    self.metadata_pipeline.enqueue(class_prepare)
+            elif event["eventKind"] == self.jdwp.EventKind.CLASS_UNLOAD:
+                self.class_model.remove(event["ClassUnload"]["signature"])
+                self.symbol_table.remove(event["ClassUnload"]["signature"])
+                self.instance_fields.clear()
+            elif event["eventKind"] == self.jdwp.EventKind.THREAD_START:
+                self.thread_model.add(event["ThreadStart"]["thread"])
+            elif event["eventKind"] == self.jdwp.EventKind.THREAD_DEATH:
+                self.thread_model.remove(event["ThreadDeath"]["thread"])
+            elif event["eventKind"] == self.jdwp.EventKind.SINGLE_STEP:
+                self.__handle_step(event["SingleStep"])
+        if any(event["eventKind"] == self.jdwp.EventKind.BREAKPOINT
+                for event in event_list["events"]):
+            self.__handle_breakpoints(event_list)
 
     def __class_name_to_signature(self, class_name):
         return "L%s;" % class_name.replace(".", "/")
 
     def __initialize_event_subscriptions(self):
-        with self.__debug_state_lock:
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.CLASS_UNLOAD,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.CLASS_PREPARE,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_START,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_END,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.THREAD_DEATH,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
-            self.jdwp.EventRequest.Set({
-                "eventKind": self.jdwp.EventKind.EXCEPTION,
-                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
-                "modifiers": []})
+        # only what the class and thread models need; everything else (e.g.,
+        # exceptions) is subscribed to on demand through self.subscriptions.
+        # Class prepares suspend nothing and only queue the class for the
+        # metadata pipeline, which keeps the source and line indexes current
+        # for classes loaded after the initial scan.
+        self.subscriptions.subscribe(self.jdwp.EventKind.CLASS_PREPARE)
+        self.subscriptions.subscribe(self.jdwp.EventKind.CLASS_UNLOAD)
+        self.subscriptions.subscribe(self.jdwp.EventKind.THREAD_START)
+        self.subscriptions.subscribe(self.jdwp.EventKind.THREAD_DEATH)
 
     def __initialize_jvm_state(self):
-        with self.__debug_state_lock:
-            self.threads = {}
-            threads_resp = self.jdwp.VirtualMachine.AllThreads()
-            for entry in threads_resp["threads"]:
-                thread_id = entry["thread"]
-                thread_name = self.jdwp.ThreadReference.Name({
-                    "thread": thread_id})["threadName"]
-                thread_group_id = self.jdwp.ThreadReference.ThreadGroup({
-                    "thread": thread_id})["group"]
-                self.threads[thread_id] = {
-                    "name": thread_name,
-                    "thread_group_id": thread_group_id}
-                self.__update_thread_status(thread_id)
-            classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()["classes"]
-            for entry in classes:
-                self.__update_class_metadata(entry)
-
-    def __update_class_metadata(self, class_entry):
-        if class_entry["signature"] in self.class_blacklist:
-            return
-        class_id = class_entry["typeID"]
-        if class_id not in self.classes_by_id:
-            self.classes_by_id[class_id] = {"typeID": class_id}
-        self.class_ids_by_sig[class_entry["signature"]] = class_id
-        cls = self.classes_by_id[class_id]
-        cls["signature"] = class_entry["signature"]
-        cls["refTypeTag"] = class_entry["signature"]
-        self.__fetch_class_info(cls)
-        try:
-            cls["source_file"] = self.jdwp.ReferenceType.SourceFile({
-                "refType": cls["typeID"]})["sourceFile"]
-        except pyjdwp.Error as e:
-            # No source info for class
-            return
-        source_file = cls["source_file"]
-        for method_entry in cls["methods"]:
-            try:
-                self.__fetch_method_info(cls, method_entry)
-            except pyjdwp.Error as e:
-                continue
-        # we save these to notify outside of the lock we're holding
-        to_notify = []
-        for matches, notify in self.class_prepare_listeners:
-            if matches(cls):
-                to_notify.append(notify)
-        for notify in to_notify:
-            notify(cls)
-
-    def __fetch_class_info(self, cls):
-        cls["access_modifier_bits"] = self.jdwp.ReferenceType.Modifiers({
-            "refType": cls["typeID"]})["modBits"]
-        cls["fields"] = self.jdwp.ReferenceType.FieldsWithGeneric({
-            "refType": cls["typeID"]})["declared"]
-        cls["methods"] = self.jdwp.ReferenceType.MethodsWithGeneric({
-            "refType": cls["typeID"]})["declared"]
-
-    def __fetch_method_info(self, cls, method_entry):
-        method_id = method_entry["methodID"]
-        method_entry["line_table"] = self.jdwp.Method.LineTable({
-            "refType": cls["typeID"],
-            "methodID": method_id})["lines"]
-        for line in method_entry["line_table"]:
-            line_number = line["lineNumber"]
-            line_code_index = line["lineCodeIndex"]
-            index_key = (cls["source_file"], line_number)
-            if index_key not in self.line_index:
-                self.line_index[index_key] = []
-            self.line_index[index_key].append(
-                    (cls["typeID"], method_id, line_code_index))
-
-    def __update_thread_status(self, thread_id):
-        thread = self.threads[thread_id]
-        thread_status = self.jdwp.ThreadReference.Status({
-            "thread": thread_id})
-        thread["status"] = thread_status["threadStatus"]
-        thread["is_suspended"] = thread_status["suspendStatus"]
-        thread["frames"] = []
-        if thread["is_suspended"]:
-            frames = self.jdwp.ThreadReference.Frames({
-                "thread": thread_id,
-                "startFrame": 0,
-                "length": -1})["frames"]
+        threads_resp = self.jdwp.VirtualMachine.AllThreads()
+        for entry in threads_resp["threads"]:
+            self.thread_model.add(entry["thread"])
+        classes = self.jdwp.VirtualMachine.AllClassesWithGeneric()["classes"]
+        self.metadata_pipeline.fetch(entry for entry in classes
+                if entry["signature"] not in self.class_blacklist)
+
+    def __install_class(self, cls):
+        """Installs a class fetched by the metadata pipeline in the class
+        model"""
+        if cls.source_file is not None:
+            cls.source_path = self.class_model.interner.string(
+                    source_path(cls.signature, cls.source_file))
+        else:
+            # Lambda and other synthetic classes still belong to the file of
+            # their enclosing class, if known.
+            outer = self.class_model.get_by_signature(
+                    outer_class_signature(cls.signature))
+            if outer is not None and outer.type_id != cls.type_id:
+                cls.source_path = outer.source_path
+        self.class_model.add(cls)
@@ -3,10 +3,14 @@ import logging
 import os
 import pprint
 import pyjdb
+import pyjdwp
 import signal
+import snapshot
 import socket
+import struct
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 
@@ -131,6 +135,1291 @@ class PyjdbTestBase(unittest.TestCase):
         self.pyjdb.resume()
         time.sleep(5)
 
+    def test_set_deferred_breakpoint_at_line(self):
+        # PyjdbTest is not loaded yet, so this waits on a filtered
+        # CLASS_PREPARE request; line 12 is blank and resolves to line 14.
+        self.pyjdb.set_breakpoint_at_line("PyjdbTest.java", 12)
+        self.assertIn("PyjdbTest.java", self.pyjdb.pending_breakpoints)
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.assertNotIn("PyjdbTest.java", self.pyjdb.pending_breakpoints)
+
+    def test_class_loaded_after_initialize(self):
+        self.assertEqual(None,
+                self.pyjdb.class_model.resolve("PyjdbTest.java"))
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.assertEqual("PyjdbTest.java",
+                self.pyjdb.class_model.resolve("PyjdbTest.java"))
+        self.assertTrue(self.pyjdb.class_model.breakpoint_locations(
+                "PyjdbTest.java", 8))
+
+    def test_set_and_clear_breakpoints(self):
+        breakpoints = self.pyjdb.set_breakpoints([
+                ("PyjdbTest.java", 8), ("PyjdbTest.java", 12)])
+        # PyjdbTest is not loaded yet
+        self.assertEqual([[], []], [bp.request_ids for bp in breakpoints])
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.assertEqual([8, 14], [bp.line for bp in breakpoints])
+        self.assertTrue(all(bp.request_ids for bp in breakpoints))
+        self.pyjdb.clear_breakpoints(breakpoints)
+        self.assertEqual([[], []], [bp.request_ids for bp in breakpoints])
+
+    def test_thread_dump(self):
+        # line 8: "sum += i * i;" in compute
+        self.pyjdb.set_breakpoint_at_line("PyjdbTest.java", 8)
+        self.pyjdb.resume()
+        time.sleep(2)
+        dump = self.pyjdb.thread_dump()
+        threads = dict((thread["name"], thread) for thread in dump["threads"])
+        self.assertIn("main", threads)
+        self.assertEqual("main", threads["main"]["thread_group"])
+        top_frame = threads["main"]["frames"][0]
+        self.assertEqual("LPyjdbTest;", top_frame["class_signature"])
+        self.assertEqual("compute", top_frame["method_name"])
+        self.assertEqual(8, top_frame["line_number"])
+        self.assertLess(dump["pause_time"], 1.0)
+        # stacks shallower than max_frames are dumped whole
+        main_frames = threads["main"]["frames"]
+        dump = self.pyjdb.thread_dump(max_frames=len(main_frames) + 10)
+        threads = dict((thread["name"], thread) for thread in dump["threads"])
+        self.assertEqual(main_frames, threads["main"]["frames"])
+        dump = self.pyjdb.thread_dump(max_frames=1)
+        threads = dict((thread["name"], thread) for thread in dump["threads"])
+        self.assertEqual(main_frames[:1], threads["main"]["frames"])
+
+    def test_conditional_breakpoint(self):
+        hits = []
+        seen = []
+
+        def predicate(local_values):
+            seen.append(local_values)
+            return local_values["i"] == 2
+        condition = pyjdb.BreakpointCondition(predicate=predicate,
+                local_names=["i"])
+        breakpoint = self.pyjdb.set_breakpoints([("PyjdbTest.java", 8)],
+                condition, lambda bp, event: hits.append(bp))[0]
+        self.pyjdb.resume()
+        time.sleep(4)
+        # the jvm stays suspended after the first hit passing the predicate
+        self.assertEqual([breakpoint], hits)
+        self.assertEqual({"i": 2}, seen[-1])
+        self.assertTrue(all(set(["i"]) == set(values) for values in seen))
+
+    def test_tracepoint(self):
+        tracepoint = self.pyjdb.set_tracepoint("PyjdbTest.java", 8,
+                ["i", "sum"], max_rate=1000)
+        self.pyjdb.resume()
+        time.sleep(4)
+        # the thread keeps running, so later calls of compute are traced too
+        records = list(tracepoint.records)
+        self.assertGreater(len(records), 3)
+        self.assertEqual(set(["i", "sum"]), set(records[-1]["locals"]))
+        self.assertEqual(len(records), len(tracepoint.pause_times))
+
+    def test_capture_snapshot(self):
+        self.pyjdb.set_breakpoint_at_line("PyjdbTest.java", 8)
+        self.pyjdb.resume()
+        time.sleep(2)
+        path = os.path.join(TEST_TMP_DIRNAME, "snapshot")
+        result = self.pyjdb.capture_snapshot(path)
+        self.assertLess(result["pause_time"], 1.0)
+        snap = snapshot.Snapshot(path)
+        main = [thread for thread in snap.threads()
+                if thread["name"] == "main"][0]
+        top_frame = snap.frames(main)[0]
+        self.assertEqual("compute", top_frame["method_name"])
+        self.assertEqual(set(["n", "sum", "i"]), set(
+                name for name, _, _ in snap.values(top_frame)))
+        snap.close()
+
+    def test_step(self):
+        threads = []
+        breakpoints = self.pyjdb.set_breakpoints([("PyjdbTest.java", 8)],
+                listener=lambda bp, event: threads.append(
+                        event["Breakpoint"]["thread"]))
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.pyjdb.clear_breakpoints(breakpoints)
+        # from "sum += i * i;" to the increment of the for loop
+        location = self.pyjdb.step_over(threads[0])
+        self.assertEqual(("compute", 7),
+                (location["method_name"], location["line_number"]))
+        # back in main, at "System.out.println(compute(n));"
+        location = self.pyjdb.step_out(threads[0])
+        self.assertEqual(("main", 16),
+                (location["method_name"], location["line_number"]))
+        # println and everything below it are excluded
+        location = self.pyjdb.step_into(threads[0], count=2)
+        self.assertEqual("main", location["method_name"])
+
+    def test_step_request_expires(self):
+        threads = []
+        breakpoints = self.pyjdb.set_breakpoints([("PyjdbTest.java", 8)],
+                listener=lambda bp, event: threads.append(
+                        event["Breakpoint"]["thread"]))
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.pyjdb.clear_breakpoints(breakpoints)
+        self.pyjdb.step_over(threads[0])
+        # resumed without resume(), as tracepoints do, the thread must not
+        # stop again on the step request
+        self.pyjdb.jdwp.ThreadReference.Resume({"thread": threads[0]})
+        time.sleep(1)
+        status = self.pyjdb.jdwp.ThreadReference.Status(
+                {"thread": threads[0]})
+        self.assertEqual(0, status["suspendStatus"])
+
+    def test_method_tracer(self):
+        self.pyjdb.method_tracer.start("PyjdbTest", ["java.*", "sun.*"])
+        self.pyjdb.resume()
+        time.sleep(2)
+        self.pyjdb.method_tracer.stop()
+        methods = dict((method["name"], method)
+                for method in self.pyjdb.method_tracer.method_stats())
+        self.assertGreater(methods["PyjdbTest.compute"]["calls"], 0)
+        self.assertEqual(0, self.pyjdb.jdwp.event_stats()["dropped"])
+
+    def test_shared_event_subscription(self):
+        jdwp = self.pyjdb.jdwp
+        modifiers = [{
+                "modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                "classPattern": "java.*"}]
+        first = self.pyjdb.subscriptions.subscribe(
+                jdwp.EventKind.EXCEPTION, modifiers)
+        second = self.pyjdb.subscriptions.subscribe(
+                jdwp.EventKind.EXCEPTION, modifiers)
+        self.assertEqual(first, second)
+        other = self.pyjdb.subscriptions.subscribe(jdwp.EventKind.EXCEPTION)
+        self.assertNotEqual(first, other)
+        self.pyjdb.subscriptions.unsubscribe(first)
+        self.pyjdb.subscriptions.unsubscribe(second)
+        self.pyjdb.subscriptions.unsubscribe(other)
+        # a fresh subscription after the last unsubscribe is a new request
+        self.assertNotEqual(first, self.pyjdb.subscriptions.subscribe(
+                jdwp.EventKind.EXCEPTION, modifiers))
+
+
+def line_table_reply(*entries):
+    """Returns a Method.LineTable reply for (code index, line number)
+    pairs"""
+    return {
+            "start": 0,
+            "end": max(entry[0] for entry in entries),
+            "lines": [{"lineCodeIndex": code_index, "lineNumber": line_number}
+                    for code_index, line_number in entries]}
+
+
+def line_table(*entries):
+    """Creates a pyjdb.LineTable from (code index, line number) pairs"""
+    return pyjdb.LineTable.create(line_table_reply(*entries))
+
+
+class LineIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = pyjdb.LineIndex()
+        # two methods of one class, with a gap (e.g., a comment) at line 12
+        self.index.add_line_table(1, 10,
+                line_table((0, 10), (4, 11), (9, 13), (12, 11)))
+        self.index.add_line_table(1, 20, line_table((0, 20), (3, 21)))
+
+    def test_next_line(self):
+        self.assertEqual(11, self.index.next_line(11))
+        self.assertEqual(13, self.index.next_line(12))
+        self.assertEqual(20, self.index.next_line(14))
+        self.assertEqual(10, self.index.next_line(1))
+        self.assertEqual(None, self.index.next_line(22))
+
+    def test_locations(self):
+        self.assertEqual([(1, 10, 4), (1, 10, 12)], self.index.locations(11))
+        self.assertEqual([(1, 10, 4)], self.index.breakpoint_locations(11))
+        self.assertEqual([], self.index.locations(12))
+
+    def test_range_queries(self):
+        self.assertEqual([11, 13, 20], self.index.lines_in_range(11, 20))
+        self.assertEqual([(1, 10, 9), (1, 20, 0)],
+                self.index.locations_in_range(12, 20))
+
+    def test_remove_class(self):
+        self.index.add_line_table(2, 30, line_table((0, 12)))
+        self.assertEqual(12, self.index.next_line(12))
+        self.index.remove_class(2)
+        self.assertEqual(13, self.index.next_line(12))
+        self.assertEqual(6, len(self.index))
+
+
+class ClassInfoTest(unittest.TestCase):
+    def test_line_tables_are_shared(self):
+        interner = pyjdb.Interner()
+        first = interner.line_table(line_table_reply((0, 5), (3, 6)))
+        self.assertIs(first,
+                interner.line_table(line_table_reply((3, 6), (0, 5))))
+        self.assertIsNot(first,
+                interner.line_table(line_table_reply((0, 5), (4, 6))))
+        self.assertEqual(None, first.line_for_code_index(-1))
+        self.assertEqual(5, first.line_for_code_index(2))
+        self.assertEqual(6, first.line_for_code_index(3))
+        interner.clear()
+        self.assertIsNot(first,
+                interner.line_table(line_table_reply((0, 5), (3, 6))))
+
+    def test_method_strings_are_interned(self):
+        entry = {
+                "methodID": 1,
+                "name": u"toString",
+                "signature": u"()Ljava/lang/String;",
+                "genericSignature": u"",
+                "modBits": 1}
+        interner = pyjdb.Interner()
+        first = pyjdb.MethodInfo(entry, interner)
+        # an equal but distinct string object, as a second decode would give
+        second = pyjdb.MethodInfo(dict(entry, methodID=2,
+                name=u"".join([u"to", u"String"])), interner)
+        self.assertIs(first.name, second.name)
+        self.assertIs(first.signature, second.signature)
+        self.assertEqual(None, first.generic_signature)
+        self.assertEqual(2, interner.stats()["strings"])
+
+
+class SourceIndexTest(unittest.TestCase):
+    def test_source_path(self):
+        self.assertEqual("com/foo/Foo.java",
+                pyjdb.source_path("Lcom/foo/Foo$Inner$1;", "Foo.java"))
+        self.assertEqual("com/foo/Foo.java",
+                pyjdb.source_path("Lcom/foo/Foo$$Lambda$1/0x10;", "Foo.java"))
+        self.assertEqual("Foo.java", pyjdb.source_path("LFoo;", "Foo.java"))
+        self.assertEqual("Lcom/foo/Foo;",
+                pyjdb.outer_class_signature("Lcom/foo/Foo$$Lambda$1/0x10;"))
+
+    def test_resolve(self):
+        index = pyjdb.SourceIndex()
+        index.add("com/foo/Foo.java", 1)
+        index.add("com/foo/Foo.java", 2)
+        index.add("com/foo/Bar.java", 3)
+        index.add("com/bar/Bar.java", 4)
+        self.assertEqual(set([1, 2]), index.class_ids("com/foo/Foo.java"))
+        self.assertEqual("com/foo/Foo.java", index.resolve("Foo.java"))
+        self.assertEqual("com/bar/Bar.java", index.resolve("com/bar/Bar.java"))
+        self.assertEqual(None, index.resolve("Baz.java"))
+        self.assertRaises(pyjdb.Error, index.resolve, "Bar.java")
+        self.assertEqual(["com/bar/Bar.java", "com/foo/Bar.java"],
+                index.paths("Bar.java"))
+        self.assertEqual([], index.paths("com/baz/Bar.java"))
+        index.remove("com/bar/Bar.java", 4)
+        self.assertEqual("com/foo/Bar.java", index.resolve("Bar.java"))
+
+
+def class_info(type_id, signature, path, *line_tables):
+    """Creates a pyjdb.ClassInfo with one method per line table"""
+    interner = pyjdb.Interner()
+    cls = pyjdb.ClassInfo(type_id, signature, 1, interner)
+    cls.source_file = path.rsplit("/", 1)[-1]
+    cls.source_path = path
+    methods = []
+    for method_id, table in enumerate(line_tables):
+        method = pyjdb.MethodInfo({
+                "methodID": method_id,
+                "name": u"m%d" % method_id,
+                "signature": u"()V",
+                "genericSignature": u"",
+                "modBits": 1}, interner)
+        method.line_table = table
+        methods.append(method)
+    cls.methods = tuple(methods)
+    return cls
+
+
+class ClassModelTest(unittest.TestCase):
+    def test_add_and_remove(self):
+        model = pyjdb.ClassModel()
+        model.add(class_info(1, "Lcom/foo/Foo;", "com/foo/Foo.java",
+                line_table((0, 10), (4, 12))))
+        model.add(class_info(2, "Lcom/foo/Foo$1;", "com/foo/Foo.java",
+                line_table((0, 20))))
+        self.assertEqual("com/foo/Foo.java", model.resolve("Foo.java"))
+        self.assertEqual([(1, 0, 4)],
+                model.breakpoint_locations("com/foo/Foo.java", 11))
+        self.assertEqual([],
+                model.breakpoint_locations("com/foo/Foo.java", 21))
+        self.assertEqual([], model.breakpoint_locations(None, 1))
+        # re-adding a class replaces its lines rather than duplicating them
+        model.add(class_info(2, "Lcom/foo/Foo$1;", "com/foo/Foo.java",
+                line_table((0, 20))))
+        self.assertEqual(3, len(model.line_index["com/foo/Foo.java"]))
+        model.remove("Lcom/foo/Foo$1;")
+        self.assertEqual(2, len(model.line_index["com/foo/Foo.java"]))
+        self.assertEqual(None, model.get(2))
+        self.assertEqual(1, model.get_by_signature("Lcom/foo/Foo;").type_id)
+
+    def test_unload_releases_strings(self):
+        model = pyjdb.ClassModel()
+        for cls in [
+                class_info(1, "Lcom/foo/Foo;", "com/foo/Foo.java",
+                    line_table((0, 10))),
+                class_info(2, "Lcom/foo/Foo$1;", "com/foo/Foo.java",
+                    line_table((0, 20)))]:
+            for value in cls.strings():
+                model.interner.string(value)
+            model.add(cls)
+        # two signatures, file name, path, method name and signature
+        self.assertEqual(6, model.interner.stats()["strings"])
+        model.remove("Lcom/foo/Bar;")
+        self.assertEqual(6, model.interner.stats()["strings"])
+        # strings the other class still uses stay
+        model.remove("Lcom/foo/Foo$1;")
+        self.assertEqual(5, model.interner.stats()["strings"])
+        model.remove("Lcom/foo/Foo;")
+        self.assertEqual(0, model.interner.stats()["strings"])
+        model.interner.string(u"Lcom/foo/Foo;")
+        model.clear()
+        self.assertEqual({"strings": 0, "line_tables": 0},
+                model.interner.stats())
+        self.assertEqual({}, model.classes_by_id)
+
+
+
+JDWP_SPEC = []
+
+
+def jdwp_spec():
+    """Returns the jdwp spec of CannedJdwp, with 8 byte IDs; parsed once"""
+    if not JDWP_SPEC:
+        JDWP_SPEC.append(pyjdwp.JdwpSpec(7, dict((name, 8) for name in [
+                "fieldIDSize", "methodIDSize", "objectIDSize",
+                "referenceTypeIDSize", "frameIDSize"])))
+    return JDWP_SPEC[0]
+
+
+class CannedReply(object):
+    """A pyjdwp.PendingReply that is already in, or that failed with a jdwp
+    error code"""
+
+    def __init__(self, reply, error=None):
+        self.reply = reply
+        self.error = error
+
+    def wait(self):
+        if self.error is not None:
+            raise pyjdwp.Error("JDWP error: %d" % self.error)
+
+    def get(self):
+        self.wait()
+        return self.reply
+
+
+class CannedJdwp(object):
+    """Stands in for a connected pyjdwp.Jdwp, answering requests from canned
+    jvm state: classes, threads and their stacks, objects, strings and event
+    requests. Command sets, constants and ID sizes come from the real jdwp
+    spec, and like a jvm, requests fail with the errors the spec documents:
+    INVALID_CLASS for types that are not loaded, INVALID_METHODID and
+    INVALID_FIELDID for members a type or object does not have,
+    ABSENT_INFORMATION for missing source files and line tables,
+    INVALID_THREAD for dead threads, THREAD_NOT_SUSPENDED for the stacks of
+    running threads, INVALID_INDEX and INVALID_LENGTH for frames or array
+    elements out of range, and INVALID_OBJECT for collected objects.
+
+    Every request is logged in requests as a (command set, command, data)
+    tuple; on_set, if set, is called from EventRequest.Set with the new
+    request's ID before it returns.
+    """
+
+    def __init__(self):
+        self.jdwp_spec = jdwp_spec()
+        for name, command_set in self.jdwp_spec.command_sets.iteritems():
+            setattr(self, name, pyjdwp.GenericService(self, command_set))
+        for name, constant_set in self.jdwp_spec.constant_sets.iteritems():
+            setattr(self, name, pyjdwp.GenericConstantSet(constant_set))
+        self.__lock = threading.Lock()
+        self.requests = []
+        # the data lists of command_requests calls
+        self.batches = []
+        self.classes = {}
+        self.threads = {}
+        self.objects = {}
+        self.referrers = {}
+        self.strings = {}
+        self.event_requests = {}
+        self.next_request_id = 1
+        self.on_set = None
+        self.event_cbs = {}
+        self.raw_event_cbs = {}
+        self.__handlers = {
+            ("VirtualMachine", "AllClasses"): self.__all_classes,
+            ("VirtualMachine", "Suspend"): self.__suspend_all,
+            ("VirtualMachine", "Resume"): self.__resume_all,
+            ("VirtualMachine", "InstanceCounts"): self.__instance_counts,
+            ("ReferenceType", "Signature"): self.__signature,
+            ("ReferenceType", "Modifiers"): self.__modifiers,
+            ("ReferenceType", "Fields"): self.__fields,
+            ("ReferenceType", "FieldsWithGeneric"): self.__fields,
+            ("ReferenceType", "MethodsWithGeneric"): self.__methods,
+            ("ReferenceType", "SourceFile"): self.__source_file,
+            ("ClassType", "Superclass"): self.__superclass,
+            ("Method", "LineTable"): self.__line_table,
+            ("ObjectReference", "ReferenceType"): self.__reference_type,
+            ("ObjectReference", "GetValues"): self.__object_values,
+            ("ObjectReference", "ReferringObjects"): self.__referring_objects,
+            ("StringReference", "Value"): self.__string_value,
+            ("ThreadReference", "Name"): self.__thread_name,
+            ("ThreadReference", "Suspend"): self.__suspend,
+            ("ThreadReference", "Resume"): self.__resume,
+            ("ThreadReference", "Status"): self.__thread_status,
+            ("ThreadReference", "ThreadGroup"): self.__thread_group,
+            ("ThreadReference", "Frames"): self.__frames,
+            ("ThreadReference", "FrameCount"): self.__frame_count,
+            ("ArrayReference", "Length"): self.__array_length,
+            ("ArrayReference", "GetValues"): self.__array_values,
+            ("EventRequest", "Set"): self.__set_event_request,
+            ("EventRequest", "Clear"): self.__clear_event_request,
+        }
+
+    def add_class(self, type_id, signature, source_file=None, methods=(),
+            fields=(), superclass=0, instances=0):
+        """Loads a class. methods are (method ID, name, signature, line
+        table) tuples, with (code index, line number) pairs or None for the
+        line table; fields are (field ID, name) pairs of instance fields."""
+        self.classes[type_id] = {
+                "signature": signature,
+                "source_file": source_file,
+                "methods": list(methods),
+                "fields": list(fields),
+                "superclass": superclass,
+                "instances": instances}
+
+    def add_thread(self, thread_id, name=None, status=None, frames=(),
+            suspended=False):
+        """Starts a thread, named t<ID> by default; frames are (class ID,
+        method ID, code index) tuples, top of stack first"""
+        self.threads[thread_id] = {
+                "name": name or u"t%d" % thread_id,
+                "status": status or self.ThreadStatus.RUNNING,
+                "frames": list(frames),
+                "suspend_count": int(suspended)}
+
+    def add_object(self, object_id, type_id, values=None, elements=None):
+        """Allocates an instance of type_id, values mapping its field IDs to
+        (tag, value) pairs, or, with elements, an array of (tag, value)
+        pairs"""
+        self.objects[object_id] = {
+                "type_id": type_id,
+                "values": values or {},
+                "elements": elements}
+
+    def commands(self):
+        """Returns the commands requested so far as "<set>.<command>" """
+        return ["%s.%s" % (command_set_name, command_name)
+                for command_set_name, command_name, _ in self.requests]
+
+    def sent(self, command):
+        """Returns the data of the requests for command, "<set>.<command>" """
+        return [data for command_set_name, command_name, data
+                in self.requests
+                if "%s.%s" % (command_set_name, command_name) == command]
+
+    def command_request(self, command_set_name, command_name, data):
+        return self.command_request_async(
+                command_set_name, command_name, data).get()
+
+    def command_request_async(self, command_set_name, command_name, data):
+        self.jdwp_spec.lookup_command(command_set_name, command_name)
+        self.requests.append((command_set_name, command_name, data))
+        return self.__handlers[(command_set_name, command_name)](data)
+
+    def command_requests(self, command_set_name, command_name, data_list):
+        self.batches.append(data_list)
+        return pyjdb.get_replies([self.command_request_async(
+                command_set_name, command_name, data) for data in data_list])
+
+    def register_event_callback(self, event_cb, event_kind=None,
+            request_id=None):
+        self.event_cbs.setdefault(event_kind, []).append(event_cb)
+
+    def unregister_event_callback(self, event_cb, event_kind=None,
+            request_id=None):
+        self.event_cbs[event_kind].remove(event_cb)
+
+    def register_raw_event_callback(self, event_cb, request_id):
+        self.raw_event_cbs[request_id] = event_cb
+
+    def unregister_raw_event_callback(self, request_id):
+        self.raw_event_cbs.pop(request_id, None)
+
+    def send_event(self, event_kind, name, data, suspend_policy=None):
+        """Sends a composite with one event_kind event, whose kind-specific
+        payload is data under name (e.g., "ClassPrepare")"""
+        if suspend_policy is None:
+            suspend_policy = self.SuspendPolicy.EVENT_THREAD
+        event_list = {"suspendPolicy": suspend_policy, "events": [{
+                "eventKind": event_kind, name: data}],
+                "received": time.time()}
+        for event_cb in list(self.event_cbs.get(None, [])) + \
+                list(self.event_cbs.get(event_kind, [])):
+            event_cb(event_list)
+
+    def send_raw_event(self, request_id, payload, offset, received):
+        self.raw_event_cbs[request_id](payload, offset, received)
+
+    def __error(self, name):
+        return CannedReply(None, getattr(self.Error, name))
+
+    def __all_classes(self, data):
+        return CannedReply({"classes": [{
+                "refTypeTag": self.TypeTag.CLASS,
+                "typeID": type_id,
+                "signature": cls["signature"],
+                "status": self.ClassStatus.INITIALIZED}
+                for type_id, cls in sorted(self.classes.iteritems())]})
+
+    def __suspend_all(self, data):
+        for thread in self.threads.itervalues():
+            thread["suspend_count"] += 1
+        return CannedReply({})
+
+    def __resume_all(self, data):
+        for thread in self.threads.itervalues():
+            thread["suspend_count"] = max(thread["suspend_count"] - 1, 0)
+        return CannedReply({})
+
+    def __instance_counts(self, data):
+        type_ids = [entry["refType"] for entry in data["refTypesCount"]]
+        if not all(type_id in self.classes for type_id in type_ids):
+            return self.__error("INVALID_CLASS")
+        return CannedReply({"counts": [{
+                "instanceCount": self.classes[type_id]["instances"]}
+                for type_id in type_ids]})
+
+    def __class_reply(self, type_id, reply):
+        """Returns reply(cls) for a loaded class, or INVALID_CLASS"""
+        if type_id not in self.classes:
+            return self.__error("INVALID_CLASS")
+        return reply(self.classes[type_id])
+
+    def __signature(self, data):
+        return self.__class_reply(data["refType"], lambda cls: CannedReply(
+                {"signature": cls["signature"]}))
+
+    def __modifiers(self, data):
+        return self.__class_reply(data["refType"], lambda cls: CannedReply(
+                {"modBits": pyjdwp.ACCESS_MODIFIER_PUBLIC}))
+
+    def __fields(self, data):
+        return self.__class_reply(data["refType"], lambda cls: CannedReply(
+                {"declared": [{
+                    "fieldID": field_id,
+                    "name": name,
+                    "signature": u"Ljava/lang/Object;",
+                    "genericSignature": u"",
+                    "modBits": 0}
+                    for field_id, name in cls["fields"]]}))
+
+    def __methods(self, data):
+        return self.__class_reply(data["refType"], lambda cls: CannedReply(
+                {"declared": [{
+                    "methodID": method_id,
+                    "name": name,
+                    "signature": signature,
+                    "genericSignature": u"",
+                    "modBits": pyjdwp.ACCESS_MODIFIER_PUBLIC}
+                    for method_id, name, signature, _ in cls["methods"]]}))
+
+    def __source_file(self, data):
+        return self.__class_reply(data["refType"], lambda cls: CannedReply(
+                {"sourceFile": cls["source_file"]}) if cls["source_file"]
+                else self.__error("ABSENT_INFORMATION"))
+
+    def __superclass(self, data):
+        return self.__class_reply(data["clazz"], lambda cls: CannedReply(
+                {"superclass": cls["superclass"]}))
+
+    def __line_table(self, data):
+        def reply(cls):
+            lines = dict((method_id, lines) for method_id, _, _, lines
+                    in cls["methods"])
+            if data["methodID"] not in lines:
+                return self.__error("INVALID_METHODID")
+            if lines[data["methodID"]] is None:
+                return self.__error("ABSENT_INFORMATION")
+            return CannedReply(line_table_reply(*lines[data["methodID"]]))
+        return self.__class_reply(data["refType"], reply)
+
+    def __reference_type(self, data):
+        obj = self.objects.get(data["object"])
+        if obj is None:
+            return self.__error("INVALID_OBJECT")
+        return CannedReply({
+                "refTypeTag": self.TypeTag.CLASS
+                        if obj["elements"] is None else self.TypeTag.ARRAY,
+                "typeID": obj["type_id"]})
+
+    def __object_values(self, data):
+        obj = self.objects.get(data["object"])
+        if obj is None:
+            return self.__error("INVALID_OBJECT")
+        field_ids = [field["fieldID"] for field in data["fields"]]
+        if not all(field_id in obj["values"] for field_id in field_ids):
+            return self.__error("INVALID_FIELDID")
+        return CannedReply({"values": [{"value": {
+                "typeTag": obj["values"][field_id][0],
+                "value": obj["values"][field_id][1]}}
+                for field_id in field_ids]})
+
+    def __referring_objects(self, data):
+        if self.objects.get(data["object"]) is None:
+            return self.__error("INVALID_OBJECT")
+        return CannedReply({"referringObjects": [
+                {"instance": {"typeTag": "L", "objectID": object_id}}
+                for object_id in self.referrers.get(data["object"], [])]})
+
+    def __string_value(self, data):
+        if data["stringObject"] not in self.strings:
+            return self.__error("INVALID_OBJECT")
+        return CannedReply({"stringValue": self.strings[data["stringObject"]]})
+
+    def __array(self, data):
+        obj = self.objects.get(data["arrayObject"])
+        if obj is None or obj["elements"] is None:
+            return None
+        return obj["elements"]
+
+    def __array_length(self, data):
+        elements = self.__array(data)
+        if elements is None:
+            return self.__error("INVALID_OBJECT")
+        return CannedReply({"arrayLength": len(elements)})
+
+    def __array_values(self, data):
+        elements = self.__array(data)
+        if elements is None:
+            return self.__error("INVALID_OBJECT")
+        first, length = data["firstIndex"], data["length"]
+        if not 0 <= first <= len(elements):
+            return self.__error("INVALID_INDEX")
+        if length < 0 or first + length > len(elements):
+            return self.__error("INVALID_LENGTH")
+        # object elements decode as (tag, object ID) pairs
+        return CannedReply({"values": [(ord(tag), value)
+                for tag, value in elements[first : first + length]]})
+
+    def __thread_reply(self, data, reply, suspended=False):
+        """Returns reply(thread) for a live thread, which must be suspended if
+        suspended is set"""
+        thread = self.threads.get(data["thread"])
+        if thread is None:
+            return self.__error("INVALID_THREAD")
+        if suspended and not thread["suspend_count"]:
+            return self.__error("THREAD_NOT_SUSPENDED")
+        return reply(thread)
+
+    def __thread_name(self, data):
+        return self.__thread_reply(data, lambda thread: CannedReply(
+                {"threadName": thread["name"]}))
+
+    def __thread_group(self, data):
+        return self.__thread_reply(data, lambda thread: CannedReply(
+                {"group": 1}))
+
+    def __thread_status(self, data):
+        return self.__thread_reply(data, lambda thread: CannedReply({
+                "threadStatus": thread["status"],
+                "suspendStatus": thread["suspend_count"] and
+                        self.SuspendStatus.SUSPEND_STATUS_SUSPENDED}))
+
+    def __suspend(self, data):
+        def reply(thread):
+            thread["suspend_count"] += 1
+            return CannedReply({})
+        return self.__thread_reply(data, reply)
+
+    def __resume(self, data):
+        def reply(thread):
+            thread["suspend_count"] = max(thread["suspend_count"] - 1, 0)
+            return CannedReply({})
+        return self.__thread_reply(data, reply)
+
+    def __frame_count(self, data):
+        return self.__thread_reply(data, lambda thread: CannedReply(
+                {"frameCount": len(thread["frames"])}), suspended=True)
+
+    def __frames(self, data):
+        def reply(thread):
+            frames = thread["frames"]
+            start, length = data["startFrame"], data["length"]
+            if length == -1:
+                length = len(frames) - start
+            if length == 0:
+                return CannedReply({"frames": []})
+            if not 0 <= start < len(frames):
+                return self.__error("INVALID_INDEX")
+            if length < 0 or start + length > len(frames):
+                return self.__error("INVALID_LENGTH")
+            # frame IDs are depths, and locations are inlined as decoded
+            return CannedReply({"frames": [{
+                    "frameID": depth,
+                    "typeTag": self.TypeTag.CLASS,
+                    "classID": frames[depth][0],
+                    "methodID": frames[depth][1],
+                    "index": frames[depth][2]}
+                    for depth in xrange(start, start + length)]})
+        return self.__thread_reply(data, reply, suspended=True)
+
+    def __set_event_request(self, data):
+        if data["eventKind"] not in self.EventKind.__dict__.values():
+            return self.__error("INVALID_EVENT_TYPE")
+        with self.__lock:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            self.event_requests[request_id] = data
+        if self.on_set is not None:
+            self.on_set(request_id)
+        return CannedReply({"requestID": request_id})
+
+    def __clear_event_request(self, data):
+        self.event_requests.pop(data["requestID"], None)
+        return CannedReply({})
+
+
+class EventSubscriptionsTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        self.subscriptions = pyjdb.EventSubscriptions(self.jdwp)
+        self.class_prepare = self.jdwp.EventKind.CLASS_PREPARE
+        self.event_thread = self.jdwp.SuspendPolicy.EVENT_THREAD
+
+    def send(self, request_id):
+        self.jdwp.send_event(self.class_prepare, "ClassPrepare",
+                {"requestID": request_id})
+
+    def test_events_before_set_returns(self):
+        calls = []
+        # the event overtakes the reply to EventRequest.Set
+        self.jdwp.on_set = self.send
+        request_id = self.subscriptions.subscribe(self.class_prepare, [],
+                self.event_thread,
+                lambda suspend_policy, event: calls.append(
+                        ("listener", event["ClassPrepare"]["requestID"])),
+                lambda request_id: calls.append(("on_set", request_id)))
+        self.assertEqual([("on_set", request_id), ("listener", request_id)],
+                calls)
+        self.jdwp.on_set = None
+        self.send(request_id)
+        self.assertEqual(("listener", request_id), calls[-1])
+        # events of requests nobody here set are not held on to
+        self.send(99)
+        self.assertEqual(3, len(calls))
+
+    def test_lock_not_held_while_setting(self):
+        other = []
+
+        def subscribe_other(request_id):
+            self.jdwp.on_set = None
+            thread = threading.Thread(target=lambda: other.append(
+                    self.subscriptions.subscribe(self.class_prepare, [],
+                            self.jdwp.SuspendPolicy.NONE)))
+            thread.start()
+            thread.join(2)
+        self.jdwp.on_set = subscribe_other
+        first = self.subscriptions.subscribe(self.class_prepare, [],
+                self.event_thread)
+        self.assertEqual([first + 1], other)
+        # the same request is shared, not set again
+        self.assertEqual(first, self.subscriptions.subscribe(
+                self.class_prepare, [], self.event_thread))
+        self.assertEqual(2, len(self.jdwp.event_requests))
+
+    def test_unsubscribe_clears_request(self):
+        request_id = self.subscriptions.subscribe(self.class_prepare)
+        self.subscriptions.subscribe(self.class_prepare)
+        self.subscriptions.unsubscribe(request_id)
+        self.assertIn(request_id, self.jdwp.event_requests)
+        self.subscriptions.unsubscribe(request_id)
+        self.assertEqual({}, self.jdwp.event_requests)
+
+
+class MetadataPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        run = [(1, u"run", u"()V", [(0, 7)])]
+        self.jdwp.add_class(1, u"LFoo;", u"Foo.java", run)
+        self.jdwp.add_class(2, u"LFoo$$Lambda$1;", None, run)
+
+    def test_fetch(self):
+        installed = []
+        pipeline = pyjdb.MetadataPipeline(self.jdwp, installed.append,
+                pyjdb.Interner())
+        pipeline.fetch([
+                {"typeID": 2, "signature": "LFoo$$Lambda$1;", "refTypeTag": 1},
+                {"typeID": 1, "signature": "LFoo;", "refTypeTag": 1},
+                {"typeID": 3, "signature": "LGone;", "refTypeTag": 1}])
+        # the class without source info is installed after its outer class,
+        # the unloaded one not at all
+        self.assertEqual([1, 2], [cls.type_id for cls in installed])
+        self.assertEqual(7, installed[0].methods[0].line_table.lines[0])
+        self.assertEqual(None, installed[1].methods[0].line_table)
+        # all metadata requests are sent before any line table request
+        self.assertEqual(["Method.LineTable"],
+                list(set(self.jdwp.commands()[3 * 4 :])))
+
+    def test_queued_classes_are_coalesced(self):
+        done = threading.Event()
+        pipeline = pyjdb.MetadataPipeline(self.jdwp, lambda cls: None,
+                pyjdb.Interner())
+        entry = {"typeID": 1, "signature": "LFoo;", "refTypeTag": 1}
+        pipeline.enqueue(entry)
+        pipeline.enqueue(entry, done.set)
+        pipeline.start()
+        self.assertTrue(done.wait(5))
+        pipeline.stop()
+        self.assertEqual(1, pipeline.stats()["classes"])
+        self.assertEqual(5, len(self.jdwp.requests))
+
+
+
+class ThreadModelTest(unittest.TestCase):
+    def test_threads_are_fetched_lazily(self):
+        jdwp = CannedJdwp()
+        jdwp.add_thread(1)
+        jdwp.add_thread(2)
+        model = pyjdb.ThreadModel(jdwp)
+        for thread_id in [1, 2, 3]:
+            model.add(thread_id)
+        self.assertEqual([], jdwp.requests)
+        self.assertEqual(u"t1", model.get(1)["name"])
+        self.assertEqual(3, len(jdwp.requests))
+        # thread 3 is dead and dropped
+        self.assertEqual([1, 2], sorted(model.get_all()))
+        self.assertNotIn(3, model)
+        del jdwp.requests[:]
+        model.get_all()
+        self.assertEqual([], jdwp.requests)
+        # after a resume only the status is fetched again
+        model.mark_stale()
+        self.assertTrue(model.threads[1]["stale"])
+        self.assertFalse(model.get(1)["stale"])
+        self.assertEqual(["ThreadReference.Status"], jdwp.commands())
+
+
+
+class StackTest(unittest.TestCase):
+    def test_frames_are_fetched_in_pages(self):
+        jdwp = CannedJdwp()
+        jdwp.add_thread(1, frames=[(1, 1, depth) for depth in xrange(45)],
+                suspended=True)
+        stack = pyjdb.Stack(jdwp, 1, page_size=20)
+        self.assertEqual(45, len(stack))
+        self.assertEqual(0, stack[0]["frameID"])
+        self.assertEqual(44, stack[-1]["frameID"])
+        self.assertEqual(["ThreadReference.FrameCount",
+                "ThreadReference.Frames", "ThreadReference.Frames"],
+                jdwp.commands())
+        self.assertEqual([(0, 20), (40, 5)], [(data["startFrame"],
+                data["length"]) for data in jdwp.sent(
+                        "ThreadReference.Frames")])
+        self.assertEqual([18, 19, 20], [frame["frameID"]
+                for frame in stack[18:21]])
+        stack.prefetch(100)
+        self.assertEqual(4, len(jdwp.requests))
+        self.assertEqual(range(45), [frame["frameID"] for frame in stack])
+        self.assertRaises(IndexError, lambda: stack[45])
+        stack.invalidate()
+        self.assertEqual(0, stack[0]["frameID"])
+        self.assertEqual(6, len(jdwp.requests))
+
+    def test_running_thread(self):
+        jdwp = CannedJdwp()
+        jdwp.add_thread(1, frames=[(1, 1, 0)])
+        self.assertRaises(pyjdwp.Error, len, pyjdb.Stack(jdwp, 1))
+
+
+
+class ValueCacheTest(unittest.TestCase):
+    def test_values_are_cached_per_epoch(self):
+        jdwp = CannedJdwp()
+        jdwp.add_class(1, u"LFoo;", fields=[(1, u"a"), (2, u"b"), (3, u"c")])
+        jdwp.add_object(10, 1, {1: ("I", 1), 2: ("I", 2), 3: ("I", 3)})
+        cache = pyjdb.ValueCache(jdwp)
+        self.assertEqual([1, 2], [value["value"]
+                for value in cache.object_values(10, [1, 2])])
+        self.assertEqual([2, 3], [value["value"]
+                for value in cache.object_values(10, [2, 3])])
+        # only the field we had not read yet was fetched
+        self.assertEqual([[1, 2], [3]], self.fetched(jdwp))
+        cache.bump()
+        cache.object_values(10, [1])
+        self.assertEqual([[1, 2], [3], [1]], self.fetched(jdwp))
+        self.assertEqual({"hits": 1, "misses": 4, "size": 1}, cache.stats())
+
+    def fetched(self, jdwp):
+        return [[field["fieldID"] for field in data["fields"]]
+                for data in jdwp.sent("ObjectReference.GetValues")]
+
+
+
+class StringCacheTest(unittest.TestCase):
+    def test_misses_are_batched(self):
+        jdwp = CannedJdwp()
+        # string 4 was collected
+        jdwp.strings.update((string_id, u"s%d" % string_id)
+                for string_id in [1, 2, 3, 5])
+        cache = pyjdb.StringCache(jdwp, max_entries=3)
+        self.assertEqual([u"s1", u"s2", u"s1", None],
+                cache.get_all([1, 2, 1, 4]))
+        self.assertEqual([u"s2", u"s3"], cache.get_all([2, 3]))
+        self.assertEqual([[1, 2, 4], [3]], self.batches(jdwp))
+        # 1 is the least recently used and goes first
+        cache.get(5)
+        cache.get(1)
+        self.assertEqual([1], self.batches(jdwp)[-1])
+        cache.invalidate([5])
+        self.assertEqual(2, len(cache))
+
+    def batches(self, jdwp):
+        return [sorted(data["stringObject"] for data in batch)
+                for batch in jdwp.batches]
+
+
+
+class IdSetTest(unittest.TestCase):
+    def test_add_and_contains(self):
+        ids = pyjdb.IdSet(capacity=4)
+        values = [1 << 40 | n * 8 for n in range(1, 5000)]
+        self.assertTrue(all(ids.add(value) for value in values))
+        self.assertFalse(ids.add(values[17]))
+        self.assertEqual(len(values), len(ids))
+        self.assertTrue(all(value in ids for value in values))
+        self.assertNotIn(3, ids)
+        self.assertEqual(set(values), set(ids))
+
+
+class HeapWalkerTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        # type 20 extends type 10
+        self.jdwp.add_class(10, u"LFoo;", fields=[(100, u"items")])
+        self.jdwp.add_class(20, u"LBar;", fields=[(200, u"size")],
+                superclass=10)
+
+    def test_referrers(self):
+        for object_id in [1, 2, 3, 4]:
+            self.jdwp.add_object(object_id, 10, {100: ("L", 0)})
+        self.jdwp.referrers.update({1: [2, 3], 2: [4, 1], 3: [4]})
+        walker = pyjdb.HeapWalker(self.jdwp, pyjdb.InstanceFields(self.jdwp),
+                max_in_flight=2)
+        self.assertEqual([
+                (1, "L", 0, None, None),
+                (2, "L", 1, 1, None),
+                (3, "L", 1, 1, None),
+                (4, "L", 2, 2, None)],
+                list(walker.referrers([(1, "L")])))
+        self.assertEqual([1, 2], [node[0] for node in
+                walker.referrers([(1, "L")], max_nodes=2)])
+        self.assertEqual([1, 2, 3], [node[0] for node in
+                walker.referrers([(1, "L")], max_depth=1)])
+
+    def test_references(self):
+        # object 1 holds an array of 2 and 3 in its inherited field and an
+        # int in its own
+        self.jdwp.add_object(1, 20, {100: ("[", 5), 200: ("I", 7)})
+        self.jdwp.add_object(5, 30, elements=[("L", 2), ("L", 0), ("L", 3)])
+        self.jdwp.add_object(2, 10, {100: ("L", 1)})
+        self.jdwp.add_object(3, 10, {100: ("L", 0)})
+        walker = pyjdb.HeapWalker(self.jdwp, pyjdb.InstanceFields(self.jdwp))
+        self.assertEqual([
+                (1, "L", 0, None, None),
+                (5, "[", 1, 1, "items"),
+                (2, "L", 2, 5, 0),
+                (3, "L", 2, 5, 2)],
+                list(walker.references([(1, "L")])))
+
+
+class HeapHistogramTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        for type_id in [1, 2, 3]:
+            self.jdwp.add_class(type_id, u"LC%d;" % type_id,
+                    instances=type_id * 10)
+
+    def counted(self):
+        """Returns the type IDs of each InstanceCounts request"""
+        return [[entry["refType"] for entry in data["refTypesCount"]]
+                for data in self.jdwp.sent("VirtualMachine.InstanceCounts")]
+
+    def test_samples_and_diffs(self):
+        histogram = pyjdb.HeapHistogram(self.jdwp, chunk_size=2)
+        _, first = histogram.sample([1, 2])
+        self.assertEqual([[1, 2]], self.counted())
+        self.jdwp.classes[1]["instances"] = 5
+        self.jdwp.classes[2]["instances"] = 26
+        # type 4 was unloaded: its chunk is retried a type at a time
+        _, second = histogram.sample([3, 4, 2, 1])
+        self.assertEqual([[1, 2], [3, 4], [2, 1], [3], [4]], self.counted())
+        self.assertEqual([1, 2, 3, 4], list(histogram.type_ids))
+        self.assertEqual([10, 20], list(first))
+        self.assertEqual([5, 26, 30, 0], list(second))
+        delta = histogram.diff(first, second)
+        self.assertEqual([-5, 6, 30, 0], list(delta))
+        self.assertEqual([(3, 30), (2, 6)], histogram.top(delta, 2))
+        self.assertEqual(2, len(histogram.samples))
+
+    def test_samples_all_loaded_types_by_default(self):
+        histogram = pyjdb.HeapHistogram(self.jdwp, chunk_size=2)
+        _, counts = histogram.sample()
+        self.assertEqual("VirtualMachine.AllClasses", self.jdwp.commands()[0])
+        self.assertEqual([[1, 2], [3]], self.counted())
+        self.assertEqual([10, 20, 30], list(counts))
+        # a type loaded since is picked up by the next sample
+        self.jdwp.add_class(4, u"LC4;", instances=40)
+        _, counts = histogram.sample()
+        self.assertEqual([10, 20, 30, 40], list(counts))
+
+
+class CannedSymbolTable(object):
+    """Symbolizes code index i of method m of class c as C<c>.m<m>:<i>"""
+
+    def __init__(self):
+        self.symbolized = []
+
+    def symbolize(self, locations):
+        locations = list(locations)
+        self.symbolized.extend(locations)
+        return [{
+                "class_signature": "LC%d;" % location["classID"],
+                "method_name": "m%d" % location["methodID"],
+                "line_number": location["index"]}
+                for location in locations]
+
+
+class ProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        self.jdwp.add_thread(1, frames=[(1, 2, 7), (1, 1, 3)])
+        self.jdwp.add_thread(2, frames=[(1, 1, 3)])
+        self.jdwp.add_thread(3, status=self.jdwp.ThreadStatus.SLEEPING,
+                frames=[(2, 1, 1)])
+        self.thread_model = pyjdb.ThreadModel(self.jdwp)
+        for thread_id in [1, 2, 3]:
+            self.thread_model.add(thread_id)
+        self.symbol_table = CannedSymbolTable()
+
+    def profiler(self, **kwargs):
+        return pyjdb.Profiler(self.jdwp, self.thread_model,
+                self.symbol_table, pyjdb.ValueCache(self.jdwp), **kwargs)
+
+    def test_samples_running_threads(self):
+        profiler = self.profiler()
+        profiler.sample()
+        profiler.sample()
+        commands = self.jdwp.commands()
+        self.assertEqual("VirtualMachine.Suspend", commands[0])
+        self.assertEqual("VirtualMachine.Resume", commands[9])
+        self.assertEqual(["C1.m1:3 2", "C1.m1:3;C1.m2:7 2"],
+                profiler.folded())
+        tree = profiler.call_tree()
+        self.assertEqual(4, tree["count"])
+        caller = tree["children"]["C1.m1:3"]
+        self.assertEqual((4, 2), (caller["count"], caller["self_count"]))
+        self.assertEqual(2, caller["children"]["C1.m2:7"]["count"])
+        # each location is symbolized once
+        self.assertEqual(2, len(self.symbol_table.symbolized))
+        # and every thread is running again
+        self.assertEqual([0, 0, 0], [thread["suspend_count"]
+                for _, thread in sorted(self.jdwp.threads.iteritems())])
+
+    def test_selected_threads(self):
+        profiler = self.profiler()
+        profiler.sample([2])
+        self.assertEqual(["ThreadReference.Suspend", "ThreadReference.Status",
+                "ThreadReference.FrameCount", "ThreadReference.Frames",
+                "ThreadReference.Resume"], self.jdwp.commands())
+        self.assertEqual(["C1.m1:3 1"], profiler.folded())
+
+    def test_frames_are_limited_to_stack_depth(self):
+        profiler = self.profiler(max_frames=1)
+        profiler.sample()
+        self.assertEqual(["C1.m1:3 1", "C1.m2:7 1"], profiler.folded())
+        profiler = self.profiler(max_frames=-1)
+        profiler.sample()
+        self.assertEqual(["C1.m1:3 1", "C1.m1:3;C1.m2:7 1"],
+                profiler.folded())
+
+    def test_pause_budget(self):
+        profiler = self.profiler(max_pause=-1, threads_per_sample=4)
+        profiler.sample()
+        profiler.sample()
+        stats = profiler.stats()
+        self.assertEqual(2, stats["over_budget"])
+        self.assertEqual(1, stats["threads_per_sample"])
+        # all three threads, then the first two
+        self.assertEqual(4, stats["stacks"])
+        self.assertEqual(["VirtualMachine.Suspend",
+                "ThreadReference.Status", "ThreadReference.FrameCount",
+                "ThreadReference.Status", "ThreadReference.FrameCount",
+                "ThreadReference.Frames", "ThreadReference.Frames",
+                "VirtualMachine.Resume"], self.jdwp.commands()[10:])
+
+
+class CallRingTest(unittest.TestCase):
+    def test_overwrites_oldest(self):
+        ring = pyjdb.CallRing(3)
+        for n in range(5):
+            ring.add(float(n), 1, 100, 1000 + n, n % 2)
+        self.assertEqual(3, len(ring))
+        self.assertEqual(2, ring.overwritten())
+        self.assertEqual([(2.0, 1, 100, 1002, False),
+                (3.0, 1, 100, 1003, True), (4.0, 1, 100, 1004, False)],
+                ring.records())
+        ring.clear()
+        self.assertEqual([], ring.records())
+
+
+class MethodTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.jdwp = CannedJdwp()
+        self.tracer = pyjdb.MethodTracer(self.jdwp,
+                pyjdb.EventSubscriptions(self.jdwp), CannedSymbolTable(),
+                capacity=4)
+
+    def event(self, request_id, thread_id, class_id, method_id, received):
+        """Sends a method entry (request 1) or exit (request 2) event,
+        preceded by a breakpoint event in the same composite"""
+        location = struct.pack(">BQQQ", 1, class_id, method_id, 0)
+        header = struct.pack(">BI", 0, 2) + \
+                struct.pack(">BIQ", 2, 9, thread_id) + location
+        payload = header + struct.pack(">BIQ", 39 + request_id, request_id,
+                thread_id) + location
+        self.jdwp.send_raw_event(request_id, payload, len(header), received)
+
+    def test_filters(self):
+        self.tracer.start("com.foo.*", ["com.foo.gen.*", "*Test"], 7)
+        self.assertEqual([1, 2], sorted(self.jdwp.raw_event_cbs))
+        self.assertEqual([
+                {"modKind": pyjdwp.MODIFIER_KIND_THREAD_ONLY, "thread": 7},
+                {"modKind": pyjdwp.MODIFIER_KIND_CLASS_MATCH,
+                    "classPattern": "com.foo.*"},
+                {"modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": "com.foo.gen.*"},
+                {"modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": "*Test"}],
+                self.jdwp.event_requests[1]["modifiers"])
+        self.tracer.stop()
+        self.assertEqual({}, self.jdwp.raw_event_cbs)
+        self.assertEqual({}, self.jdwp.event_requests)
+
+    def test_call_stats(self):
+        self.tracer.start()
+        event = self.event
+        # thread 1: m1 calls m2 twice; thread 2 runs m2
+        event(1, 1, 1, 1, 10.0)
+        event(1, 1, 1, 2, 10.5)
+        event(1, 2, 1, 2, 10.6)
+        event(2, 1, 1, 2, 11.0)
+        event(1, 1, 1, 2, 11.5)
+        event(2, 1, 1, 2, 12.5)
+        event(2, 1, 1, 1, 14.0)
+        # exit without an entry
+        event(2, 2, 1, 3, 15.0)
+        stats = self.tracer.stats()
+        self.assertEqual(8, stats["events"])
+        self.assertEqual(4, stats["overwritten"])
+        self.assertEqual(1, stats["unmatched"])
+        self.assertEqual(1, stats["open_calls"])
+        self.assertEqual([(12.5, 1, 1, 2, True), (14.0, 1, 1, 1, True),
+                (15.0, 2, 1, 3, True)], self.tracer.records()[1:])
+        self.assertEqual([
+                {"class_id": 1, "method_id": 1, "name": "C1.m1", "calls": 1,
+                    "total": 4.0, "mean": 4.0, "max": 4.0},
+                {"class_id": 1, "method_id": 2, "name": "C1.m2", "calls": 2,
+                    "total": 1.5, "mean": 0.75, "max": 1.0}],
+                self.tracer.method_stats())
+
+
+class BreakpointConditionTest(unittest.TestCase):
+    def test_modifiers(self):
+        condition = pyjdb.BreakpointCondition(hit_count=3, thread_id=7,
+                class_exclude="java.*")
+        # the count comes last, so only hits passing the filters count
+        self.assertEqual([
+                {"modKind": pyjdwp.MODIFIER_KIND_THREAD_ONLY, "thread": 7},
+                {"modKind": pyjdwp.MODIFIER_KIND_CLASS_EXCLUDE,
+                    "classPattern": "java.*"},
+                {"modKind": pyjdwp.MODIFIER_KIND_COUNT, "count": 3}],
+                condition.modifiers())
+        self.assertEqual([], pyjdb.BreakpointCondition().modifiers())
+
+    def test_holds(self):
+        condition = pyjdb.BreakpointCondition(
+                predicate=lambda local_values: local_values["x"] > 1,
+                local_names=["x"])
+        self.assertTrue(condition.holds({"x": 2}))
+        self.assertFalse(condition.holds({"x": 0}))
+        # x is out of scope at the location
+        self.assertFalse(condition.holds({}))
+        self.assertTrue(pyjdb.BreakpointCondition().holds({}))
+
+
+class TracepointTest(unittest.TestCase):
+    def test_rate_limit(self):
+        tracepoint = pyjdb.Tracepoint("Foo.java", 12, max_rate=2)
+        self.assertEqual([True, True, False],
+                [tracepoint.allow() for _ in range(3)])
+        self.assertEqual(1, tracepoint.dropped)
+        self.assertTrue(pyjdb.Tracepoint("Foo.java", 12).allow())
+
+    def test_pause_stats(self):
+        tracepoint = pyjdb.Tracepoint("Foo.java", 12, max_records=2)
+        self.assertEqual({"count": 0, "mean": 0.0, "max": 0.0},
+                tracepoint.pause_stats())
+        tracepoint.pause_times.extend([0.5, 0.001, 0.003])
+        self.assertEqual({"count": 2, "mean": 0.002, "max": 0.003},
+                tracepoint.pause_stats())
+
+
+class BreakpointRegistryTest(unittest.TestCase):
+    def test_lookups(self):
+        registry = pyjdb.BreakpointRegistry()
+        first = pyjdb.Breakpoint("Foo.java", 12)
+        first.path, first.line = "com/foo/Foo.java", 13
+        first.locations = [(1, 10, 9), (2, 20, 0)]
+        first.request_ids = [100, 101]
+        second = pyjdb.Breakpoint("com/foo/Foo.java", 13)
+        second.path, second.line = "com/foo/Foo.java", 13
+        second.locations = [(1, 10, 9)]
+        second.request_ids = [102]
+        registry.begin_set([first, second])
+        registry.add(first, 100)
+        registry.add(first, 101)
+        registry.add(second, 102)
+        self.assertEqual([], registry.end_set())
+        self.assertIs(first, registry.lookup(101))
+        self.assertIs(second, registry.for_event(
+                {"eventKind": 2, "Breakpoint": {"requestID": 102}}))
+        self.assertEqual((first, second), registry.at_location(1, 10, 9))
+        self.assertEqual(("com/foo/Foo.java", 13),
+                registry.source_line(2, 20, 0))
+        registry.remove(first)
+        self.assertEqual(1, len(registry))
+        self.assertEqual((second,), registry.at_location(1, 10, 9))
+        self.assertEqual(None, registry.source_line(2, 20, 0))
+
+    def test_hold_early_events(self):
+        registry = pyjdb.BreakpointRegistry()
+        breakpoint = pyjdb.Breakpoint("Foo.java", 12)
+        breakpoint.locations = [(1, 10, 9)]
+        hit = {"suspendPolicy": 1, "events": [
+                {"eventKind": 2, "Breakpoint": {"requestID": 100}}]}
+        # no Set in flight: the request is not ours
+        self.assertFalse(registry.hold_early(hit))
+        registry.begin_set([breakpoint])
+        self.assertEqual((breakpoint,), registry.at_location(1, 10, 9))
+        self.assertTrue(registry.setting())
+        self.assertTrue(registry.hold_early(hit))
+        registry.add(breakpoint, 100)
+        self.assertFalse(registry.hold_early(hit))
+        self.assertEqual([hit], registry.end_set())
+        self.assertFalse(registry.setting())
+        self.assertIs(breakpoint, registry.for_event(hit["events"][0]))
+
 
 if __name__ == "__main__":
     unittest.main()
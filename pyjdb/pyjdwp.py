@@ -17,6 +17,8 @@ class Timeout(Error):
     pass
 
 JDWP_PACKET_HEADER_LENGTH = 11
+# how often threads waiting for replies check whether they timed out
+REPLY_TIMER_INTERVAL = 0.25
 
 STRUCT_FMTS_BY_SIZE_UNSIGNED = {1: "B", 4: "I", 8: "Q"}
 
@@ -74,33 +76,296 @@ class RequestIdGenerator(object):
             self._next_id = value
 
 
+class EventDecoder(object):
+    """Decodes Event.Composite packets one event at a time.
+
+    peek() reads only the suspend policy and each event's kind and request ID
+    out of the raw packet, so callers can decide which events are worth a full
+    decode. Events nobody wants are stepped over: by arithmetic for kinds
+    whose layout has a fixed size (breakpoints, steps, method entry/exit,
+    thread start/death, ...), and by decoding only that one event otherwise.
+    """
+
+    def __init__(self, spec):
+        # events are decoded from memoryviews of the payload, so the field
+        # decoders slice without copying the rest of the composite each time
+        composite = spec.lookup_command("Event", "Composite")
+        select = composite.response.args[1].arg
+        self.__alts = select.alts
+        self.__sizes = {}
+        for kind, alt in self.__alts.iteritems():
+            self.__sizes[kind] = self.__fixed_size(spec, alt)
+
+    def peek(self, payload):
+        """Returns the suspend policy and a list of (eventKind, requestID,
+        offset) for the events in payload, where offset is that of the
+        event's kind byte (to be passed to decode)"""
+        suspend_policy, count = struct.unpack_from(">BI", payload, 0)
+        events = []
+        offset = 5
+        for i in range(count):
+            event_kind, request_id = struct.unpack_from(">BI", payload, offset)
+            events.append((event_kind, request_id, offset))
+            if i + 1 < count:
+                offset = self.skip(payload, offset)
+        return suspend_policy, events
+
+    def decode(self, payload, offset):
+        """Decodes the event at offset into the same dict shape as a full
+        Event.Composite decode produces for one entry of "events"."""
+        event_kind = ord(payload[offset])
+        _, result = self.__alts[event_kind].decode(
+                memoryview(payload)[offset + 1 : ], {"eventKind": event_kind})
+        return result
+
+    def skip(self, payload, offset):
+        """Returns the offset of the event following the one at offset"""
+        event_kind = ord(payload[offset])
+        size = self.__sizes[event_kind]
+        if size is not None:
+            return offset + 1 + size
+        rest, _ = self.__alts[event_kind].decode(
+                memoryview(payload)[offset + 1 : ], {})
+        return len(payload) - len(rest)
+
+    def __fixed_size(self, spec, alt):
+        size = 0
+        for arg in alt.args:
+            if isinstance(arg, Location):
+                size += 1 + spec.lookup_id_size("referenceTypeID") + \
+                        spec.lookup_id_size("methodID") + 8
+            elif isinstance(arg, TaggedObject):
+                size += 1 + spec.lookup_id_size("objectID")
+            elif isinstance(arg, Primitive):
+                if arg.type == "binary":
+                    size += 1
+                else:
+                    size += spec.lookup_id_size(arg.type)
+            else:
+                return None
+        return size
+
+
+class EventRouter(object):
+    """Runs event handlers on a pool of worker threads.
+
+    Each dispatch names an ordering key, normally the jvm thread the events
+    happened in. Work with the same key always lands on the same worker and
+    runs in dispatch order, so a thread's events are handled in order while
+    events of different threads are handled in parallel. A slow handler only
+    delays the work queued behind it on its own worker.
+    """
+
+    def __init__(self, num_workers=4, max_queued=1000):
+        self.__lock = threading.Lock()
+        # bounded, so that a backlog blocks the dispatching thread instead of
+        # growing without limit
+        self.__queues = [Queue.Queue(max_queued) for i in range(num_workers)]
+        self.__workers = []
+        for i, queue in enumerate(self.__queues):
+            worker = threading.Thread(target = self.__work, args = (queue,),
+                    name = "jdwp_event_worker_%d" % i)
+            worker.setDaemon(True)
+            self.__workers.append(worker)
+        self.__stats_by_handler = {}
+
+    def start(self):
+        for worker in self.__workers:
+            worker.start()
+
+    def stop(self):
+        for queue in self.__queues:
+            queue.put(None)
+
+    def dispatch(self, key, handler, *args):
+        """Queues handler(*args) on the worker for ordering key"""
+        with self.__lock:
+            if handler not in self.__stats_by_handler:
+                self.__stats_by_handler[handler] = {
+                    "queued": 0,
+                    "handled": 0,
+                    "total_latency": 0.0,
+                    "max_latency": 0.0}
+            self.__stats_by_handler[handler]["queued"] += 1
+        queue = self.__queues[hash(key) % len(self.__queues)]
+        queue.put((handler, args, time.time()))
+
+    def handler_stats(self):
+        """Returns, per handler, its current queue depth ("queued"), the
+        number of completed calls ("handled") and the total and maximum
+        latency in seconds from dispatch to completion"""
+        with self.__lock:
+            return dict((handler, dict(stats)) for handler, stats in
+                    self.__stats_by_handler.iteritems())
+
+    def __work(self, queue):
+        while True:
+            work = queue.get()
+            if work is None:
+                return
+            handler, args, dispatch_time = work
+            try:
+                handler(*args)
+            except Exception as e:
+                logging.exception("Event handler %s failed", handler)
+            latency = time.time() - dispatch_time
+            with self.__lock:
+                stats = self.__stats_by_handler[handler]
+                stats["queued"] -= 1
+                stats["handled"] += 1
+                stats["total_latency"] += latency
+                stats["max_latency"] = max(stats["max_latency"], latency)
+
+
+class PendingReply(object):
+    """Handle to the reply of a request sent with Jdwp.command_request_async"""
+
+    def __init__(self, jdwp, command, req_id):
+        self.__jdwp = jdwp
+        self.__command = command
+        self.__reply = None
+        self.__error = None
+        self.req_id = req_id
+
+    def wait(self):
+        """Blocks until the reply arrives, without decoding it; raises
+        pyjdwp.Error if the request failed"""
+        if self.__reply is None and self.__error is None:
+            try:
+                self.__reply = self.__jdwp.await_reply(self.req_id)
+            except Timeout:
+                raise
+            except Error as e:
+                self.__error = e
+        if self.__error is not None:
+            raise self.__error
+
+    def get(self):
+        """Blocks until the reply arrives and returns it decoded; raises
+        pyjdwp.Error if the request failed"""
+        self.wait()
+        return self.__command.decode(self.__reply)
+
+
 class Jdwp(object):
-    def __init__(self, host="localhost", port=5005, timeout=10):
+    """Connection to a target jvm's jdwp agent.
+
+    Incoming events pass through a bounded queue between the socket reader
+    and the notifier thread. When more than event_high_water events are
+    queued, the target is asked to hold further events
+    (VirtualMachine.HoldEvents) until the queue drains to event_low_water
+    (VirtualMachine.ReleaseEvents). Held events stay queued in the target,
+    so memory use stays bounded however fast events are generated; only if
+    the queue still reaches max_queued_events are new events dropped.
+    """
+
+    def __init__(self, host="localhost", port=5005, timeout=10,
+            event_workers=4, max_queued_events=10000, event_high_water=5000,
+            event_low_water=1000):
         logging.info("Create jdwp object for %s:%d", host, port)
         self.__timeout = timeout
         self.__request_id_generator = RequestIdGenerator()
         self.__event_cbs = []
+        self.__event_cbs_by_kind = {}
+        self.__event_cbs_by_request_id = {}
+        self.__raw_event_cbs_by_request_id = {}
+        self.__event_stats_lock = threading.Lock()
+        self.__event_stats = {
+                "decoded": 0,
+                "raw": 0,
+                "skipped": 0,
+                "dropped": 0,
+                "holds": 0,
+                "releases": 0,
+                "max_queued": 0}
+        self.__event_router = EventRouter(event_workers)
         self.__conn = JdwpConnection(host, port, self.handle_packet)
         self.__replies = {}
-        self.__events = Queue.Queue()
+        self.__replies_cond = threading.Condition()
+        self.__discarded_replies = set()
+        self.__events = Queue.Queue(max_queued_events)
+        self.__event_high_water = event_high_water
+        self.__event_low_water = event_low_water
+        self.__events_held = False
         # background thread for calling self.__event_cbs as new events come in.
         # we use a separate thread for this so that JdwpConnection's
         # __reader_thread need not block while we handle events.
         self.__notifier_thread = threading.Thread(
                 target = self.__event_notify_loop, name = "jdwp_event_notifier")
         self.__notifier_thread.setDaemon(True)
+        # python 2 implements waits with a timeout by polling, which adds up
+        # to milliseconds to every round trip; reply waiters block instead,
+        # and this thread wakes them up now and then to check for timeouts.
+        self.__reply_timer_running = False
+        self.__reply_timer_thread = threading.Thread(
+                target = self.__reply_timer_loop, name = "jdwp_reply_timer")
+        self.__reply_timer_thread.setDaemon(True)
         logging.info("Jdwp object created")
 
-    def register_event_callback(self, event_cb):
+    def register_event_callback(self, event_cb, event_kind=None,
+            request_id=None):
+        """Registers event_cb to be called with composite events, each with
+        the time its packet was received under "received".
+
+        With no event_kind or request_id, event_cb receives every event.
+        Otherwise it only receives events of event_kind, or only events
+        generated by request_id, and events no callback is interested in are
+        never decoded. Callbacks run on a pool of event_workers threads:
+        events of one jvm thread reach each callback in order, and for each
+        event, callbacks registered by kind are dispatched before those
+        registered by request ID, and those before the callbacks receiving
+        every event."""
         logging.info("Register event callback")
-        self.__event_cbs.append(event_cb)
+        self.__event_cb_list(event_kind, request_id).append(event_cb)
 
-    def unregister_event_callback(self, event_cb):
+    def unregister_event_callback(self, event_cb, event_kind=None,
+            request_id=None):
         logging.info("Unregister event callback")
-        self.__event_cbs.remove(event_cb)
+        self.__event_cb_list(event_kind, request_id).remove(event_cb)
+        if event_kind is not None and not self.__event_cbs_by_kind[event_kind]:
+            del self.__event_cbs_by_kind[event_kind]
+        elif request_id is not None and \
+                not self.__event_cbs_by_request_id[request_id]:
+            del self.__event_cbs_by_request_id[request_id]
+
+    def register_raw_event_callback(self, event_cb, request_id):
+        """Registers event_cb to be called with the undecoded events
+        generated by request_id, for consumers of high event rates (e.g.,
+        method entry and exit).
+
+        event_cb is called on the notifier thread itself, before any other
+        callback is dispatched, with the Event.Composite payload, the offset
+        of the event's kind byte in it and the time the packet was received;
+        it must be quick, as it holds up all other events. There is one raw
+        callback per request ID."""
+        logging.info("Register raw event callback")
+        self.__raw_event_cbs_by_request_id[request_id] = event_cb
+
+    def unregister_raw_event_callback(self, request_id):
+        logging.info("Unregister raw event callback")
+        self.__raw_event_cbs_by_request_id.pop(request_id, None)
+
+    def event_stats(self):
+        """Returns event pipeline counters: events decoded for callbacks,
+        handed undecoded to raw callbacks, skipped without decoding because
+        no callback wanted them, and dropped because the queue was full; how
+        often the target was told to hold and release events; and the
+        current ("queued") and maximum queue depth"""
+        with self.__event_stats_lock:
+            stats = dict(self.__event_stats)
+        stats["queued"] = self.__events.qsize()
+        stats["held"] = self.__events_held
+        return stats
+
+    def event_handler_stats(self):
+        """Returns queue depth and latency per event callback; see
+        EventRouter.handler_stats"""
+        return self.__event_router.handler_stats()
 
     def initialize(self):
         logging.info("Unregister event callback")
+        self.__reply_timer_running = True
+        self.__reply_timer_thread.start()
         # As soon as we call this, events (e.g., vm_start) may be incoming.
         self.__conn.initialize()
         self.__await_vm_start()
@@ -113,66 +378,201 @@ class Jdwp(object):
         for constant_set_name in self.jdwp_spec.constant_sets:
             constant_set = self.jdwp_spec.constant_sets[constant_set_name]
             setattr(self, constant_set_name, GenericConstantSet(constant_set))
+        self.__event_decoder = EventDecoder(self.jdwp_spec)
         self.__notifier_running = True
+        self.__event_router.start()
         self.__notifier_thread.start()
 
     def command_request(self, command_set_name, command_name, data):
+        return self.command_request_async(
+                command_set_name, command_name, data).get()
+
+    def command_request_async(self, command_set_name, command_name, data):
+        """Sends a request without waiting for its reply; returns a
+        PendingReply. Sending many requests before collecting any reply
+        pipelines them, costing one round trip instead of one each."""
         command = self.jdwp_spec.lookup_command(command_set_name, command_name)
         req_id = self.__request_id_generator.next_id
         command_set_id = command.command_set_id
         command_id = command.id
         payload = command.encode(data)
         self.__conn.send(req_id, command_set_id, command_id, payload)
-        reply_payload = self.__await_reply(req_id)
-        return command.decode(reply_payload)
+        return PendingReply(self, command, req_id)
+
+    def command_requests(self, command_set_name, command_name, data_list):
+        """Pipelines one request per entry of data_list and returns their
+        decoded replies in order, with None in place of requests that failed
+        (e.g. for a class that was unloaded in the meantime)"""
+        pending = [self.command_request_async(
+                command_set_name, command_name, data) for data in data_list]
+        replies = []
+        for reply in pending:
+            try:
+                replies.append(reply.get())
+            except Timeout:
+                raise
+            except Error:
+                replies.append(None)
+        return replies
+
+    def await_reply(self, req_id):
+        """Blocks until a reply is received for "req_id"; raises pyjdwp.Error
+        if err != 0, returns reply otherwise"""
+        deadline = time.time() + self.__timeout
+        with self.__replies_cond:
+            while req_id not in self.__replies:
+                if time.time() >= deadline:
+                    raise Timeout("Timed out")
+                self.__replies_cond.wait()
+            err, reply = self.__replies.pop(req_id)
+        if err != 0:
+            raise Error("JDWP error: %s" % err)
+        return reply
 
     def disconnect(self):
         self.__notifier_running = False;
+        try:
+            self.__events.put_nowait(None)
+        except Queue.Full:
+            # the notifier has events to wake up for, and stops at the next
+            pass
+        self.__reply_timer_running = False
+        self.__event_router.stop()
         self.__conn.disconnect()
 
     def handle_packet(self, req_id, flags, err, payload):
         if err == 0x4064:
-            self.__events.put((req_id, payload))
+            self.__enqueue_event(req_id, payload)
             return
-        if req_id in self.__replies:
-            raise Error("More than one reply packet for req_id %d" % req_id)
-        self.__replies[req_id] = (err, payload)
+        with self.__replies_cond:
+            if req_id in self.__discarded_replies:
+                self.__discarded_replies.remove(req_id)
+                if err != 0:
+                    logging.warning("JDWP error %s for req_id %d", err, req_id)
+                return
+            if req_id in self.__replies:
+                raise Error("More than one reply packet for req_id %d" %
+                        req_id)
+            self.__replies[req_id] = (err, payload)
+            self.__replies_cond.notify_all()
+
+    def __enqueue_event(self, req_id, payload):
+        # runs on the connection's reader thread, so it must never block
+        try:
+            self.__events.put_nowait((req_id, payload, time.time()))
+        except Queue.Full:
+            with self.__event_stats_lock:
+                self.__event_stats["dropped"] += 1
+            logging.warning("Event queue full; dropping event")
+            return
+        queued = self.__events.qsize()
+        with self.__event_stats_lock:
+            self.__event_stats["max_queued"] = max(
+                    self.__event_stats["max_queued"], queued)
+            hold = not self.__events_held and \
+                    queued >= self.__event_high_water
+            if hold:
+                self.__events_held = True
+                self.__event_stats["holds"] += 1
+        if hold:
+            logging.info("%d events queued; holding events", queued)
+            self.__send_discarding_reply(1, 15)  # VirtualMachine.HoldEvents
+
+    def __release_events_if_drained(self):
+        with self.__event_stats_lock:
+            release = self.__events_held and \
+                    self.__events.qsize() <= self.__event_low_water
+            if release:
+                self.__events_held = False
+                self.__event_stats["releases"] += 1
+        if release:
+            logging.info("Event queue drained; releasing events")
+            self.__send_discarding_reply(1, 16)  # VirtualMachine.ReleaseEvents
+
+    def __send_discarding_reply(self, cmd_set_id, cmd_id):
+        """Sends a payload-less command whose reply nobody will wait for"""
+        req_id = self.__request_id_generator.next_id
+        with self.__replies_cond:
+            self.__discarded_replies.add(req_id)
+        self.__conn.send(req_id, cmd_set_id, cmd_id)
+
+    def __reply_timer_loop(self):
+        while self.__reply_timer_running:
+            time.sleep(REPLY_TIMER_INTERVAL)
+            with self.__replies_cond:
+                self.__replies_cond.notify_all()
 
     def __event_notify_loop(self):
+        # blocks without a timeout, which python 2 would poll for;
+        # disconnect() wakes it up with a None
         while True:
-            if not self.__notifier_running:
+            item = self.__events.get()
+            if item is None or not self.__notifier_running:
                 return
-            if not self.__events.empty():
-                self.__event_notify()
-
-    def __event_notify(self):
-        while not self.__events.empty():
-            jvm_req_id, event_payload = self.__events.get()
-            event = self.__decode_event(event_payload)
-            for event_cb in self.__event_cbs:
-                event_cb(event)
-
-    def __decode_event(self, event_payload):
-        command = self.jdwp_spec.lookup_command("Event", "Composite")
-        return command.decode(event_payload)
-
-    def __await_reply(self, req_id):
-        """Blocks until a reply is received for "req_id"; raises pyjdwp.Error
-        if err != 0, returns reply otherwise"""
-        start_time = time.time()
-        while req_id not in self.__replies:
-            if time.time() >= start_time + self.__timeout:
-                raise Timeout("Timed out")
-        err, reply = self.__replies[req_id]
-        del self.__replies[req_id]
-        if err != 0:
-            raise Error("JDWP error: %s" % err)
-        return reply
+            jvm_req_id, event_payload, received = item
+            self.__release_events_if_drained()
+            self.__event_notify(event_payload, received)
+
+    def __event_notify(self, event_payload, received):
+        suspend_policy, peeked = self.__event_decoder.peek(event_payload)
+        # callbacks in notification order, each with its own events
+        events_by_cb = []
+        skipped = 0
+        raw = 0
+        decoded = 0
+        for event_kind, request_id, offset in peeked:
+            raw_event_cb = self.__raw_event_cbs_by_request_id.get(request_id)
+            if raw_event_cb is not None:
+                try:
+                    raw_event_cb(event_payload, offset, received)
+                except Exception:
+                    logging.exception("Raw event callback failed")
+                raw += 1
+            event_cbs = self.__event_cbs_by_kind.get(event_kind, []) + \
+                    self.__event_cbs_by_request_id.get(request_id, []) + \
+                    self.__event_cbs
+            if not event_cbs:
+                if raw_event_cb is None:
+                    skipped += 1
+                continue
+            event = self.__event_decoder.decode(event_payload, offset)
+            decoded += 1
+            for event_cb in event_cbs:
+                for cb, events in events_by_cb:
+                    if cb == event_cb:
+                        events.append(event)
+                        break
+                else:
+                    events_by_cb.append((event_cb, [event]))
+        with self.__event_stats_lock:
+            self.__event_stats["raw"] += raw
+            self.__event_stats["skipped"] += skipped
+            self.__event_stats["decoded"] += decoded
+        for event_cb, events in events_by_cb:
+            self.__event_router.dispatch(self.__event_thread(events[0]),
+                    event_cb,
+                    {"suspendPolicy": suspend_policy, "events": events,
+                        "received": received})
+
+    def __event_thread(self, event):
+        """Returns the jvm thread an event happened in, or 0 for events not
+        tied to a thread (e.g., class unloads)"""
+        for key, value in event.iteritems():
+            if key != "eventKind":
+                return value.get("thread", 0)
+        return 0
+
+    def __event_cb_list(self, event_kind, request_id):
+        if event_kind is not None:
+            return self.__event_cbs_by_kind.setdefault(event_kind, [])
+        if request_id is not None:
+            return self.__event_cbs_by_request_id.setdefault(request_id, [])
+        return self.__event_cbs
 
     def __await_vm_start(self):
         found_event = False
         while not found_event:
-            jvm_req_id, payload = self.__events.get()
+            jvm_req_id, payload, _ = self.__events.get()
             if len(payload) < 6:
                 raise Error("Unexpected event before jvm start: %s" % payload)
             _, _, event_kind = struct.unpack(">BIB", payload[0 : 6])
@@ -183,7 +583,7 @@ class Jdwp(object):
     def __hardcoded_version_request(self):
         req_id = self.__request_id_generator.next_id
         self.__conn.send(req_id, 1, 1)
-        version_data = self.__await_reply(req_id)
+        version_data = self.await_reply(req_id)
         desc_len = 4 + struct.unpack(">I", version_data[0:4])[0]
         minor_version = struct.unpack(
                 ">I", version_data[desc_len + 4: desc_len + 8])[0]
@@ -192,7 +592,7 @@ class Jdwp(object):
     def __hardcoded_id_sizes_request(self):
         req_id = self.__request_id_generator.next_id
         self.__conn.send(req_id, 1, 7)
-        id_size_data = self.__await_reply(req_id);
+        id_size_data = self.await_reply(req_id);
         id_size_names = [
                 "fieldIDSize",
                 "methodIDSize",
@@ -211,6 +611,9 @@ class JdwpConnection(object):
         # the socket we use to communicate with the jvm (connection is later)
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # pipelined requests are small packets sent back to back; without
+        # this, nagle's algorithm holds them until earlier ones are acked
+        self.__socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         self.__socket.settimeout(1.0)
         # callback for notifying of received jdwp packet (may be an event or
         # a response to a previous request). this should return quickly, as it
@@ -260,7 +663,7 @@ class JdwpConnection(object):
         length = JDWP_PACKET_HEADER_LENGTH + len(payload)
         header = struct.pack(">IIBBB", length, req_id, 0, cmd_set_id, cmd_id)
         with self.__request_lock:
-            self.__socket.send(header + payload)
+            self.__socket.sendall(header + payload)
 
     def disconnect(self):
         self.__socket.close();
@@ -271,23 +674,34 @@ class JdwpConnection(object):
         while True:
             if not self.__listening:
                 return
-            try:
-                header = self.__socket.recv(JDWP_PACKET_HEADER_LENGTH);
-            except socket.error as e:
-                continue
-            if len(header) != JDWP_PACKET_HEADER_LENGTH:
+            header = self.__recv(JDWP_PACKET_HEADER_LENGTH)
+            if header is None:
                 continue
             length, req_id, flags, err = struct.unpack(">IIBH", header)
-            remaining = length - JDWP_PACKET_HEADER_LENGTH
-            msg = bytearray()
-            while remaining > 0:
-                chunk = self.__socket.recv(min(remaining, 4096))
-                msg.extend(chunk)
-                remaining -= len(chunk)
-            # TODO(cgs): why do we need to do this string voodoo?
-            payload = "".join([chr(x) for x in msg])
+            payload = self.__recv(length - JDWP_PACKET_HEADER_LENGTH)
+            if payload is None:
+                continue
             self.__packet_callback(req_id, flags, err, payload)
 
+    def __recv(self, length):
+        """Reads exactly length bytes, which at high event rates often
+        arrive in several segments; returns None if the connection is lost
+        or closed first"""
+        data = bytearray()
+        while len(data) < length:
+            if not self.__listening:
+                return None
+            try:
+                chunk = self.__socket.recv(min(length - len(data), 65536))
+            except socket.timeout:
+                continue
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return str(data)
+
 
 class JdwpSpec(object):
     def __init__(self, version, id_sizes):
@@ -799,7 +1213,22 @@ SPEC_GRAMMAR_S_EXP_LIST = pyparsing.Group(SPEC_GRAMMAR_OPEN_PAREN +
 SPEC_GRAMMAR_S_EXP << ( SPEC_GRAMMAR_STRING | SPEC_GRAMMAR_S_EXP_LIST )
 GRAMMAR_JDWP_SPEC = pyparsing.OneOrMore(SPEC_GRAMMAR_S_EXP)
 
+# modKind values of EventRequest.Set modifiers
+MODIFIER_KIND_COUNT = 1
+MODIFIER_KIND_CONDITIONAL = 2
+MODIFIER_KIND_THREAD_ONLY = 3
+MODIFIER_KIND_CLASS_ONLY = 4
+MODIFIER_KIND_CLASS_MATCH = 5
+MODIFIER_KIND_CLASS_EXCLUDE = 6
+MODIFIER_KIND_LOCATION_ONLY = 7
+MODIFIER_KIND_EXCEPTION_ONLY = 8
+MODIFIER_KIND_FIELD_ONLY = 9
+MODIFIER_KIND_STEP = 10
+MODIFIER_KIND_INSTANCE_ONLY = 11
+MODIFIER_KIND_SOURCE_NAME_MATCH = 12
+
 ACCESS_MODIFIER_PUBLIC = 0x0001
+ACCESS_MODIFIER_STATIC = 0x0008 # fields and methods
 ACCESS_MODIFIER_FINAL = 0x0010
 ACCESS_MODIFIER_SUPER = 0x0020 # old invokespecial instruction semantics (Java 1.0x?)
 ACCESS_MODIFIER_INTERFACE = 0x0200
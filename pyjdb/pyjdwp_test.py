@@ -4,8 +4,10 @@ import pyjdwp
 import signal
 import socket
 import string
+import struct
 import subprocess
 import tempfile
+import threading
 import time
 import unittest
 import Queue
@@ -99,7 +101,8 @@ class PyjdwpTestBase(unittest.TestCase):
             # won't be called if we fail) and bail.
             self.test_target_subprocess.send_signal(signal.SIGKILL)
             raise e
-        self.jdwp = pyjdwp.Jdwp("localhost", port)
+        self.jdwp = pyjdwp.Jdwp("localhost", port,
+                **getattr(self, "jdwp_options", {}))
         self.jdwp.initialize();
 
     def tearDown(self):
@@ -369,6 +372,30 @@ class VirtualMachineTest(PyjdwpTestBase):
         pass
 
 
+class EventBackpressureTest(PyjdwpTestBase):
+    # hold events as soon as two are queued
+    jdwp_options = {"event_high_water": 2, "event_low_water": 0}
+
+    def test_hold_and_release_events(self):
+        prepared = Queue.Queue()
+        def slow_callback(event):
+            time.sleep(.01)
+            prepared.put(event)
+        self.jdwp.register_event_callback(slow_callback,
+                self.jdwp.EventKind.CLASS_PREPARE)
+        self.jdwp.EventRequest.Set({
+                "eventKind": self.jdwp.EventKind.CLASS_PREPARE,
+                "suspendPolicy": self.jdwp.SuspendPolicy.NONE,
+                "modifiers": []})
+        self.jdwp.VirtualMachine.Resume()
+        prepared.get(timeout=10)
+        time.sleep(2)
+        stats = self.jdwp.event_stats()
+        self.assertGreater(stats["holds"], 0)
+        self.assertGreater(stats["releases"], 0)
+        self.assertEquals(0, stats["dropped"])
+
+
 class ReferenceTypeTest(PyjdwpTestBase):
     def setUp(self):
         super(ReferenceTypeTest, self).setUp()
@@ -1318,5 +1345,75 @@ class StackFrameTest(PyjdwpTestBase):
         # now there should only be 3 frames
         self.assertEquals(len(resp), 3)
 
+
+class EventDecoderTest(unittest.TestCase):
+    """Decodes hand-built composite event packets; needs no target jvm"""
+
+    def setUp(self):
+        self.spec = pyjdwp.JdwpSpec(7, {
+                "fieldIDSize": 8,
+                "methodIDSize": 8,
+                "objectIDSize": 8,
+                "referenceTypeIDSize": 8,
+                "frameIDSize": 8})
+        self.decoder = pyjdwp.EventDecoder(self.spec)
+        location = struct.pack(">BQQQ", 1, 100, 200, 7)
+        breakpoint = struct.pack(">BIQ", 2, 5, 42) + location
+        signature = "LFoo;"
+        class_prepare = struct.pack(">BIQBQI", 8, 9, 43, 1, 77,
+                len(signature)) + signature + struct.pack(">i", 7)
+        thread_death = struct.pack(">BIQ", 7, 3, 44)
+        self.payload = struct.pack(">BI", 2, 4) + breakpoint + \
+                class_prepare + thread_death + breakpoint
+
+    def test_peek(self):
+        suspend_policy, events = self.decoder.peek(self.payload)
+        self.assertEquals(2, suspend_policy)
+        self.assertEquals([(2, 5), (8, 9), (7, 3), (2, 5)],
+                [(kind, request_id) for kind, request_id, _ in events])
+
+    def test_decode_matches_full_decode(self):
+        _, events = self.decoder.peek(self.payload)
+        full = self.spec.lookup_command("Event", "Composite").decode(
+                self.payload)
+        self.assertEquals(full["events"], [self.decoder.decode(
+                self.payload, offset) for _, _, offset in events])
+
+
+class EventRouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = pyjdwp.EventRouter(num_workers=3)
+        self.router.start()
+
+    def tearDown(self):
+        self.router.stop()
+
+    def test_per_key_ordering(self):
+        handled = Queue.Queue()
+        def handler(key, n):
+            handled.put((key, n))
+        for n in range(100):
+            for key in range(5):
+                self.router.dispatch(key, handler, key, n)
+        by_key = {}
+        for i in range(500):
+            key, n = handled.get(timeout=5)
+            by_key.setdefault(key, []).append(n)
+        for key in range(5):
+            self.assertEquals(range(100), by_key[key])
+        stats = self.router.handler_stats()[handler]
+        self.assertEquals(500, stats["handled"])
+        self.assertEquals(0, stats["queued"])
+
+    def test_slow_handler_does_not_block_other_keys(self):
+        release = threading.Event()
+        handled = Queue.Queue()
+        self.router.dispatch(0, release.wait)
+        self.router.dispatch(1, handled.put, "fast")
+        self.assertEquals("fast", handled.get(timeout=5))
+        self.assertEquals(1, self.router.handler_stats()[release.wait][
+                "queued"])
+        release.set()
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,271 @@
+"""Compact binary snapshots of jvm state (see Pyjdb.capture_snapshot).
+
+A snapshot file is a header followed by five sections: a string table and
+tables of fixed-width thread, frame, value and object records, all little
+endian. Records refer to strings by index into the string table (NO_INDEX
+for none), frames and values by (first index, count) ranges, and object
+records are sorted by object ID, so a Snapshot can memory-map the file and
+look anything up without parsing it first.
+
+    header:  magic, version, flags, pause time, then (offset, count) for the
+             strings, threads, frames, values and objects sections
+    strings: count + 1 uint32 offsets into the utf-8 data that follows
+    thread:  thread ID, name, status, first frame, frame count
+    frame:   class ID, method ID, code index, class signature, method name,
+             method signature, source path, line number, first value, value
+             count
+    value:   name, type tag and an 8 byte payload: a signed integer, a double
+             or an object ID, depending on the tag
+    object:  object ID, type signature, type tag, first value, value count,
+             array length (-1 for non-arrays), string contents
+"""
+import bisect
+import mmap
+import struct
+
+
+MAGIC = "PYJDBSNP"
+VERSION = 1
+NO_INDEX = 0xffffffff
+FLAG_TRUNCATED = 0x1
+
+HEADER = struct.Struct("<8sHHd" + "QI" * 5)
+THREAD = struct.Struct("<QIiII")
+FRAME = struct.Struct("<QQQIIIIiII")
+VALUE_TAG = struct.Struct("<Ic")
+VALUE_BY_KIND = {
+        "int": struct.Struct("<Icxxxq"),
+        "double": struct.Struct("<Icxxxd"),
+        "id": struct.Struct("<IcxxxQ")}
+VALUE_SIZE = VALUE_BY_KIND["int"].size
+OBJECT = struct.Struct("<QIcxxxIIiI")
+STRING_OFFSET = struct.Struct("<I")
+
+_PAYLOAD_KINDS = {"F": "double", "D": "double", "B": "int", "C": "int",
+        "I": "int", "J": "int", "S": "int", "Z": "int", "V": "int"}
+
+
+def payload_kind(tag):
+    """Returns how a value with jdwp type tag is stored: "int", "double" or
+    "id" (objects)"""
+    return _PAYLOAD_KINDS.get(tag, "id")
+
+
+class SnapshotWriter(object):
+    """Builds a snapshot in memory and writes it out in one go. Values are
+    (name, tag, value) tuples, with None as the name of array elements."""
+
+    def __init__(self):
+        self.__strings = []
+        self.__string_indexes = {}
+        self.__threads = []
+        self.__frames = []
+        self.__values = []
+        self.__objects = {}
+
+    def string(self, value):
+        """Returns the index of value in the string table, adding it if
+        needed"""
+        if value is None:
+            return NO_INDEX
+        index = self.__string_indexes.get(value)
+        if index is None:
+            index = len(self.__strings)
+            self.__strings.append(value)
+            self.__string_indexes[value] = index
+        return index
+
+    def add_thread(self, thread_id, name, status, frames):
+        """Adds a thread; frames is a list of dicts with location (a
+        (class_id, method_id, code_index) tuple), class_signature,
+        method_name, method_signature, source_path, line_number and values,
+        top of stack first"""
+        self.__threads.append((thread_id, self.string(name), status,
+                len(self.__frames), len(frames)))
+        for frame in frames:
+            class_id, method_id, code_index = frame["location"]
+            first_value = self.__add_values(frame["values"])
+            self.__frames.append((class_id, method_id, code_index,
+                    self.string(frame["class_signature"]),
+                    self.string(frame["method_name"]),
+                    self.string(frame["method_signature"]),
+                    self.string(frame["source_path"]),
+                    frame["line_number"] if frame["line_number"] is not None
+                            else -1,
+                    first_value, len(frame["values"])))
+
+    def add_object(self, object_id, type_signature, tag, values, length=-1,
+            string=None):
+        """Adds an object with its field values or array elements, and, for
+        strings, their contents"""
+        self.__objects[object_id] = (type_signature, tag, values, length,
+                string)
+
+    def write(self, path, pause_time=0.0, truncated=False):
+        values = list(self.__values)
+        objects = []
+        for object_id in sorted(self.__objects):
+            type_signature, tag, object_values, length, string = \
+                    self.__objects[object_id]
+            objects.append(OBJECT.pack(object_id,
+                    self.string(type_signature), tag, len(values),
+                    len(object_values), length, self.string(string)))
+            values.extend(self.__pack_value(value) for value in object_values)
+        encoded = [value.encode("utf-8") if isinstance(value, unicode)
+                else value for value in self.__strings]
+        offsets = [0]
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        sections = [
+                "".join(STRING_OFFSET.pack(offset) for offset in offsets) +
+                        "".join(encoded),
+                "".join(THREAD.pack(*thread) for thread in self.__threads),
+                "".join(FRAME.pack(*frame) for frame in self.__frames),
+                "".join(values),
+                "".join(objects)]
+        counts = [len(encoded), len(self.__threads), len(self.__frames),
+                len(values), len(objects)]
+        offset = HEADER.size
+        table = []
+        for section, count in zip(sections, counts):
+            table.extend([offset, count])
+            offset += len(section)
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(HEADER.pack(MAGIC, VERSION,
+                    FLAG_TRUNCATED if truncated else 0, pause_time, *table))
+            for section in sections:
+                snapshot_file.write(section)
+
+    def __add_values(self, values):
+        first_value = len(self.__values)
+        self.__values.extend(self.__pack_value(value) for value in values)
+        return first_value
+
+    def __pack_value(self, value):
+        name, tag, payload = value
+        kind = payload_kind(tag)
+        if payload is None:
+            payload = 0
+        elif kind == "double":
+            payload = float(payload)
+        return VALUE_BY_KIND[kind].pack(self.string(name), tag, payload)
+
+
+class Snapshot(object):
+    """Read access to a memory-mapped snapshot file. Records are decoded on
+    access only; objects are found by binary search on their IDs."""
+
+    def __init__(self, path):
+        self.__file = open(path, "rb")
+        self.__map = mmap.mmap(self.__file.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.__map, 0)
+        if header[0] != MAGIC or header[1] != VERSION:
+            self.close()
+            raise ValueError("%s is not a version %d snapshot" % (
+                    path, VERSION))
+        self.truncated = bool(header[2] & FLAG_TRUNCATED)
+        self.pause_time = header[3]
+        (self.__strings_offset, self.string_count,
+                self.__threads_offset, self.thread_count,
+                self.__frames_offset, self.frame_count,
+                self.__values_offset, self.value_count,
+                self.__objects_offset, self.object_count) = header[4:]
+        self.__string_data_offset = self.__strings_offset + \
+                STRING_OFFSET.size * (self.string_count + 1)
+        self.__object_ids = _ObjectIds(self.__map, self.__objects_offset,
+                self.object_count)
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+    def string(self, index):
+        if index == NO_INDEX:
+            return None
+        start, end = struct.unpack_from("<II", self.__map,
+                self.__strings_offset + STRING_OFFSET.size * index)
+        return self.__map[self.__string_data_offset + start :
+                self.__string_data_offset + end].decode("utf-8")
+
+    def thread(self, index):
+        thread_id, name, status, first_frame, frame_count = \
+                THREAD.unpack_from(self.__map,
+                        self.__threads_offset + THREAD.size * index)
+        return {
+                "thread_id": thread_id,
+                "name": self.string(name),
+                "status": status,
+                "first_frame": first_frame,
+                "frame_count": frame_count}
+
+    def threads(self):
+        return [self.thread(index) for index in xrange(self.thread_count)]
+
+    def frame(self, index):
+        (class_id, method_id, code_index, class_signature, method_name,
+                method_signature, source_path, line_number, first_value,
+                value_count) = FRAME.unpack_from(self.__map,
+                        self.__frames_offset + FRAME.size * index)
+        return {
+                "location": (class_id, method_id, code_index),
+                "class_signature": self.string(class_signature),
+                "method_name": self.string(method_name),
+                "method_signature": self.string(method_signature),
+                "source_path": self.string(source_path),
+                "line_number": line_number if line_number >= 0 else None,
+                "first_value": first_value,
+                "value_count": value_count}
+
+    def frames(self, thread):
+        """Returns the frames of a thread as returned by thread()"""
+        return [self.frame(index) for index in xrange(thread["first_frame"],
+                thread["first_frame"] + thread["frame_count"])]
+
+    def value(self, index):
+        """Returns a (name, tag, value) tuple"""
+        offset = self.__values_offset + VALUE_SIZE * index
+        name, tag = VALUE_TAG.unpack_from(self.__map, offset)
+        _, _, payload = VALUE_BY_KIND[payload_kind(tag)].unpack_from(
+                self.__map, offset)
+        return (self.string(name), tag, payload)
+
+    def values(self, record):
+        """Returns the values of a frame or object record"""
+        return [self.value(index) for index in xrange(record["first_value"],
+                record["first_value"] + record["value_count"])]
+
+    def object(self, object_id):
+        """Returns the record of an object, or None if it was not
+        captured"""
+        index = bisect.bisect_left(self.__object_ids, object_id)
+        if index == self.object_count or \
+                self.__object_ids[index] != object_id:
+            return None
+        (object_id, type_signature, tag, first_value, value_count, length,
+                string) = OBJECT.unpack_from(self.__map,
+                        self.__objects_offset + OBJECT.size * index)
+        return {
+                "object_id": object_id,
+                "type_signature": self.string(type_signature),
+                "tag": tag,
+                "first_value": first_value,
+                "value_count": value_count,
+                "length": length if length >= 0 else None,
+                "string": self.string(string)}
+
+
+class _ObjectIds(object):
+    """The sorted object IDs of a mapped snapshot, as a sequence for bisect"""
+
+    def __init__(self, snapshot_map, offset, count):
+        self.__map = snapshot_map
+        self.__offset = offset
+        self.__count = count
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, index):
+        return struct.unpack_from("<Q", self.__map,
+                self.__offset + OBJECT.size * index)[0]
@@ -0,0 +1,65 @@
+"""Tests for the snapshot file format"""
+import os
+import snapshot
+import tempfile
+import unittest
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_round_trip(self):
+        writer = snapshot.SnapshotWriter()
+        writer.add_thread(1, u"main", 1, [{
+                "location": (100, 1000, 4),
+                "class_signature": "LFoo;",
+                "method_name": "main",
+                "method_signature": "([Ljava/lang/String;)V",
+                "source_path": "Foo.java",
+                "line_number": 11,
+                "values": [("this", "L", 4242), ("x", "I", -3),
+                    ("ratio", "D", 0.25), ("name", "s", 77)]}])
+        writer.add_thread(2, u"w\xf6rker", 3, [])
+        writer.add_object(4242, "LFoo;", "L", [("count", "J", 1 << 40)])
+        writer.add_object(77, "Ljava/lang/String;", "s", [],
+                string=u"h\xe9llo")
+        writer.add_object(90, "[I", "[", [(None, "I", 5), (None, "I", 6)],
+                length=2)
+        writer.write(self.path, pause_time=0.002, truncated=True)
+
+        snap = snapshot.Snapshot(self.path)
+        self.assertTrue(snap.truncated)
+        self.assertEqual(0.002, snap.pause_time)
+        threads = snap.threads()
+        self.assertEqual([u"main", u"w\xf6rker"],
+                [thread["name"] for thread in threads])
+        frames = snap.frames(threads[0])
+        self.assertEqual(1, len(frames))
+        self.assertEqual((100, 1000, 4), frames[0]["location"])
+        self.assertEqual(11, frames[0]["line_number"])
+        self.assertEqual([("this", "L", 4242), ("x", "I", -3),
+                ("ratio", "D", 0.25), ("name", "s", 77)],
+                snap.values(frames[0]))
+        self.assertEqual([], snap.frames(threads[1]))
+        self.assertEqual([("count", "J", 1 << 40)],
+                snap.values(snap.object(4242)))
+        self.assertEqual(u"h\xe9llo", snap.object(77)["string"])
+        array = snap.object(90)
+        self.assertEqual(2, array["length"])
+        self.assertEqual([(None, "I", 5), (None, "I", 6)], snap.values(array))
+        self.assertEqual(None, snap.object(91))
+        snap.close()
+
+    def test_not_a_snapshot(self):
+        with open(self.path, "wb") as snapshot_file:
+            snapshot_file.write("\0" * snapshot.HEADER.size)
+        self.assertRaises(ValueError, snapshot.Snapshot, self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()